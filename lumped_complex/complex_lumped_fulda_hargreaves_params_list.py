@@ -13,6 +13,14 @@ import datetime
 import sys
 import numpy as np
 from dateutil.relativedelta import relativedelta
+from evaluation_data import EvaluationData
+from forcing_cache import load_window
+from storage_state import StorageState
+from discharge_recorder import DischargeRecorder
+from solver_ladder import SolverLadder
+from parameter_bounds import BoundsEnforcer, ParameterOutOfBounds
+from spinup import Spinup
+from early_stop import EarlyStop
 
 
 class ComplexLumped(object):
@@ -20,7 +28,9 @@ class ComplexLumped(object):
     Class which contains the complete model, readeable for Spotpy
     """
     tr_soil_gw = spotpy.parameter.Constant(361.95603672540824)
-    def __init__(self, begin, end):
+    def __init__(self, begin, end, persistent_connections=True,
+                 bounds="reject", spinup="year", warmup_days=90,
+                 early_stop=None, early_stop_margin=None):
         """Initializes the model and build the core setup"""
         # tr_soil_GW = Residence time of the water in the soil to the GW
         self.params = [spotpy.parameter.List("tr_soil_gw",
@@ -66,10 +76,19 @@ class ComplexLumped(object):
         self.begin = begin
         self.end = end
 
+        # Create the connections only once and change their parameters
+        # for every run. False creates them again for every run.
+        self.persistent_connections = persistent_connections
+        self.connections = None
+
         # load the weather data and discharge data
         prec, temp, temp_min, temp_max, Q,  = self.loadPETQ()
         self.Q = Q
 
+        # Observed discharge and its statistics for the objective function
+        self.evaluation_data = EvaluationData(
+            self.Q[self.begin:self.end + datetime.timedelta(days=1)])
+
         # use only one core (faster when model is small
         cmf.set_parallel_threads(1)
 
@@ -106,6 +125,23 @@ class ComplexLumped(object):
 
         self.project = p
 
+        # Initial volumes of all storages, every run starts from them
+        self.initial_state = StorageState(p)
+        # Solvers for all runs, the ladder tries them one after the other
+        # until one of them finishes a run
+        self.ladder = SolverLadder(self.project, self.create_solver)
+        # Repairs or rejects parameter values outside of their bounds
+        self.bounds = BoundsEnforcer(self.params, bounds)
+        # Initial state of every run, the mean observed runoff of the spin-up
+        # year is used for the steady state of the parameters
+        spinup_begin = p.meteo_stations[0].T.begin.AsPython()
+        self.spinup = Spinup(p, [self.outlet], spinup_begin, self.begin,
+                             self.Q[spinup_begin:self.begin].mean(), spinup,
+                             warmup_days)
+        # Stops runs, which can not reach the save threshold of the sampler
+        self.early_stop = EarlyStop(self.evaluation_data, early_stop,
+                                    early_stop_margin, "nse")
+
 
     def set_parameters(self,
                        tr_soil_gw,
@@ -128,8 +164,9 @@ class ComplexLumped(object):
 
                        ):
         """
-        Creates all connections with the parameter values produced by the
-        sampling algorithm.
+        Sets the parameter values produced by the sampling algorithm. The
+        connections are created on the first call, later calls only change
+        their parameters.
         """
         print("tr_soil_gw: {}; tr_soil_out: {}; tr_gw_out: {}; V0_soil: {}; "
               "beta_soil_gw: {}; beta_soil_out: {}; ETV1: {}; fETV0: {}; "
@@ -137,23 +174,58 @@ class ComplexLumped(object):
               " {}\n".format(tr_soil_gw, tr_soil_out, tr_gw_out, V0_soil,
                          beta_soil_gw, beta_soil_out, ETV1, fETV0,  LAI, CanopyClosure))
         # Get all definition from the init method
-        p = self.project
-        c = p[0]
+        c = self.project[0]
+        if self.connections is None or not self.persistent_connections:
+            self.connections = self.create_connections()
+        con = self.connections
+
+        # Adjustment of the ET, cmf copies the stress into the cell, so it
+        # is handed over for every parameter set
+        c.set_uptakestress(cmf.VolumeStress(ETV1, ETV1 * fETV0))
+
+        # Flux from soil to outlet
+        con["soil_out"].residencetime = tr_soil_out / V0_soil
+        con["soil_out"].V0 = V0_soil
+        con["soil_out"].exponent = beta_soil_out
+
+        # Flux from soil to groundwater
+        con["soil_gw"].residencetime = tr_soil_gw / V0_soil
+        con["soil_gw"].V0 = V0_soil
+        con["soil_gw"].exponent = beta_soil_gw
+
+        # Flux from the  groundwater to the outlet (baseflow)
+        con["gw_out"].residencetime = tr_gw_out
+
+        # Sets the paramaters for interception
+        c.vegetation.LAI = LAI
+
+        # Defines how much throughfall there is (in %)
+        c.vegetation.CanopyClosure = CanopyClosure
+        #
+        # # # Set parameters of the snow calculations
+        # cmf.Weather.set_snow_threshold(snow_melt_temp)
+        # cmf.SimpleTindexSnowMelt(c.snow, soil, c, rate=meltrate)
+
+    def create_connections(self):
+        """
+        Creates all connections of the model. Their parameter values are
+        set by set_parameters.
+
+        :return: dictionary with all connections that have parameters
+        """
+        c = self.project[0]
         outlet = self.outlet
         soil = c.layers[0]
         gw = c.layers[1]
 
-        # Adjustment of the ET
-        c.set_uptakestress(cmf.VolumeStress(ETV1, ETV1 * fETV0))
-
         # Flux from soil to outlet
-        cmf.kinematic_wave(soil, outlet, tr_soil_out/V0_soil, V0=V0_soil, exponent=beta_soil_out)
+        soil_out = cmf.kinematic_wave(soil, outlet, 1.)
 
         # Flux from soil to groundwater
-        cmf.kinematic_wave(soil, gw, tr_soil_gw/V0_soil, V0=V0_soil, exponent=beta_soil_gw)
+        soil_gw = cmf.kinematic_wave(soil, gw, 1.)
 
         # Flux from the  groundwater to the outlet (baseflow)
-        cmf.kinematic_wave(gw, outlet, tr_gw_out)
+        gw_out = cmf.kinematic_wave(gw, outlet, 1.)
 
         # Split the rainfall in interception and throughfall
         cmf.Rainfall(c.canopy, c, False, True)
@@ -165,15 +237,8 @@ class ComplexLumped(object):
         # Transpiration from the plants is added
         cmf.CanopyStorageEvaporation(c.canopy, c.evaporation, c)
 
-        # Sets the paramaters for interception
-        c.vegetation.LAI = LAI
-
-        # Defines how much throughfall there is (in %)
-        c.vegetation.CanopyClosure = CanopyClosure
-        #
-        # # # Set parameters of the snow calculations
-        # cmf.Weather.set_snow_threshold(snow_melt_temp)
-        # cmf.SimpleTindexSnowMelt(c.snow, soil, c, rate=meltrate)
+        return {"soil_out": soil_out, "soil_gw": soil_gw,
+                "gw_out": gw_out}
 
     def loadPETQ(self):
         """
@@ -184,26 +249,25 @@ class ComplexLumped(object):
         # Change this if you want a warm up period other than a year
         begin = self.begin - relativedelta(years=1)
         step = datetime.timedelta(days=1)
-        # empty time series
-        prec = cmf.timeseries(begin, step)
-        prec.extend(float(Pstr.strip("\n")) for Pstr in open(fnP))
 
-        discharge = cmf.timeseries(begin, step)
-        discharge.extend(float(Qstr.strip("\n")) for Qstr in open(fnQ))
+        def load(file_name, num_columns=1):
+            """
+            Loads only the simulated days of a file. The text files are
+            parsed once, later starts read the binary cache.
+            """
+            return load_window(file_name, begin, self.end, num_columns)
+
+        prec = cmf.timeseries.from_array(begin, step, load(fnP))
+        discharge = cmf.timeseries.from_array(begin, step, load(fnQ))
         # Convert m3/s to mm/day
         area_catchment = 562.41  # Change this when catchment changes!!!
         discharge *= 86400 * 1e3 / (area_catchment * 1e6)
-        temp = cmf.timeseries(begin, step)
-        temp_min = cmf.timeseries(begin, step)
-        temp_max = cmf.timeseries(begin, step)
-
-        # Go through all lines in the file
-        for line in open(fnT):
-            columns = line.strip("\n").split('\t')
-            if len(columns) == 3:
-                temp_max.add(float(columns[0]))
-                temp_min.add(float(columns[1]))
-                temp.add(float(columns[2]))
+
+        # The columns of the temperature file are max, min and avg
+        temperature = load(fnT, num_columns=3)
+        temp_max = cmf.timeseries.from_array(begin, step, temperature[:, 0])
+        temp_min = cmf.timeseries.from_array(begin, step, temperature[:, 1])
+        temp = cmf.timeseries.from_array(begin, step, temperature[:, 2])
 
         return prec, temp, temp_min, temp_max, discharge
 
@@ -224,57 +288,86 @@ class ComplexLumped(object):
         self.project.use_nearest_meteo()
         return rainstation
 
-    def run_model(self):
+    def create_solver(self):
+        """
+        Creates the solver for differential equations. The model creates it
+        only once and uses it for all runs, it is the first rung of the
+        solver ladder.
+
+        :return: cmf.CVodeIntegrator
+        """
+        # The dense linear solver with a tolerance of 1e-9 is the next rung
+        # of the ladder
+        return cmf.CVodeIntegrator(self.project, 1e-8)
+
+    def run_model(self, parameters=None):
         """
         Starts the model. Used by spotpy
+
+        :param parameters: dictionary with the parameters of the run, only
+        used for the records of failed attempts
         """
         print("Start running model")
+        # The solvers of the ladder are tried one after the other, until one
+        # of them finishes the run
         try:
-            # Create a solver for differential equations
-            solver = cmf.CVodeIntegrator(self.project, 1e-9)
-            solver.LinearSolver = 0
-            self.solver = solver
-            # New time series for model results
-            resQ = cmf.timeseries(self.begin, cmf.day)
-            # starts the solver and calculates the daily time steps
-            end = self.end # datetime.datetime(1979,1,7,9)
-            tstart = time.time()
-            tmax = 300
-            for t in solver.run(self.project.meteo_stations[0].T.begin, end,
-                                cmf.day):
-                # Fill the results (first year is included but not used to
-                # calculate the NS)
-                print(t)
-                if t >= self.begin:
-                    resQ.add(self.outlet.waterbalance(t))
-                if time.time() - tstart > tmax:
-                    raise RuntimeError('Took more than {:0.1f}min to run'.format(tmax/60))
-            print("Finished running model")
-            return resQ
-        # Return an nan - array when a runtime error occurs
+            result = self.ladder.run(self.run_solver, parameters)
+            print("Finished running model with " + self.ladder.last_rung)
+            return result
+        # Return an nan - array when a runtime error occurs in all solvers
+        # (solver errors and runs stopped by the watchdogs)
         except RuntimeError as error:
             print(error)
             print("FInished running model")
-            return np.array(self.Q[
-                            self.begin:self.end + datetime.timedelta(
-                                days=1)])*np.nan
+            return self.evaluation_data.nan_result()
+
+    def run_solver(self, solver, watchdog):
+        """
+        Runs the model once with one solver of the ladder.
+
+        :param solver: cmf integrator of the project
+        :param watchdog: Watchdog with the limits for the solver
+        :return: np.array with the discharge of every day
+        """
+        # Start every parameter set from the initial volumes or from the
+        # steady state of its parameters
+        self.spinup.restore(self.initial_state, solver)
+        self.early_stop.start()
+        # Buffer for the model results, allocated for all days at once
+        resQ = DischargeRecorder(self.begin, self.end)
+        # starts the solver and calculates the daily time steps
+        end = self.end # datetime.datetime(1979,1,7,9)
+        for t in watchdog.run(solver, end, cmf.day):
+            # Fill the results (first year is included but not used to
+            # calculate the NS)
+            print(t)
+            if t >= self.begin:
+                q = self.outlet.waterbalance(t)
+                resQ.add(q)
+                # The rest of the run stays nan
+                if not self.early_stop.add(q):
+                    break
+        return resQ.values
 
     def simulation(self, vector):
         """
         SpotPy expects a method simulation. This methods calls set_parameters
         and run_models, so SpotPy is satisfied
         """
+        # Repair or reject values outside of the bounds of the parameters
+        try:
+            vector = self.bounds.apply(vector)
+        except ParameterOutOfBounds:
+            return self.evaluation_data.nan_result()
         paramdict = dict((pp.name, v) for pp, v in zip(self.params, vector))
         self.set_parameters(**paramdict)
-        resQ = self.run_model()
-        return np.array(resQ)
+        return self.run_model(paramdict)
 
     def evaluation(self):
         """
         For Spotpy
         """
-        return np.array(
-            self.Q[self.begin:self.end + datetime.timedelta(days=1)])
+        return self.evaluation_data.observed
 
     def parameters(self):
         """
@@ -286,19 +379,50 @@ class ComplexLumped(object):
         """
         For Spotpy
         """
-        # Slice the arrays to only use the days of the calibration period
-        # for objective function
-        evaluation_calibration = evaluation[:1827]
-        evaluation_validation = evaluation[1827:]
-        simulation_calibration = simulation[:1827]
-        simulation_validation = simulation[1827:]
-        ns_calibration = spotpy.objectivefunctions.nashsutcliffe(
-                                                        evaluation_calibration,
-                                                        simulation_calibration)
-        ns_validation = spotpy.objectivefunctions.nashsutcliffe(
-                                                        evaluation_validation,
-                                                        simulation_validation)
-        return [ns_calibration, ns_validation]
+        # Runs stopped early are ranked below all finished runs
+        if self.early_stop.stopped_early(simulation):
+            return self.early_stop.score(simulation)
+        # Calibration and validation period, the statistics of the
+        # observed discharge are calculated once in __init__
+        return self.evaluation_data.for_evaluation(evaluation).nse(
+            simulation)
+
+    def simulation_batch(self, matrix):
+        """
+        Runs many parameter sets, one per row of matrix. The bounds of all
+        sets are checked at once.
+
+        :param matrix: np.array with one parameter set per row
+        :return: np.array with the discharge of every day, one row per
+        parameter set
+        """
+        matrix, valid = self.bounds.apply_batch(matrix)
+        result = np.full((len(matrix), len(self.evaluation_data.observed)),
+                         np.nan)
+        for index in np.flatnonzero(valid):
+            paramdict = dict((pp.name, v)
+                             for pp, v in zip(self.params, matrix[index]))
+            self.set_parameters(**paramdict)
+            result[index] = self.run_model(paramdict)
+        return result
+
+    def objectivefunction_batch(self, simulations, evaluation):
+        """
+        Objective function of many runs at once, the periods of all runs
+        are scored together.
+
+        :param simulations: np.array with one simulation per row
+        :param evaluation: observed discharge
+        :return: np.array with one row per run and one column per period
+        """
+        simulations = np.array(simulations, dtype=np.float64, ndmin=2)
+        result = self.evaluation_data.for_evaluation(
+            evaluation).score_batch(simulations, "nse")
+        # Runs stopped early are ranked below all finished runs
+        for index, simulation in enumerate(simulations):
+            if self.early_stop.stopped_early(simulation):
+                result[index] = self.early_stop.score(simulation)
+        return result
 
 
 if __name__ == '__main__':
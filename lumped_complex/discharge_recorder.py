@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Collects the simulated discharge of a run in a NumPy array, which is
+allocated for the whole simulated period before the run starts. The array is
+handed to the objective function and the database as it is, unit
+conversions are done in place.
+"""
+import numpy as np
+
+
+class DischargeRecorder:
+    """
+    Buffer for the daily values of one run. Every run gets a new buffer, so
+    results already handed to spotpy are never overwritten.
+    """
+    def __init__(self, begin, end, dtype=np.float64):
+        """
+        :param begin: first recorded day
+        :param end: last recorded day (included)
+        :param dtype: np.float64 or np.float32
+        """
+        self.values = np.full((end - begin).days + 1, np.nan, dtype=dtype)
+        self.size = 0
+
+    def add(self, value):
+        """
+        Writes the value of the next day into the buffer.
+
+        :param value: discharge of the day
+        :return: None
+        """
+        self.values[self.size] = value
+        self.size += 1
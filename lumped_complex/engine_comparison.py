@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the NumPy engine (vector_engine.py) with cmf for random parameter
+sets. Every set is run once with cmf (CVODE) and once with the engine, the
+report shows for every set the largest difference of the KGE in the
+calibration and validation period and the largest relative difference of
+the daily discharge. The daily difference is relative to the discharge of
+cmf on that day, but at least to the mean discharge of cmf: on days with
+almost no discharge the plain relative difference gets large, although the
+absolute difference is tiny. The plain relative difference (of the days
+with discharge) is shown too, but it is not checked.
+
+The differences come mostly from the implicit Euler steps of the engine.
+They are largest on days with fast snow melt and shrink with the number of
+substeps: for the simple lumped model and 20 sets (seed 42) the largest
+daily difference was 14 % with 24 substeps and 3.5 % with 96, the largest
+KGE difference was 0.006.
+
+A set passes, if both differences are within the tolerances (KGE_TOLERANCE
+and DISCHARGE_TOLERANCE). The script exits with 1, if a set fails.
+
+Usage: python engine_comparison.py [runs] [seed]
+"""
+import datetime
+import sys
+import time
+
+import numpy as np
+
+
+# Largest accepted difference of the KGE in every period
+KGE_TOLERANCE = 0.01
+# Largest accepted difference of the daily discharge, relative to the
+# discharge of cmf, but at least to its mean
+DISCHARGE_TOLERANCE = 0.2
+
+
+def compare(model, vectors):
+    """
+    Runs the parameter sets with cmf and the engine.
+
+    :param model: lumped model created with engine="numpy"
+    :param vectors: parameter sets
+    :return: dictionary of np.arrays with one value per set: the largest
+    KGE difference, the largest daily difference relative to the
+    discharge of the day (at least the mean) and relative to the discharge
+    of the day only
+    """
+    evaluation = model.evaluation()
+    start = time.perf_counter()
+    cmf_runs = np.array([model.simulation(vector) for vector in vectors])
+    cmf_time = time.perf_counter() - start
+    start = time.perf_counter()
+    engine_runs = model.simulation_numpy(np.array(vectors, dtype=float))
+    engine_time = time.perf_counter() - start
+    result = {"kge": [], "discharge": [], "day": [],
+              "cmf time": cmf_time, "engine time": engine_time}
+    for cmf_run, engine_run in zip(cmf_runs, engine_runs):
+        difference = np.abs(
+            np.asarray(model.objectivefunction(cmf_run, evaluation)) -
+            np.asarray(model.objectivefunction(engine_run, evaluation)))
+        result["kge"].append(np.max(difference))
+        daily = np.abs(engine_run - cmf_run)
+        result["discharge"].append(np.max(
+            daily / np.maximum(np.abs(cmf_run), np.mean(cmf_run))))
+        wet = np.abs(cmf_run) > 0
+        result["day"].append(np.max(daily[wet] / np.abs(cmf_run[wet]),
+                                    initial=0.))
+    for key in ("kge", "discharge", "day"):
+        result[key] = np.array(result[key])
+    return result
+
+
+def report(name, model, vectors, out=sys.stdout):
+    """
+    Compares the engine with cmf and prints the differences of every set.
+
+    :param name: name of the model in the report
+    :param model: lumped model created with engine="numpy"
+    :param vectors: parameter sets
+    :param out: file the report is written to
+    :return: True if all sets are within the tolerances
+    """
+    result = compare(model, vectors)
+    passed = (result["kge"] <= KGE_TOLERANCE) & \
+        (result["discharge"] <= DISCHARGE_TOLERANCE)
+    out.write("{}, {} sets, tolerances: KGE {}, discharge {:.0%}\n".format(
+        name, len(vectors), KGE_TOLERANCE, DISCHARGE_TOLERANCE))
+    out.write("  cmf: {:.1f} s, engine: {:.1f} s\n".format(
+        result["cmf time"], result["engine time"]))
+    out.write("   set    KGE diff  discharge diff  largest day diff\n")
+    for index in range(len(vectors)):
+        out.write("  {:4d}  {:10.4f}  {:14.2%}  {:16.2%}  {}\n".format(
+            index, result["kge"][index], result["discharge"][index],
+            result["day"][index], "ok" if passed[index] else "FAILED"))
+    return bool(passed.all())
+
+
+if __name__ == '__main__':
+    import complex_lumped_fulda_hargreaves as model_file
+
+    # File names of the forcing data
+    model_file.fnQ = "Q_Kammerzell_1979_1999.txt"
+    model_file.fnT = "T_kammerzell_1979_1999_max_min_avg.txt"
+    model_file.fnP = "P_Krigavg_kammerzell_1979_1999.txt"
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 42
+
+    model = model_file.ComplexLumped(datetime.datetime(1980, 1, 1),
+                                     datetime.datetime(1989, 12, 31),
+                                     engine="numpy")
+    np.random.seed(seed)
+    vectors = [model.parameters()["random"] for _ in range(runs)]
+    sys.exit(0 if report("ComplexLumped", model, vectors) else 1)
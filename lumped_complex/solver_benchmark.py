@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the time the model spends on its solver. The setup is the time
+needed to create and initialize a new CVodeIntegrator. The time per run is
+measured three times:
+
+- with the solver of the model, which is used for all runs
+- with a new solver for every run, like the model did before
+- with a new solver for every run and cmf's solver.run instead of the
+  watchdog, like the model did before the solver ladder
+
+Reusing the solver does not make the runs faster: the setup of a solver
+takes about 0.015 ms, while a run of the complex lumped model takes about
+10 s (median of 3 runs: 9.6 s with the reused solver, 9.9 s with a new one
+and 9.3 s with solver.run). The watchdog integrates one output step (a day)
+at a time like solver.run, which also calls integrate_until for every step,
+so the differences between the three are within the noise of single runs.
+The report prints the ratios, so they can be checked for every model and
+machine.
+
+Usage: python solver_benchmark.py [runs]
+"""
+import datetime
+import sys
+import time
+
+import numpy as np
+
+from run_watchdog import Watchdog
+from solver_ladder import SolverLadder, SolverRung
+
+
+class PlainRun(Watchdog):
+    """
+    Runs the solver with cmf's solver.run without any checks, like the
+    models did before the watchdog.
+    """
+    def run(self, solver, end, step):
+        return solver.run(solver.t, end, step)
+
+
+def time_setup(model, repeats=20):
+    """
+    Times the creation of new solvers for the model.
+
+    :param model: model with a create_solver method
+    :param repeats: number of solvers created
+    :return: np.array with the seconds needed for every solver
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        solver = model.create_solver()
+        solver.initialize()
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def time_runs(model, vectors, new_solver=False, plain=False):
+    """
+    Times model.simulation for every parameter set.
+
+    :param model: model with a create_solver method and a solver ladder
+    :param vectors: parameter sets handed to model.simulation
+    :param new_solver: create new solvers for every run (included in the
+    time)
+    :param plain: run a new solver with solver.run instead of the ladder
+    and its watchdogs
+    :return: np.array with the seconds needed for every run
+    """
+    ladder = model.ladder
+    solvers = list(ladder.solvers)
+    if plain:
+        new_solver = True
+        model.ladder = SolverLadder(
+            model.project, model.create_solver,
+            [SolverRung("cvode", model.create_solver,
+                        PlainRun(log_file=None))], log_file=None)
+    times = []
+    for vector in vectors:
+        start = time.perf_counter()
+        if new_solver:
+            model.ladder.clear()
+        model.simulation(vector)
+        times.append(time.perf_counter() - start)
+    model.ladder = ladder
+    ladder.solvers = solvers
+    return np.array(times)
+
+
+def report(name, model, vectors, repeats=20, out=sys.stdout):
+    """
+    Runs all measurements for a model and prints the medians.
+
+    :param name: name of the model in the report
+    :param model: model with a create_solver method and a solver ladder
+    :param vectors: parameter sets handed to model.simulation
+    :param repeats: number of solvers created for the setup time
+    :param out: file the report is written to
+    :return: dictionary with the medians in seconds
+    """
+    # Alternate between the solver modes, so all see the same load
+    reused = []
+    new = []
+    plain = []
+    for vector in vectors:
+        reused.extend(time_runs(model, [vector]))
+        new.extend(time_runs(model, [vector], new_solver=True))
+        plain.extend(time_runs(model, [vector], plain=True))
+    result = {"setup": np.median(time_setup(model, repeats)),
+              "reused": np.median(reused),
+              "new": np.median(new),
+              "plain": np.median(plain)}
+    out.write("{}, {} runs\n".format(name, len(vectors)))
+    out.write("  solver setup:            {:10.3f} ms\n".format(
+        result["setup"] * 1e3))
+    out.write("  per run, reused solver:  {:10.3f} s\n".format(
+        result["reused"]))
+    out.write("  per run, new solver:     {:10.3f} s\n".format(result["new"]))
+    out.write("  per run, solver.run:     {:10.3f} s\n".format(
+        result["plain"]))
+    # Differences below 5 % are within the noise of single runs
+    ratio = result["reused"] / result["new"]
+    out.write("  reused / new solver:     {:10.2f} ({})\n".format(
+        ratio, "reusing the solver is faster" if ratio < 0.95
+        else "no speedup from reusing the solver"))
+    ratio = result["new"] / result["plain"]
+    out.write("  watchdog / solver.run:   {:10.2f} ({})\n".format(
+        ratio, "the watchdog is slower" if ratio > 1.05
+        else "no overhead of the watchdog"))
+    return result
+
+
+if __name__ == '__main__':
+    import complex_lumped_fulda_hargreaves as model_file
+
+    # File names of the forcing data
+    model_file.fnQ = "Q_Kammerzell_1979_1999.txt"
+    model_file.fnT = "T_kammerzell_1979_1999_max_min_avg.txt"
+    model_file.fnP = "P_Krigavg_kammerzell_1979_1999.txt"
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    start = time.perf_counter()
+    model = model_file.ComplexLumped(datetime.datetime(1980, 1, 1),
+                                     datetime.datetime(1989, 12, 31))
+    print("ComplexLumped created in {:.3f} s".format(
+        time.perf_counter() - start))
+
+    np.random.seed(42)
+    vectors = [model.parameters()["random"] for _ in range(runs)]
+    report("ComplexLumped", model, vectors)
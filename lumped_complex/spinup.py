@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Initial states of the storages for every run. The models start every run
+with the same fixed volumes one year before the calibration begins, so
+every run spends a year on the spin-up (mode "year").
+
+In mode "equilibrium" the layers of every cell start from their steady
+state under the mean runoff of the spin-up year instead, which depends on
+the parameters of the run. The steady state is found with the connections
+of the model itself: the uppermost layer drains the mean runoff, every
+deeper layer what drains into it from above. The run then starts only
+warmup_days before the calibration begins, so snow, canopy and soil can
+adapt to the actual weather.
+
+The mode can be set for a whole job with the environment variable SPINUP.
+"""
+import datetime
+import os
+
+
+MODES = ("year", "equilibrium")
+
+
+def drainage(layer, receivers):
+    """
+    Returns the connections through which a layer drains.
+
+    :param layer: cmf layer
+    :param receivers: node ids of the nodes the layer drains into
+    :return: list of cmf connections
+    """
+    return [connection for connection in layer.connections
+            if connection.get_target(layer).node_id in receivers]
+
+
+def outflow(layer, connections, volume, t):
+    """
+    Returns the outflow of a layer with the given volume.
+
+    :param layer: cmf layer
+    :param connections: connections the layer drains through
+    :param volume: volume of the layer in m³
+    :param t: time for the fluxes
+    :return: outflow in m³/day
+    """
+    layer.volume = volume
+    return -sum(connection.q(layer, t) for connection in connections)
+
+
+def steady_volume(layer, connections, inflow, t, rtol=1e-6):
+    """
+    Finds the volume at which the outflow of the layer equals the inflow.
+    The outflow grows with the volume, so the volume is bisected.
+
+    :param layer: cmf layer
+    :param connections: connections the layer drains through
+    :param inflow: inflow in m³/day
+    :param t: time for the fluxes
+    :param rtol: relative tolerance of the volume
+    :return: volume in m³
+    """
+    if inflow <= 0:
+        return 0.
+    lower = 0.
+    upper = max(layer.volume, 1.)
+    # Expand the interval until it holds the steady state
+    for _ in range(200):
+        if outflow(layer, connections, upper, t) >= inflow:
+            break
+        lower, upper = upper, upper * 2
+    for _ in range(200):
+        if upper - lower <= rtol * upper:
+            break
+        middle = (lower + upper) / 2
+        if outflow(layer, connections, middle, t) < inflow:
+            lower = middle
+        else:
+            upper = middle
+    return upper
+
+
+def set_equilibrium(project, outlets, runoff, t):
+    """
+    Sets the layers of all cells to their steady state.
+
+    :param project: cmf project
+    :param outlets: nodes the water leaves the model through
+    :param runoff: mean runoff in mm/day
+    :param t: time for the fluxes
+    :return: None
+    """
+    outlet_ids = {outlet.node_id for outlet in outlets}
+    for cell in project.cells:
+        layers = list(cell.layers)
+        ids = [layer.node_id for layer in layers]
+        inflow = [0.] * len(layers)
+        inflow[0] = runoff / 1000 * cell.area
+        for index, layer in enumerate(layers):
+            deeper = {ids[below]: below
+                      for below in range(index + 1, len(layers))}
+            connections = drainage(layer, outlet_ids | set(deeper))
+            # Layers without drainage keep their initial volume
+            if not connections:
+                continue
+            layer.volume = steady_volume(layer, connections, inflow[index],
+                                         t)
+            for connection in connections:
+                below = deeper.get(connection.get_target(layer).node_id)
+                if below is not None:
+                    inflow[below] -= connection.q(layer, t)
+
+
+class Spinup:
+    """
+    Sets the storages to their state at the start of a run.
+    """
+    def __init__(self, project, outlets, spinup_begin, begin, runoff,
+                 mode="year", warmup_days=90):
+        """
+        :param project: cmf project
+        :param outlets: nodes the water leaves the model through
+        :param spinup_begin: first day of the forcing (datetime)
+        :param begin: first day of the results (datetime)
+        :param runoff: mean observed runoff of the spin-up year in mm/day
+        :param mode: "year" or "equilibrium", overwritten by the environment
+        variable SPINUP
+        :param warmup_days: days before begin, on which an equilibrium run
+        starts
+        """
+        mode = os.environ.get("SPINUP", mode)
+        if mode not in MODES:
+            raise ValueError("Unknown spin-up mode {}, use one of {}".format(
+                mode, ", ".join(MODES)))
+        self.mode = mode
+        self.project = project
+        self.outlets = outlets
+        self.runoff = runoff
+        if mode == "year":
+            self.start = spinup_begin
+        else:
+            self.start = max(spinup_begin,
+                             begin - datetime.timedelta(days=warmup_days))
+
+    def restore(self, state, solver):
+        """
+        Sets the storages back to their initial volumes (and in mode
+        equilibrium the layers to their steady state) and the solver to the
+        start of the run.
+
+        :param state: StorageState with the initial volumes
+        :param solver: cmf integrator of the project
+        :return: None
+        """
+        state.restore()
+        if self.mode == "equilibrium":
+            set_equilibrium(self.project, self.outlets, self.runoff,
+                            self.start)
+        solver.set_t(self.start)
+        solver.reset()
@@ -3,35 +3,183 @@
 Created on Mon Nov 21 11:03:26 2016
 
 @author: Florian
+
+Goes through a csv file produced by Spotpy and writes the rows above
+thresholds to new csv files. The file is streamed (only one line per
+process is in memory), several output files with different thresholds are
+written in one pass and the simulation columns can be dropped. Large
+files are split into chunks, which are processed in parallel.
 """
-import csv
+import multiprocessing
+import os
+import shutil
+
+
+def read_header(in_name):
+    """
+    :param in_name: csv file of spotpy
+    :return: list with the column names, size of the header in bytes
+    """
+    with open(in_name, "rb") as csv_in:
+        header = csv_in.readline()
+    return header.rstrip(b"\r\n").decode().split(","), len(header)
+
+
+def chunk_bounds(in_name, start, chunks):
+    """
+    Splits a file into byte ranges, which begin at the start of a line.
+
+    :param in_name: file name
+    :param start: first byte of the first range
+    :param chunks: number of ranges
+    :return: list with the bounds of the ranges
+    """
+    size = os.path.getsize(in_name)
+    bounds = [start]
+    with open(in_name, "rb") as csv_in:
+        for chunk in range(1, chunks):
+            csv_in.seek(max(start + (size - start) * chunk // chunks,
+                            bounds[-1]))
+            # Go to the start of the next line
+            csv_in.readline()
+            bounds.append(min(csv_in.tell(), size))
+    bounds.append(size)
+    return bounds
+
+
+def drop_columns(line, before, after):
+    """
+    :param line: line of the csv file
+    :param before: number of columns kept at the start of the line
+    :param after: number of columns kept at the end of the line
+    :return: line without the columns in between
+    """
+    head = line.split(b",", before)
+    tail = head[-1].rstrip(b"\r\n").rsplit(b",", after)
+    return b",".join(head[:-1] + tail[1:]) + b"\n"
+
+
+def shrink_chunk(in_name, begin, end, filters, out_names, kept):
+    """
+    Writes the rows of a byte range of the csv file, which are above the
+    thresholds, to the output files (appended).
+
+    :param in_name: csv file of spotpy
+    :param begin: first byte of the range (start of a line)
+    :param end: first byte after the range
+    :param filters: list with a list of (column index, threshold) for every
+    output file
+    :param out_names: list with the names of the output files
+    :param kept: None keeps all columns, otherwise (number of columns
+    before the simulations, number of columns after them)
+    :return: list with the number of rows written to every output file
+    """
+    # Only the fields up to the last filtered column are converted
+    split = max(index for columns in filters for index, _ in columns) + 1
+    counts = [0] * len(out_names)
+    outputs = [open(name, "ab") for name in out_names]
+    try:
+        with open(in_name, "rb") as csv_in:
+            csv_in.seek(begin)
+            position = begin
+            for line in csv_in:
+                if position >= end:
+                    break
+                position += len(line)
+                values = line.split(b",", split)
+                row = None
+                for output, columns in enumerate(filters):
+                    try:
+                        passed = all(float(values[index]) > threshold
+                                     for index, threshold in columns)
+                    except ValueError:
+                        passed = False
+                    if not passed:
+                        continue
+                    if row is None:
+                        row = drop_columns(line, *kept) if kept else line
+                    outputs[output].write(row)
+                    counts[output] += 1
+    finally:
+        for output in outputs:
+            output.close()
+    return counts
+
+
+def shrink_chunk_star(arguments):
+    return shrink_chunk(*arguments)
+
+
+def shrink(in_name, outputs, drop_simulations=False, processes=1):
+    """
+    Writes the rows above the thresholds to the output files in one pass.
+
+    :param in_name: csv file of spotpy
+    :param outputs: dict with the name of every output file and a dict with
+    the thresholds of its like columns, e.g. {"short.csv": {"like1": 0.5},
+    "shorter.csv": {"like1": 0.6, "like2": 0.5}}. A row is written, if it
+    is above all thresholds of its file.
+    :param drop_simulations: True leaves out the simulation columns
+    :param processes: number of processes, which work on chunks of the file
+    :return: dict with the number of rows written to every output file
+    """
+    columns, header_size = read_header(in_name)
+    out_names = list(outputs)
+    filters = []
+    for name in out_names:
+        for column in outputs[name]:
+            if not column.startswith("like") or column not in columns:
+                raise ValueError("{} has no column {} to filter by".format(
+                    in_name, column))
+        filters.append([(columns.index(column), threshold)
+                        for column, threshold in outputs[name].items()])
+    kept = None
+    header = columns
+    simulations = [index for index, column in enumerate(columns)
+                   if column.startswith("simulation")]
+    if drop_simulations and simulations:
+        # Spotpy writes the simulations between the parameters and chain
+        kept = (simulations[0], len(columns) - simulations[-1] - 1)
+        header = columns[:kept[0]] + columns[simulations[-1] + 1:]
+    for name in out_names:
+        with open(name, "w", newline="") as csv_out:
+            csv_out.write(",".join(header) + "\n")
+
+    bounds = chunk_bounds(in_name, header_size, max(processes, 1))
+    if processes <= 1:
+        counts = shrink_chunk(in_name, bounds[0], bounds[1], filters,
+                              out_names, kept)
+        return dict(zip(out_names, counts))
+    # Every chunk is written to its own part files, which are appended to
+    # the output files in the order of the chunks
+    jobs = []
+    for chunk, (begin, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        part_names = ["{}.part{}".format(name, chunk) for name in out_names]
+        for part_name in part_names:
+            if os.path.exists(part_name):
+                os.remove(part_name)
+        jobs.append((in_name, begin, end, filters, part_names, kept))
+    with multiprocessing.Pool(processes) as pool:
+        chunk_counts = pool.map(shrink_chunk_star, jobs)
+    for output, name in enumerate(out_names):
+        with open(name, "ab") as csv_out:
+            for job in jobs:
+                part_name = job[4][output]
+                with open(part_name, "rb") as part:
+                    shutil.copyfileobj(part, csv_out)
+                os.remove(part_name)
+    return {name: sum(counts[output] for counts in chunk_counts)
+            for output, name in enumerate(out_names)}
+
+
 def spotpy_csv_shrinker(in_name, out_name, thresh_NS):
     """
     Goes through a csv file produced by Spotpy and creates
     a new csv file with all entries above eff_thresh
     """
-    # create an empy list to temp save the data
-    temp = []
-    # read through the file
-    with open(in_name, newline="") as csv_in:
-        reader = csv.reader(csv_in, delimiter = ",")
-        for row in reader:
-            # use try to avoid problems with "nan" and "efficieny"
-            try:
-                # only write those values to the file that are above thresh
-                if float(row[0]) > thresh_NS:
-                    temp.append(row)
-            except ValueError:
-                # Add the first row if it pops upp
-                if row[0] == "like1":
-                    temp.append(row)
-                    
-    # write the new csv file
-    with open(out_name, "w", newline="") as csv_out:
-        writer = csv.writer(csv_out, delimiter=",", quoting=csv.QUOTE_MINIMAL)
-        for row in temp:
-            writer.writerow(row)
-                    
-
-spotpy_csv_shrinker("complex_lumped_500_lhs.csv",
-                    "complex_lumped_500_lhs_short.csv", 0.0)
+    return shrink(in_name, {out_name: {"like1": thresh_NS}})[out_name]
+
+
+if __name__ == "__main__":
+    spotpy_csv_shrinker("complex_lumped_500_lhs.csv",
+                        "complex_lumped_500_lhs_short.csv", 0.0)
@@ -5,28 +5,20 @@ Created on Aug 04 11:08 2017
 @author(s): Florian U. Jehn
 """
 
-import pandas as pd
 import matplotlib.pyplot as plt
 
+from result_reader import read_results
+
+
 def read_data(filename):
     """
-    Reads in the data from a csv file.
+    Reads in the objective functions and parameters from a csv file
+    (without the simulations, see result_reader.py).
 
     :param filename:
     :return: pd.dataframe
     """
-    results = pd.read_csv(filename, delimiter=",")
-    objective_functions = 0
-    params = 0
-    for col_name in results.columns.values.tolist():
-        if "sim" in col_name:
-            break
-        if "like" in col_name:
-            objective_functions += 1
-        if "par" in col_name:
-            params += 1
-    results_no_sims = results.ix[:, 0:objective_functions + params]
-    return results_no_sims
+    return read_results(filename)
 
 
 def count_NS_over_thresh(results, threshold):
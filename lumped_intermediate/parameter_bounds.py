@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Checks the parameter sets of the sampler against the bounds of the
+parameters, before they reach set_parameters. Some algorithms (e.g. ROPE)
+create values outside of the declared bounds and those can make CVODE
+extremely stiff (see "hängen geblieben Läufe.txt", beta_soil_out = 0.02
+with a lower bound of 0.3). Values outside of the bounds are
+
+- clip: set to the nearest bound
+- reflect: mirrored at the bound they crossed
+- reject: not repaired, the whole parameter set is not run
+
+Values that are not finite are always rejected. The mode can be set for a
+whole job with the environment variable PARAMETER_BOUNDS.
+
+Spotpy writes the values of the sampler to the database, not the repaired
+ones, so with clip and reflect the database pairs objective functions with
+parameter values that were never run. The default is therefore reject, the
+rejected sets get a nan result and are not saved.
+"""
+import os
+
+import numpy as np
+
+
+MODES = ("reject", "clip", "reflect")
+
+
+class ParameterOutOfBounds(ValueError):
+    """
+    Raised for parameter sets that are rejected.
+    """
+    def __init__(self, names):
+        super().__init__("Parameters out of bounds: " + ", ".join(names))
+        self.names = names
+
+
+def declared_bounds(parameter):
+    """
+    Returns the bounds of a spotpy parameter. The minbound and maxbound of
+    spotpy are estimated from a random sample, so the bounds of uniform
+    parameters are taken from their distribution.
+
+    :param parameter: spotpy parameter
+    :return: lower bound, upper bound
+    """
+    if parameter.rndfunctype == "Uniform":
+        return parameter.rndargs
+    return parameter.minbound, parameter.maxbound
+
+
+class BoundsEnforcer:
+    """
+    Repairs or rejects parameter sets and counts the values outside of the
+    bounds for every parameter.
+    """
+    def __init__(self, params, mode="reject"):
+        """
+        :param params: list of spotpy parameters
+        :param mode: "reject", "clip" or "reflect", overwritten by the
+        environment variable PARAMETER_BOUNDS
+        """
+        mode = os.environ.get("PARAMETER_BOUNDS", mode)
+        if mode not in MODES:
+            raise ValueError("Unknown mode {} for the parameter bounds, use "
+                             "one of {}".format(mode, ", ".join(MODES)))
+        self.mode = mode
+        self.names = [parameter.name for parameter in params]
+        bounds = np.array([declared_bounds(parameter)
+                           for parameter in params], dtype=float)
+        self.lower = bounds[:, 0]
+        self.upper = bounds[:, 1]
+        # Values below and above the bounds for every parameter
+        self.below = dict.fromkeys(self.names, 0)
+        self.above = dict.fromkeys(self.names, 0)
+        # Number of checked, repaired and rejected parameter sets
+        self.checked = 0
+        self.repaired = 0
+        self.rejected = 0
+
+    def apply(self, vector):
+        """
+        Checks a parameter set and repairs it. The vector of the sampler is
+        not changed.
+
+        :param vector: parameter values in the order of the parameters
+        :return: np.array with the values to use for the run
+        """
+        values = np.array(vector, dtype=float)
+        self.checked += 1
+        below = values < self.lower
+        above = values > self.upper
+        invalid = ~np.isfinite(values)
+        if not (below.any() or above.any() or invalid.any()):
+            return values
+        for index in np.flatnonzero(below):
+            self.below[self.names[index]] += 1
+        for index in np.flatnonzero(above):
+            self.above[self.names[index]] += 1
+        if self.mode == "reject" or invalid.any():
+            self.rejected += 1
+            raise ParameterOutOfBounds([self.names[index] for index in
+                                        np.flatnonzero(below | above |
+                                                       invalid)])
+        self.repaired += 1
+        outside = below | above
+        if self.mode == "clip":
+            values[outside] = np.clip(values[outside], self.lower[outside],
+                                      self.upper[outside])
+        else:
+            values[outside] = self.reflect(values[outside],
+                                           self.lower[outside],
+                                           self.upper[outside])
+        return values
+
+    def apply_batch(self, matrix):
+        """
+        Checks and repairs many parameter sets at once, like apply for
+        every row of matrix.
+
+        :param matrix: parameter values, one parameter set per row
+        :return: np.array with the values to use for the runs, boolean
+        np.array which is False for the rejected sets
+        """
+        values = np.array(matrix, dtype=float, ndmin=2)
+        self.checked += len(values)
+        below = values < self.lower
+        above = values > self.upper
+        outside = below | above
+        for index, name in enumerate(self.names):
+            self.below[name] += int(below[:, index].sum())
+            self.above[name] += int(above[:, index].sum())
+        rejected = (~np.isfinite(values)).any(axis=1)
+        if self.mode == "reject":
+            rejected |= outside.any(axis=1)
+        self.rejected += int(rejected.sum())
+        # Only the values of the sets that are run are repaired
+        outside &= ~rejected[:, np.newaxis]
+        self.repaired += int(outside.any(axis=1).sum())
+        lower = np.broadcast_to(self.lower, values.shape)[outside]
+        upper = np.broadcast_to(self.upper, values.shape)[outside]
+        if self.mode == "clip":
+            values[outside] = np.clip(values[outside], lower, upper)
+        else:
+            values[outside] = self.reflect(values[outside], lower, upper)
+        return values, ~rejected
+
+    @staticmethod
+    def reflect(values, lower, upper):
+        """
+        Mirrors values at the bounds until they are inside of them.
+
+        :param values: np.array of values outside of the bounds
+        :param lower: np.array of the lower bounds
+        :param upper: np.array of the upper bounds
+        :return: np.array of values inside of the bounds
+        """
+        width = upper - lower
+        # A value is mirrored back and forth, so it repeats every 2 * width
+        position = np.mod(values - lower, 2 * width,
+                          out=np.zeros_like(values), where=width > 0)
+        return lower + np.where(position > width, 2 * width - position,
+                                position)
+
+    def summary(self):
+        """
+        Returns the counters as a text.
+
+        :return: str
+        """
+        lines = ["{} parameter sets checked ({}), {} repaired, {} rejected"
+                 .format(self.checked, self.mode, self.repaired,
+                         self.rejected)]
+        for name in self.names:
+            if self.below[name] or self.above[name]:
+                lines.append("  {}: {} below, {} above".format(
+                    name, self.below[name], self.above[name]))
+        return "\n".join(lines)
@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy engine for the lumped models. The lumped structures are small (snow,
+canopy, soil and groundwater of one cell), so instead of solving one
+parameter set after the other with CVODE, the engine integrates many
+parameter sets at once. Every storage holds one value per parameter set.
+
+The engine uses the same fluxes as cmf:
+
+- rainfall and snowfall split by the snow threshold
+- snow melt with the temperature index method (limited to snow / 10 min)
+- interception with the Rutter method and evaporation of the canopy
+- kinematic waves from the soil to the outlet and the groundwater, and
+  from the groundwater to the outlet
+- Hargreaves or Penman-Monteith transpiration from the soil, reduced by
+  the volume stress and the wet leaves
+
+The weather is taken from the cmf project once, at the end of every sub
+step. Every day is split into substeps, which are solved with the implicit
+Euler method. The storages drain in one direction (snow and canopy into the
+soil, soil into the groundwater), so the storages are solved one after the
+other. Snow, canopy and groundwater have a closed solution, the soil is
+solved with a safeguarded Newton iteration. The implicit method stays stable
+for short residence times, where an explicit method would need tiny steps.
+
+The daily discharge is the flux into the outlet at the end of every day,
+like outlet.waterbalance(t) of cmf. The results differ slightly from CVODE,
+more substeps bring them closer.
+
+The engine starts every run from the initial volumes of the project, so
+only the spin-up mode "year" is supported.
+
+Every call has a fixed cost, the Python loop over all sub steps, which
+hardly depends on the number of parameter sets. For the simple lumped model
+(1979-1989, 24 substeps) one call took about 19 s for 1 set, 24 s for 20
+sets and 32 s for 200 random sets, while CVODE takes about 2.7 s per set.
+The engine breaks even at about 8 sets per call (intermediate: about 31 s
+per call against 5.5 s per set, complex: about 33 s against 9.5 s, so both
+break even below 8 sets). The models use it only for batches of at least
+min_batch sets (simulation_batch, BatchRepeat), smaller batches and single
+sets, e.g. from MPI, are run with cmf. engine_comparison.py compares the
+engine with cmf.
+"""
+import os
+
+import numpy as np
+
+import cmf
+
+
+ENGINES = ("cmf", "numpy")
+ET_METHODS = ("hargreaves", "penman")
+
+
+def create_engine(engine, project, begin, end, spinup, et="hargreaves"):
+    """
+    Creates the engine of a lumped model.
+
+    :param engine: "cmf" or "numpy", overwritten by the environment variable
+    ENGINE
+    :param project: cmf project of the lumped model
+    :param begin: first day of the results (datetime)
+    :param end: last day of the results (datetime)
+    :param spinup: Spinup of the model
+    :param et: "hargreaves" or "penman", transpiration of the soil
+    :return: VectorEngine or None for cmf
+    """
+    engine = os.environ.get("ENGINE", engine)
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine {}, use one of {}".format(
+            engine, ", ".join(ENGINES)))
+    if engine == "cmf":
+        return None
+    return VectorEngine(project, begin, end, spinup, et)
+
+
+def net_radiation(weather, albedo, daily, t_ground=None):
+    """
+    Net radiation like cmf.Weather.Rn.
+
+    :param weather: dictionary of np.arrays with the weather
+    :param albedo: albedo of the vegetation
+    :param daily: True uses Tmax and Tmin for the long wave radiation
+    :param t_ground: temperature of the ground, None uses T
+    :return: np.array in MJ/(m² day)
+    """
+    if daily:
+        sigma_t = 4.903e-9 * ((weather["Tmax"] + 273.16) ** 4 +
+                              (weather["Tmin"] + 273.16) ** 4) / 2
+    else:
+        if t_ground is None:
+            t_ground = weather["T"]
+        sigma_t = 4.903e-9 * (t_ground + 273.16) ** 4
+    emissivity = 1.24 * (10. * weather["e_a"] /
+                         (weather["T"] + 273.16)) ** (1. / 7.)
+    clear_sky = 0.2 + 0.8 * weather["sunshine"]
+    return (1 - albedo) * weather["Rs"] + sigma_t * (emissivity - 1) * \
+        clear_sky
+
+
+def vapour_slope(temperature):
+    """
+    Slope of the vapour pressure curve (FAO 1998, Eq. 13)
+
+    :param temperature: np.array in °C
+    :return: np.array in kPa/°C
+    """
+    return 4098 * 0.6108 * np.exp(17.27 * temperature / (
+        temperature + 237.3)) / (temperature + 237.3) ** 2
+
+
+class Forcing:
+    """
+    Weather of the cmf project at the end of every sub step and the
+    potential evapotranspiration derived from it.
+    """
+    def __init__(self, cell, start, days, substeps, et="hargreaves",
+                 canopy=False):
+        """
+        :param cell: cmf cell of the lumped model
+        :param start: cmf.Time of the start of the run
+        :param days: number of simulated days
+        :param substeps: sub steps per day
+        :param et: "hargreaves" or "penman", transpiration of the soil
+        :param canopy: True calculates the evaporation of the canopy
+        """
+        if et not in ET_METHODS:
+            raise ValueError("Unknown ET method {}, use one of {}".format(
+                et, ", ".join(ET_METHODS)))
+        self.et = et
+        step = cmf.day / substeps
+        times = [start + step * (i + 1) for i in range(days * substeps)]
+        self.rain = np.array([cell.get_rainfall(t) for t in times])
+        names = ["T", "Tmax", "Tmin", "Ra", "Rs", "e_a", "e_s", "sunshine",
+                 "Windspeed", "instrument_height"]
+        values = np.array([[getattr(w, name) for name in names]
+                           for w in map(cell.get_weather, times)])
+        weather = dict(zip(names, values.T))
+        self.temperature = weather["T"]
+        vegetation = cell.vegetation
+        self.rootfraction = cell.layers[0].rootfraction
+        if et == "hargreaves":
+            # Reference crop ET in mm/day like cmf.HargreaveET, the
+            # transpiration is scaled with LAI / 2.88
+            td = np.abs(weather["Tmax"] - weather["Tmin"])
+            kt = 0.00185 * td ** 2 - 0.0433 * td + 0.4023
+            self.hargreaves = 0.0135 * kt * weather["Ra"] / 2.45 * \
+                np.sqrt(td) * (weather["T"] + 17.8)
+        else:
+            # Penman-Monteith of cmf.PenmanMonteithET without the surface
+            # resistance, which depends on the LAI
+            height = vegetation.Height
+            displacement = 0.666667 * height
+            z_om = 0.123 * height
+            z_oh = 0.1 * z_om
+            ra_u = np.log((height + weather["instrument_height"] -
+                           displacement) / z_om) * np.log(
+                (height + weather["instrument_height"] - displacement) /
+                z_oh) / 0.1681
+            # Resistances in day/m
+            self.ra = ra_u / np.maximum(weather["Windspeed"], 0.5) / 86400.
+            self.delta = vapour_slope(weather["T"])
+            self.rn = net_radiation(weather, vegetation.albedo, True)
+            self.deficit = weather["e_s"] - weather["e_a"]
+            self.stomatal_resistance = vegetation.StomatalResistance
+        self.canopy = None
+        if canopy:
+            # Evaporation of the canopy (Penman-Monteith with the height of
+            # the cell, which is 0 for the lumped models, so only the
+            # radiation term is left). Cells with snow cover have a ground
+            # temperature of at most 0 °C.
+            delta = vapour_slope(weather["T"])
+            gamma = 1.013e-3 * 101.3 / (0.622 * 2.45)
+            self.canopy = [np.maximum(
+                delta * net_radiation(weather, vegetation.albedo, False,
+                                      t_ground) / ((delta + gamma) * 2.45),
+                0.) for t_ground in (weather["T"],
+                                     np.minimum(weather["T"], 0.))]
+
+    def penman(self, step, lai):
+        """
+        Potential transpiration of the soil with Penman-Monteith.
+
+        :param step: index of the sub step
+        :param lai: np.array with the leaf area index of every set
+        :return: np.array in mm/day
+        """
+        rs = self.stomatal_resistance / (0.5 * lai) / 86400.
+        ra = self.ra[step]
+        delta = self.delta[step]
+        gamma = 0.067
+        nominator = delta + gamma * (1 + rs / ra)
+        rad_term = delta * self.rn[step] / (nominator * 2.45)
+        aero_term = 1.240e-3 / nominator * self.deficit[step] / ra
+        return np.maximum(rad_term + aero_term, 0.)
+
+
+class VectorEngine:
+    """
+    Runs the lumped model for many parameter sets at once.
+    """
+    def __init__(self, project, begin, end, spinup, et="hargreaves",
+                 substeps=24, min_batch=8):
+        """
+        :param project: cmf project of the lumped model with its initial
+        volumes
+        :param begin: first day of the results (datetime)
+        :param end: last day of the results (datetime)
+        :param spinup: Spinup of the model, gives the start of the runs
+        :param et: "hargreaves" or "penman", transpiration of the soil
+        :param substeps: implicit Euler steps per day
+        :param min_batch: smallest number of parameter sets the models run
+        with the engine, see the module docstring
+        """
+        if spinup.mode != "year":
+            raise ValueError("The NumPy engine supports only the spin-up "
+                             "mode year, not {}".format(spinup.mode))
+        cell = project[0]
+        self.cell = cell
+        self.spinup = spinup
+        self.substeps = substeps
+        self.min_batch = min_batch
+        self.dt = 1. / substeps
+        self.has_canopy = cell.canopy is not None
+        self.has_groundwater = cell.layer_count() > 1
+        start = cmf.AsCMFtime(spinup.start)
+        # Days before the first result
+        self.skip = (begin - spinup.start).days - 1
+        self.days = (end - spinup.start).days
+        self.forcing = Forcing(cell, start, self.days, substeps, et,
+                               self.has_canopy)
+        # Like in cmf the volumes are in m³, the fluxes per area in mm/day
+        # are converted with the area of the cell
+        self.mm = cell.area * 1e-3
+        self.initial = {"snow": cell.snow.volume,
+                        "canopy": (cell.canopy.volume
+                                   if self.has_canopy else 0.),
+                        "soil": cell.layers[0].volume,
+                        "gw": (cell.layers[1].volume
+                               if self.has_groundwater else 0.)}
+        self.capacity_per_lai = cell.vegetation.CanopyCapacityPerLAI
+        self.default_lai = cell.vegetation.LAI
+
+    def run(self, connections):
+        """
+        Runs the model for all parameter sets.
+
+        :param connections: dictionary with the parameters of the
+        connections, every value is a float or a np.array with one value per
+        parameter set (see engine_parameters of the models)
+        :return: np.array with the daily discharge in m³/day, one row per
+        parameter set
+        """
+        # Residence times of 0 give nan, like the failed runs of cmf
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.integrate(connections)
+
+    def integrate(self, connections):
+        """
+        Integrates all parameter sets from the start of the run till the
+        end.
+
+        :param connections: see run
+        :return: see run
+        """
+        size = max(np.size(value) for value in connections.values())
+
+        def get(name, default=None):
+            value = connections.get(name, default)
+            return np.array(np.broadcast_to(np.asarray(value, dtype=float),
+                                            (size,)))
+
+        # Kinematic waves q = (V / V0) ** beta / residencetime, written as
+        # q = k * V ** beta
+        drainage = [self.kinematic_wave(get("soil_out_tr"),
+                                        get("soil_out_V0"),
+                                        get("soil_out_beta"))]
+        if self.has_groundwater:
+            drainage.append(self.kinematic_wave(get("soil_gw_tr"),
+                                                get("soil_gw_V0"),
+                                                get("soil_gw_beta")))
+            gw_out_tr = get("gw_out_tr")
+        stress = (get("ET_V0"), get("ET_V1"))
+        meltrate = get("meltrate") * self.mm
+        threshold = get("snow_threshold")
+        lai = get("LAI", self.default_lai)
+        closure = get("CanopyClosure", 0.)
+        capacity = self.capacity_per_lai * lai * self.mm
+
+        forcing = self.forcing
+        dt = self.dt
+        mm = self.mm
+        snow = np.full(size, self.initial["snow"])
+        canopy = np.full(size, self.initial["canopy"])
+        soil = np.full(size, self.initial["soil"])
+        gw = np.full(size, self.initial["gw"])
+        # Wet leaves reduce the transpiration
+        dry_leaves = np.ones(size)
+        result = np.empty((size, self.days - self.skip))
+
+        if forcing.et == "hargreaves":
+            transpiration_factor = lai / 2.88 * forcing.rootfraction * mm
+
+        step = 0
+        for day in range(self.days):
+            for _ in range(self.substeps):
+                temperature = forcing.temperature[step]
+                rain = forcing.rain[step] * mm
+                # Snow fraction of the precipitation, 1 below threshold - 1
+                # and 0 above threshold + 1
+                liquid = rain * np.clip((temperature - threshold + 1) / 2,
+                                        0., 1.)
+                snowfall = rain - liquid
+
+                # Snow, melt = min(snow * 144, meltrate * (T - threshold))
+                potential_melt = meltrate * np.maximum(
+                    temperature - threshold, 0.)
+                new_snow = snow + dt * (snowfall - potential_melt)
+                new_snow = np.where(new_snow * 144 < potential_melt,
+                                    (snow + dt * snowfall) / (1 + 144 * dt),
+                                    new_snow)
+                # Melt, never negative because of rounding errors
+                inflow = np.maximum(snowfall - (new_snow - snow) / dt, 0.)
+                snow = new_snow
+
+                # Canopy
+                if self.has_canopy:
+                    # Snow cover above 50 % (2 mm of snow)
+                    potential_evaporation = np.where(
+                        snow > 2. * mm, forcing.canopy[1][step],
+                        forcing.canopy[0][step]) * mm
+                    canopy, drip = self.canopy_step(
+                        canopy, liquid * closure, potential_evaporation,
+                        capacity)
+                    inflow += liquid * (1 - closure) + drip
+                    dry_leaves = 1 - np.minimum(canopy / capacity, 1.)
+                else:
+                    inflow += liquid
+
+                # Transpiration without the volume stress
+                if forcing.et == "hargreaves":
+                    transpiration = forcing.hargreaves[step] * \
+                        transpiration_factor
+                else:
+                    transpiration = forcing.penman(step, lai) * \
+                        forcing.rootfraction * mm
+                transpiration *= dry_leaves
+
+                soil, percolation = self.soil_step(soil, inflow,
+                                                   transpiration, stress,
+                                                   drainage)
+                if self.has_groundwater:
+                    gw = (gw + dt * percolation) / (1 + dt / gw_out_tr)
+                step += 1
+
+            if day >= self.skip:
+                k, beta = drainage[0]
+                discharge = k * soil ** beta
+                if self.has_groundwater:
+                    discharge += gw / gw_out_tr
+                result[:, day - self.skip] = discharge
+        return result
+
+    def canopy_step(self, canopy, intercepted, evaporation, capacity):
+        """
+        One implicit Euler step of the canopy. The drip is
+        intercepted * min(C / Cmax, 2) and the evaporation
+        evaporation * min(C / Cmax, 1), so the canopy can be solved for
+        each of the three parts and the part which fits is taken.
+
+        :param canopy: np.array with the canopy storage in m³
+        :param intercepted: np.array with the intercepted rain in m³/day
+        :param evaporation: potential evaporation of the canopy in m³/day
+        :param capacity: np.array with the capacity of the canopy in m³
+        :return: new canopy storage, drip in m³/day
+        """
+        dt = self.dt
+        full = canopy + dt * intercepted
+        # Below the capacity
+        new = full / (1 + dt * (intercepted + evaporation) / capacity)
+        # Between one and two times the capacity
+        above = (full - dt * evaporation) / (1 + dt * intercepted / capacity)
+        new = np.where(new > capacity, above, new)
+        # Above two times the capacity
+        overflow = full - dt * (2 * intercepted + evaporation)
+        new = np.where(new > 2 * capacity, overflow, new)
+        new = np.maximum(new, 0.)
+        drip = intercepted * np.minimum(new / capacity, 2.)
+        return new, drip
+
+    @staticmethod
+    def kinematic_wave(residencetime, v0, beta):
+        """
+        Coefficients of a cmf.kinematic_wave, the flux is k * V ** beta.
+
+        :param residencetime: np.array with the residence time in days
+        :param v0: np.array with the reference volume in m³
+        :param beta: np.array with the exponent
+        :return: k, beta
+        """
+        return 1 / (residencetime * v0 ** beta), beta
+
+    def soil_step(self, soil, inflow, transpiration, stress, drainage,
+                  iterations=50, tolerance=1e-10):
+        """
+        One implicit Euler step of the soil, the new volume V is the root of
+        V - soil - dt * (inflow - outflow(V)), which is found with Newton's
+        method. The outflow grows with V, so the root lies between 0 and
+        soil + dt * inflow and steps which leave this interval are replaced
+        by bisection.
+
+        :param soil: np.array with the soil storage in m³
+        :param inflow: np.array with the inflow in m³/day
+        :param transpiration: transpiration without the stress in m³/day
+        :param stress: volumes without and with full transpiration
+        :param drainage: coefficients of the kinematic waves to the outlet
+        and to the groundwater
+        :return: new soil storage, percolation in m³/day
+        """
+        dt = self.dt
+        wilting, no_stress = stress
+        width = np.maximum(no_stress - wilting, 1e-12)
+        # The loop runs for every sub step, so everything which does not
+        # depend on V is calculated before it
+        target = soil + dt * inflow
+        stress_slope = transpiration / width
+        tolerance = tolerance * (1 + soil)
+        lower = np.zeros_like(soil)
+        upper = np.maximum(target, 0.)
+        volume = np.minimum(soil, upper)
+        for _ in range(iterations):
+            relative = np.minimum(np.maximum((volume - wilting) / width, 0.),
+                                  1.)
+            outflow = transpiration * relative
+            slope = np.where((relative > 0) & (relative < 1), stress_slope,
+                             0.)
+            for k, beta in drainage:
+                flux = k * volume ** beta
+                outflow += flux
+                # The flux is 0 for V = 0
+                slope += beta * flux / np.maximum(volume, 1e-300)
+            error = volume - target + dt * outflow
+            converged = np.abs(error) <= tolerance
+            if converged.all():
+                break
+            lower = np.where(error < 0, volume, lower)
+            upper = np.where(error > 0, volume, upper)
+            newton = volume - error / (1 + dt * slope)
+            # Converged sets keep their volume, otherwise a Newton step
+            # which rounds to the bound is replaced by bisection and throws
+            # them away from the root while the other sets converge
+            volume = np.where(converged, volume, np.where(
+                (newton > lower) & (newton < upper), newton,
+                (lower + upper) / 2))
+        percolation = 0.
+        if len(drainage) > 1:
+            k, beta = drainage[1]
+            percolation = k * volume ** beta
+        return volume, percolation
+
+
+class BatchRepeat:
+    """
+    Replaces the repeat of a spotpy sampler (spotpy.parallel.sequential),
+    so the model gets all parameter sets of a ROPE subset in batches instead
+    of one after the other.
+    """
+    def __init__(self, model, batch_size=1000):
+        """
+        :param model: lumped model with the NumPy engine
+        :param batch_size: maximal number of parameter sets per call
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.phase = None
+
+    def is_idle(self):
+        return True
+
+    def terminate(self):
+        pass
+
+    def setphase(self, phasename):
+        self.phase = phasename
+
+    def start(self):
+        pass
+
+    def __call__(self, jobs):
+        """
+        :param jobs: iterable of (run id, parameter set)
+        :return: generator of (run id, parameter set, simulation)
+        """
+        jobs = iter(jobs)
+        while True:
+            batch = [job for _, job in zip(range(self.batch_size), jobs)]
+            if not batch:
+                return
+            simulations = self.model.simulation_batch(
+                np.array([params for _, params in batch], dtype=float))
+            for (run_id, params), simulation in zip(batch, simulations):
+                yield run_id, params, simulation
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Stops runs early that can not reach the save threshold of the sampler
+anymore. Spotpy only saves runs, whose objective function is above the
+threshold in every period, but every run is simulated until the end,
+although most of them are far below the threshold after a few months.
+
+During a run the sums of the simulated values of the current period are
+updated every day. From them two values are derived:
+
+- an exact bound, which the objective function can not exceed anymore. For
+  the NSE the squared errors only grow. For the KGE the simulated volume
+  (beta) and the variability (alpha) can only grow, so a run which already
+  simulated too much water can not reach the threshold.
+- an estimate, which assumes the rest of the period is simulated without
+  any error. For the NSE this is the exact bound. For the KGE it is not a
+  strict bound, so it is only used with a margin.
+
+A run stops as soon as the exact bound is below the threshold, or the
+estimate plus the margin is. The rest of the simulation stays nan, so the
+validation period of a run stopped in the calibration is not simulated.
+Nobody knows the objective function of a stopped run, so score gives it
+-inf in every period. The run is not saved and ROPE ranks it below every
+finished run, it never picks the parameters of the next subset.
+
+The early stop is off by default. It is switched on for a whole job with
+the environment variable EARLY_STOP (the threshold, e.g. "0.0" or
+"0.0,0.0" for one value per period), EARLY_STOP_MARGIN sets the margin.
+"""
+import math
+import os
+
+import numpy as np
+
+
+OBJECTIVES = ("kge", "nse")
+
+
+def from_environ(name, default):
+    """
+    Returns the value of the environment variable name or default.
+
+    :param name: name of the environment variable
+    :param default: value if the variable is not set
+    :return: value as float, list of floats or None
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if value.lower() in ("", "none"):
+        return None
+    values = [float(part) for part in value.split(",")]
+    return values if len(values) > 1 else values[0]
+
+
+class PeriodBound:
+    """
+    Sums of the simulated values of one period of a run.
+    """
+    def __init__(self, period):
+        """
+        :param period: ObservedPeriod of evaluation_data
+        """
+        self.period = period
+        observed = period.observed
+        # Sums of the observed values from day k till the end of the period
+        self.rest = np.append(observed[::-1].cumsum()[::-1], 0.)
+        self.rest_squares = np.append((observed ** 2)[::-1].cumsum()[::-1],
+                                      0.)
+        self.start()
+
+    def start(self):
+        """
+        Sets the sums back for a new run.
+
+        :return: None
+        """
+        self.days = 0
+        self.sum = 0.
+        self.squares = 0.
+        self.products = 0.
+
+    def add(self, value):
+        """
+        Adds the simulated value of the next day.
+
+        :param value: simulated value in the unit of the observed one
+        :return: None
+        """
+        self.sum += value
+        self.squares += value * value
+        self.products += value * self.period.observed[self.days]
+        self.days += 1
+
+    def estimate(self, name):
+        """
+        Objective function of the period, if the rest of it is simulated
+        without errors.
+
+        :param name: "kge" or "nse"
+        :return: float
+        """
+        period = self.period
+        n = period.size
+        sim_sum = self.sum + self.rest[self.days]
+        squares = self.squares + self.rest_squares[self.days]
+        products = self.products + self.rest_squares[self.days]
+        if name == "nse":
+            errors = squares - 2 * products + self.rest_squares[0]
+            return 1 - errors / period.sum_squares
+        sim_sum_squares = max(squares - sim_sum * sim_sum / n, 0.)
+        if sim_sum_squares == 0:
+            return -math.inf
+        cc = (products - sim_sum * period.sum / n) / math.sqrt(
+            period.sum_squares * sim_sum_squares)
+        alpha = math.sqrt(sim_sum_squares / n) / period.std
+        beta = sim_sum / period.sum
+        return 1 - math.sqrt((cc - 1) ** 2 + (alpha - 1) ** 2 +
+                             (beta - 1) ** 2)
+
+    def bound(self, name):
+        """
+        Upper bound of the objective function of the period.
+
+        :param name: "kge" or "nse"
+        :return: float
+        """
+        if name == "nse":
+            return self.estimate(name)
+        period = self.period
+        # The discharge is never negative, so the simulated sum and the
+        # squared anomalies of the whole period are at least those so far
+        beta = self.sum / period.sum
+        alpha = 0.
+        if self.days:
+            sim_sum_squares = max(
+                self.squares - self.sum * self.sum / self.days, 0.)
+            alpha = math.sqrt(sim_sum_squares / period.size) / period.std
+        return 1 - math.hypot(max(alpha - 1, 0.), max(beta - 1, 0.))
+
+
+class EarlyStop:
+    """
+    Decides after every simulated day, if a run can still reach the
+    threshold.
+    """
+    def __init__(self, evaluation_data, threshold=None, margin=None,
+                 objective="kge", scale=1.):
+        """
+        :param evaluation_data: EvaluationData of the model
+        :param threshold: save threshold of the sampler, one value for all
+        periods or a list with one value per period. None switches the early
+        stop off. Overwritten by the environment variable EARLY_STOP
+        :param margin: runs whose estimate plus margin (>= 0) is below the
+        threshold are stopped, None uses only the exact bounds. Overwritten
+        by the environment variable EARLY_STOP_MARGIN
+        :param objective: "kge" or "nse", the objective function of the
+        model
+        :param scale: factor from the simulated values of the run to the unit
+        of the observed values
+        """
+        if objective not in OBJECTIVES:
+            raise ValueError("Unknown objective function {}, use one of {}"
+                             .format(objective, ", ".join(OBJECTIVES)))
+        threshold = from_environ("EARLY_STOP", threshold)
+        if threshold is not None and np.ndim(threshold) == 0:
+            threshold = [threshold] * len(evaluation_data.periods)
+        self.threshold = threshold
+        margin = from_environ("EARLY_STOP_MARGIN", margin)
+        if margin is not None and margin < 0:
+            raise ValueError("The margin of the early stop can not be "
+                             "negative")
+        self.margin = margin
+        self.objective = objective
+        self.scale = scale
+        self.evaluation_data = evaluation_data
+        self.periods = [PeriodBound(period)
+                        for period in evaluation_data.periods]
+        self.ends = [part.stop or len(evaluation_data.observed)
+                     for part in evaluation_data.slices]
+        # Number of stopped runs and days not simulated because of them
+        self.stopped = 0
+        self.skipped_days = 0
+        self.start()
+
+    @property
+    def active(self):
+        """
+        :return: True if runs are stopped early
+        """
+        return self.threshold is not None
+
+    def start(self):
+        """
+        Sets the sums back for a new run.
+
+        :return: None
+        """
+        self.day = 0
+        self.index = 0
+        for period in self.periods:
+            period.start()
+
+    def hopeless(self, period, threshold):
+        """
+        :param period: PeriodBound of the current period
+        :param threshold: threshold of the period
+        :return: True if the period can not reach the threshold anymore
+        """
+        if period.bound(self.objective) < threshold:
+            return True
+        return (self.margin is not None and
+                period.estimate(self.objective) + self.margin < threshold)
+
+    def add(self, value):
+        """
+        Adds the simulated value of the next day.
+
+        :param value: simulated value of the run
+        :return: False if the run should be stopped
+        """
+        if not self.active:
+            return True
+        if self.day == self.ends[self.index]:
+            self.index += 1
+        period = self.periods[self.index]
+        period.add(value * self.scale)
+        self.day += 1
+        if not self.hopeless(period, self.threshold[self.index]):
+            return True
+        self.stopped += 1
+        self.skipped_days += len(self.evaluation_data.observed) - self.day
+        return False
+
+    def stopped_early(self, simulation):
+        """
+        :param simulation: simulated series handed to the objective function
+        :return: True if the simulation is from a stopped run
+        """
+        return (self.active and
+                len(simulation) == len(self.evaluation_data.observed) and
+                np.isnan(simulation[-1]) and not np.isnan(simulation[0]))
+
+    def score(self, simulation):
+        """
+        Objective function of a stopped run. The run was not simulated until
+        the end, so it gets -inf in every period instead of a value nobody
+        measured.
+
+        :param simulation: simulated series of a stopped run
+        :return: list with one value per period
+        """
+        return [-np.inf] * len(self.evaluation_data.periods)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Observed discharge prepared once for the objective functions. The series,
+the calibration and validation slices and the observed statistics are
+computed when the model is created, so a model run only has to reduce the
+simulation.
+"""
+import numpy as np
+
+
+# 1980 till 1984 are used for calibration, 1827 = 2 * 366 + 3 * 365
+CALIBRATION_DAYS = 1827
+
+
+def read_only(array):
+    """
+    Returns a contiguous float64 copy of array, which can not be changed.
+    """
+    array = np.array(array, dtype=np.float64)
+    array.flags.writeable = False
+    return array
+
+
+class ObservedPeriod:
+    """
+    Observed values of one period and their statistics.
+    """
+    def __init__(self, observed):
+        self.observed = observed
+        self.size = len(observed)
+        self.mean = observed.mean()
+        self.std = observed.std()
+        self.sum = observed.sum()
+        self.anomaly = read_only(observed - self.mean)
+        # Sum of the squared anomalies (denominator of the NSE)
+        self.sum_squares = np.dot(self.anomaly, self.anomaly)
+
+    def kge(self, simulation):
+        """
+        Kling-Gupta efficiency, gives the same values as
+        spotpy.objectivefunctions.kge.
+
+        :param simulation: np.array with the simulated values of the period
+        :return: float
+        """
+        sim_mean = simulation.mean()
+        sim_anomaly = simulation - sim_mean
+        sim_sum_squares = np.dot(sim_anomaly, sim_anomaly)
+        cc = np.dot(self.anomaly, sim_anomaly) / np.sqrt(
+            self.sum_squares * sim_sum_squares)
+        alpha = np.sqrt(sim_sum_squares / self.size) / self.std
+        beta = sim_mean * self.size / self.sum
+        return 1 - np.sqrt((cc - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2)
+
+    def nse(self, simulation):
+        """
+        Nash-Sutcliffe efficiency
+
+        :param simulation: np.array with the simulated values of the period
+        :return: float
+        """
+        error = self.observed - simulation
+        return 1 - np.dot(error, error) / self.sum_squares
+
+    def kge_batch(self, simulations):
+        """
+        Kling-Gupta efficiency of many simulations at once.
+
+        :param simulations: np.array with one simulation of the period per
+        row
+        :return: np.array with one value per row
+        """
+        sim_mean = simulations.mean(axis=1)
+        sim_anomaly = simulations - sim_mean[:, np.newaxis]
+        sim_sum_squares = np.einsum("ij,ij->i", sim_anomaly, sim_anomaly)
+        cc = np.dot(sim_anomaly, self.anomaly) / np.sqrt(
+            self.sum_squares * sim_sum_squares)
+        alpha = np.sqrt(sim_sum_squares / self.size) / self.std
+        beta = sim_mean * self.size / self.sum
+        return 1 - np.sqrt((cc - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2)
+
+    def nse_batch(self, simulations):
+        """
+        Nash-Sutcliffe efficiency of many simulations at once.
+
+        :param simulations: np.array with one simulation of the period per
+        row
+        :return: np.array with one value per row
+        """
+        error = self.observed - simulations
+        return 1 - np.einsum("ij,ij->i", error, error) / self.sum_squares
+
+
+class EvaluationData:
+    """
+    Read only observed series split into a calibration and a validation
+    period.
+    """
+    def __init__(self, observed, calibration_days=CALIBRATION_DAYS):
+        """
+        :param observed: observed values (cmf.timeseries or array)
+        :param calibration_days: length of the calibration period, None
+        uses the whole series for one period
+        """
+        self.observed = read_only(observed)
+        if calibration_days is None:
+            self.slices = [slice(None)]
+        else:
+            self.slices = [slice(None, calibration_days),
+                           slice(calibration_days, None)]
+        self.calibration = self.slices[0]
+        self.validation = self.slices[-1]
+        self.periods = [ObservedPeriod(self.observed[part])
+                        for part in self.slices]
+
+    def score(self, simulation, name):
+        """
+        Calculates an objective function for every period. Like spotpy, nan
+        is returned if the simulation has the wrong length.
+
+        :param simulation: simulated series, same length as the observed one
+        :param name: "kge" or "nse"
+        :return: list with one value per period
+        """
+        simulation = np.asarray(simulation, dtype=np.float64)
+        if len(simulation) != len(self.observed):
+            return [np.nan] * len(self.periods)
+        return [getattr(period, name)(simulation[part])
+                for period, part in zip(self.periods, self.slices)]
+
+    def score_batch(self, simulations, name):
+        """
+        Calculates an objective function for every period of many
+        simulations at once. Like in score, simulations with the wrong
+        length give nan.
+
+        :param simulations: np.array with one simulated series per row
+        :param name: "kge" or "nse"
+        :return: np.array with one row per simulation and one column per
+        period
+        """
+        simulations = np.array(simulations, dtype=np.float64, ndmin=2)
+        result = np.full((len(simulations), len(self.periods)), np.nan)
+        if simulations.shape[1] != len(self.observed):
+            return result
+        for index, (period, part) in enumerate(zip(self.periods,
+                                                   self.slices)):
+            result[:, index] = getattr(period, name + "_batch")(
+                simulations[:, part])
+        return result
+
+    def kge(self, simulation):
+        """
+        :param simulation: simulated series, same length as the observed one
+        :return: list with the KGE of every period
+        """
+        return self.score(simulation, "kge")
+
+    def nse(self, simulation):
+        """
+        :param simulation: simulated series, same length as the observed one
+        :return: list with the NSE of every period
+        """
+        return self.score(simulation, "nse")
+
+    def nan_result(self):
+        """
+        Result for a failed run.
+
+        :return: np.array with nan and the length of the observed series
+        """
+        return np.full(len(self.observed), np.nan)
+
+    def for_evaluation(self, evaluation):
+        """
+        Returns self, if evaluation is the observed series of this object
+        (which is what spotpy hands to objectivefunction). Otherwise the
+        statistics are computed for evaluation.
+
+        :param evaluation: evaluation handed over by spotpy
+        :return: EvaluationData
+        """
+        if evaluation is self.observed:
+            return self
+        split = None if len(self.slices) == 1 else self.slices[0].stop
+        return EvaluationData(evaluation, split)
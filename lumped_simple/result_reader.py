@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Reads the objective functions and parameters of a spotpy csv file without
+the simulations. Only the header is parsed completely. The like* and par*
+columns are read in chunks as float64, the simulation columns are cut off
+the lines before pandas sees them (spotpy writes them after the
+parameters), so a file with 100000 runs and ten years of simulated days
+fits in memory.
+
+The pruned table is cached next to the csv file (<file>.pruned.npz) with
+the size and modification time of the csv file. Later reads load the cache,
+as long as the csv file has not changed.
+"""
+import io
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def read_header(filename):
+    """
+    :param filename: csv file of spotpy
+    :return: list with the column names
+    """
+    with open(filename, "rb") as csv_file:
+        return csv_file.readline().rstrip(b"\r\n").decode().split(",")
+
+
+def pruned_columns(columns):
+    """
+    :param columns: column names of a spotpy csv file
+    :return: list with the like and par columns
+    """
+    return [column for column in columns
+            if column.startswith("like") or column.startswith("par")]
+
+
+def cache_name(filename):
+    """
+    :return: file name of the cache of a csv file
+    """
+    return filename + ".pruned.npz"
+
+
+def source_stamp(filename):
+    """
+    :return: np.array with the size and modification time of a file
+    """
+    stat = os.stat(filename)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def read_cache(filename):
+    """
+    :param filename: csv file of spotpy
+    :return: pd.DataFrame from the cache, None if there is no valid cache
+    """
+    try:
+        with np.load(cache_name(filename)) as cache:
+            if not np.array_equal(cache["source"], source_stamp(filename)):
+                return None
+            return pd.DataFrame(cache["values"],
+                                columns=list(cache["columns"]))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def write_cache(filename, results):
+    """
+    Writes the pruned table of a csv file to its cache. Written to another
+    file first, so a kill while writing does not leave a broken cache.
+
+    :param filename: csv file of spotpy
+    :param results: pd.DataFrame with the pruned table
+    :return: None
+    """
+    name = cache_name(filename)
+    try:
+        with open(name + ".tmp", "wb") as cache:
+            np.savez(cache, values=results.to_numpy(dtype=np.float64),
+                     columns=np.array(results.columns, dtype=str),
+                     source=source_stamp(filename))
+        os.replace(name + ".tmp", name)
+    except OSError:
+        # The cache is only an aid, e.g. the folder can be read only
+        pass
+
+
+def read_prefix(filename, columns, chunksize):
+    """
+    Reads the first len(columns) columns of a csv file. The rest of every
+    line is cut off before it is parsed.
+
+    :param filename: csv file of spotpy
+    :param columns: names of the first columns
+    :param chunksize: number of lines parsed at once
+    :return: pd.DataFrame
+    """
+    kept = len(columns)
+    chunks = []
+    with open(filename, "rb") as csv_file:
+        csv_file.readline()
+        while True:
+            lines = list(itertools.islice(csv_file, chunksize))
+            if not lines:
+                break
+            pruned = b"\n".join(b",".join(line.split(b",", kept)[:kept])
+                                for line in lines)
+            chunks.append(pd.read_csv(
+                io.BytesIO(pruned), header=None, names=columns,
+                dtype={column: np.float64 for column in columns}))
+    if not chunks:
+        return pd.DataFrame(columns=columns, dtype=np.float64)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_results(filename, chunksize=10000, cache=True):
+    """
+    Reads the like and par columns of a spotpy csv file.
+
+    :param filename: csv file of spotpy
+    :param chunksize: number of lines parsed at once
+    :param cache: True uses and writes the cache of the file
+    :return: pd.DataFrame with the like and par columns
+    """
+    if cache:
+        results = read_cache(filename)
+        if results is not None:
+            return results
+    header = read_header(filename)
+    columns = pruned_columns(header)
+    if header[:len(columns)] == columns:
+        results = read_prefix(filename, columns, chunksize)
+    else:
+        results = pd.concat(pd.read_csv(
+            filename, usecols=columns, chunksize=chunksize,
+            dtype={column: np.float64 for column in columns}),
+            ignore_index=True)[columns]
+    if cache:
+        write_cache(filename, results)
+    return results
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""
+ROPE of spotpy, which can be continued after the job was killed. The
+sampler writes a checkpoint (dbname.checkpoint) every backup_every_rep
+runs and at the end of every subset. It holds
+
+- the subset and its parameter sets (drawn from the behavioural set of the
+  subset before)
+- the finished runs of the subset and their objective functions
+- the states of the random number generators of python and NumPy
+- the progress of the sampler and the size of the csv file (or the
+  position of the simulation store of the model, see simulation_store.py)
+
+When the job gets SIGUSR1, SIGUSR2 (sent by SGE before it suspends or kills
+a job submitted with -notify) or SIGTERM, the sampler flushes the csv file,
+writes a checkpoint and stops. sample(..., resume=True) cuts the csv file
+to the size of the checkpoint (runs saved after it are run again) and
+continues with the runs that were not finished.
+"""
+import os
+import pickle
+import random
+import signal
+import time
+
+import numpy as np
+from spotpy.algorithms import rope
+
+
+# Signals, which make the sampler write a checkpoint and stop
+STOP_SIGNALS = [signal.SIGUSR1, signal.SIGUSR2, signal.SIGTERM]
+
+
+def best_runs(likes, pars, percentage):
+    """
+    Returns the best runs like rope.get_best_runs, but ranks the runs by
+    their objective function only. spotpy sorts the pairs of like and
+    parameter set, so tied likes (e.g. the -inf of runs stopped early)
+    compare the np.arrays of the parameter sets, which raises a ValueError.
+    Runs with nan or -inf are ranked below all other runs, tied runs keep
+    their order.
+
+    >>> pars = [np.array([0., 1.]), np.array([1., 1.]), np.array([2., 1.]),
+    ...         np.array([3., 1.])]
+    >>> best = best_runs([-np.inf, 0.5, 0.2, np.nan], pars, 0.5)
+    >>> [float(par[0]) for par in best]
+    [2.0, 1.0]
+    >>> len(best_runs([-np.inf] * 4, pars, 0.5))
+    2
+
+    :param likes: objective function of every run
+    :param pars: parameter set of every run
+    :param percentage: fraction of the runs, which is returned
+    :return: list with the parameter sets of the best runs, the best one is
+    the last
+    """
+    likes = np.array([np.ravel(like)[0] for like in likes], dtype=float)
+    likes[np.isnan(likes)] = -np.inf
+    order = np.argsort(likes, kind="stable")
+    return [pars[index] for index in order[int(len(likes) *
+                                               (1 - percentage)):]]
+
+
+class ResumableRope(rope):
+    """
+    ROPE with checkpoints, see the module docstring.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkpoint_name = self.dbname + ".checkpoint"
+        # Signal, which stops the sampling (None as long as none came in)
+        self.stop_signal = None
+        # False if the last sampling was stopped by a signal
+        self.finished = False
+
+    def sample(self, repetitions=None, repetitions_first_run=None,
+               subsets=5, percentage_first_run=0.10,
+               percentage_following_runs=0.10, NDIR=None, resume=False):
+        """
+        Samples like spotpy.algorithms.rope.sample.
+
+        :param resume: True continues the sampling of the checkpoint, whose
+        settings are used instead of the other arguments
+        :return: None
+        """
+        # Installed before the workers of MPI start, so they are not killed
+        # by the signals either
+        handlers = {signum: signal.signal(signum, self.handle_signal)
+                    for signum in STOP_SIGNALS}
+        try:
+            if resume:
+                state = self.read_checkpoint()
+                repetitions = state["plan"]["repetitions"]
+            else:
+                state = None
+            print("Starting the ROPE algorithm with " + str(repetitions) +
+                  " repetitions...")
+            self.set_repetiton(repetitions)
+            # Spotpy draws random values here, so before the random number
+            # generators are restored
+            parset = self.parameter()
+            self.min_bound = parset["minbound"]
+            self.max_bound = parset["maxbound"]
+            if state is None:
+                state = self.first_subset(
+                    repetitions, repetitions_first_run, subsets,
+                    percentage_first_run, percentage_following_runs, NDIR)
+            else:
+                self.restore(state)
+            self.NDIR = state["plan"]["NDIR"]
+            self.finished = self.run_subsets(state)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        self.final_call()
+        if self.finished and os.path.exists(self.checkpoint_name):
+            os.remove(self.checkpoint_name)
+
+    def first_subset(self, repetitions, repetitions_first_run, subsets,
+                     percentage_first_run, percentage_following_runs, NDIR):
+        """
+        Creates the plan of the sampling and the latin hypercube of the first
+        subset (like rope.sample).
+
+        :return: dict with the state of the sampling
+        """
+        if repetitions_first_run is None:
+            # Take the first half of the repetitions as burn-in
+            first_run = int(repetitions / 2.0)
+        else:
+            first_run = repetitions_first_run
+        following_runs = int((repetitions - first_run) / (subsets - 1))
+        # Needed to avoid an error in integer division in the depth function
+        if following_runs % 2 != 0:
+            print("Warning: Burn-in samples and total number of repetions "
+                  "are not compatible.\nSPOTPY will automatically adjust the "
+                  "number of total repetitions.")
+            following_runs += 1
+        if NDIR is None:
+            NDIR = int(following_runs / 100.0)
+        plan = dict(repetitions=repetitions, first_run=first_run,
+                    following_runs=following_runs, subsets=subsets,
+                    percentage_first_run=percentage_first_run,
+                    percentage_following_runs=percentage_following_runs,
+                    NDIR=NDIR)
+
+        min_bound, max_bound = self.min_bound, self.max_bound
+        segment = 1.0 / float(first_run)
+        # Latin hypercube as in McKay et al. (1979)
+        matrix = np.empty((first_run, len(min_bound)))
+        for i in range(int(first_run)):
+            point_in_segment = i * segment + random.random() * segment
+            matrix[i] = point_in_segment * (max_bound - min_bound) + min_bound
+        for i in range(len(min_bound)):
+            random.shuffle(matrix[:, i])
+        # Like spotpy, the last set of the hypercube is not run
+        return self.new_subset(plan, 0, matrix[:int(first_run) - 1], 0)
+
+    @staticmethod
+    def new_subset(plan, subset, matrix, offset):
+        """
+        :param plan: settings of the sampling
+        :param subset: number of the subset, 0 is the latin hypercube
+        :param matrix: parameter sets of the subset
+        :param offset: run id of the first parameter set
+        :return: dict with the state of the sampling
+        """
+        return dict(plan=plan, subset=subset, matrix=matrix, offset=offset,
+                    done=[], likes=[], pars=[])
+
+    def next_subset(self, state):
+        """
+        Draws the parameter sets of the next subset from the best runs of
+        the current one (like rope.sample).
+
+        :param state: state of the finished subset
+        :return: state of the next subset
+        """
+        plan = state["plan"]
+        following_runs = plan["following_runs"]
+        if state["subset"] == 0:
+            percentage = plan["percentage_first_run"]
+        else:
+            percentage = plan["percentage_following_runs"]
+        best_pars = self.get_best_runs(state["likes"], state["pars"],
+                                       following_runs, percentage)
+        valid = False
+        trials = 0
+        new_pars = []
+        while valid is False and trials < 10 and following_runs > 1:
+            new_pars = self.programm_depth(best_pars, following_runs)
+            if len(new_pars) == following_runs:
+                valid = True
+            else:
+                trials += 1
+        runs = min(following_runs, len(new_pars))
+        offset = plan["first_run"] + following_runs * state["subset"]
+        return self.new_subset(plan, state["subset"] + 1,
+                               np.array(new_pars)[:runs], offset)
+
+    def run_subsets(self, state):
+        """
+        Runs the rest of the current subset and all following ones.
+
+        :param state: state of the sampling
+        :return: True if the sampling is finished, False if it was stopped
+        by a signal
+        """
+        plan = state["plan"]
+        intervaltime = time.time()
+        while True:
+            done = set(state["done"])
+            param_generator = ((rep, state["matrix"][rep])
+                               for rep in range(len(state["matrix"]))
+                               if rep not in done)
+            since_checkpoint = 0
+            for rep, pars, simulations in self.repeat(param_generator):
+                like = self.postprocessing(state["offset"] + rep, pars,
+                                           simulations)
+                state["done"].append(rep)
+                state["likes"].append(like)
+                state["pars"].append(pars)
+                since_checkpoint += 1
+                if self.stop_signal is not None:
+                    self.write_checkpoint(state)
+                    print("Signal {} received, checkpoint written to {}"
+                          .format(self.stop_signal, self.checkpoint_name))
+                    return False
+                if since_checkpoint >= self.backup_every_rep:
+                    self.write_checkpoint(state)
+                    since_checkpoint = 0
+                if self.status.stop:
+                    break
+                # Progress bar, refreshed every two seconds
+                if time.time() - intervaltime >= 2:
+                    print("%i Subset: Run %i of %i (best like=%g)" % (
+                        state["subset"] + 1, len(state["done"]),
+                        len(state["matrix"]),
+                        self.status.objectivefunction_max))
+                    intervaltime = time.time()
+            if self.status.stop or state["subset"] >= plan["subsets"] - 1:
+                return True
+            state = self.next_subset(state)
+            self.write_checkpoint(state)
+
+    def save(self, like, randompar, simulations, chains=1):
+        """
+        Saves a run like spotpy. If the simulation store of the model wants
+        every run (see SimulationStore.all_runs), the run is handed to it
+        without checking the save threshold.
+        """
+        store = getattr(self.setup, "store", None)
+        if store is None or not store.all_runs:
+            return super().save(like, randompar, simulations, chains=chains)
+        self._init_database(like, randompar, simulations)
+        self.datawriter.save(like, randompar, simulations, chains=chains)
+
+    def get_best_runs(self, likes, pars, runs, percentage):
+        """
+        Returns the best runs, see best_runs.
+        """
+        return best_runs(likes, pars, percentage)
+
+    def handle_signal(self, signum, frame):
+        # Only remembered here, the checkpoint is written after the next run
+        self.stop_signal = signum
+
+    def database_size(self):
+        """
+        Flushes the csv file and returns its size.
+
+        :return: size in bytes, None if there is no csv file yet
+        """
+        datawriter = getattr(self, "datawriter", None)
+        db = getattr(datawriter, "db", None)
+        if db is None or db.closed:
+            return None
+        db.flush()
+        os.fsync(db.fileno())
+        return db.tell()
+
+    def store_position(self):
+        """
+        Flushes the simulation store of the model (dbformat="custom").
+
+        :return: position of the store, None if the model has none
+        """
+        store = getattr(self.setup, "store", None)
+        return None if store is None else store.flush()
+
+    def write_checkpoint(self, state):
+        """
+        Writes the state of the sampling, the random number generators and
+        the progress of the sampler to the checkpoint file.
+
+        :param state: state of the sampling
+        :return: None
+        """
+        checkpoint = dict(state, random=random.getstate(),
+                          numpy_random=np.random.get_state(),
+                          status=dict(rep=self.status.rep,
+                                      objectivefunction_max=self.status
+                                      .objectivefunction_max,
+                                      params_max=self.status.params_max,
+                                      duration=time.time() -
+                                      self.status.starttime),
+                          database_size=self.database_size(),
+                          store_position=self.store_position())
+        # Written to another file first, so a kill while writing does not
+        # destroy the last checkpoint
+        with open(self.checkpoint_name + ".tmp", "wb") as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file)
+        os.replace(self.checkpoint_name + ".tmp", self.checkpoint_name)
+
+    def read_checkpoint(self):
+        """
+        :return: dict with the state of the sampling
+        """
+        if not os.path.exists(self.checkpoint_name):
+            raise FileNotFoundError("No checkpoint {} to resume from".format(
+                self.checkpoint_name))
+        with open(self.checkpoint_name, "rb") as checkpoint_file:
+            return pickle.load(checkpoint_file)
+
+    def restore(self, state):
+        """
+        Restores the random number generators and the progress of the
+        sampler and cuts the csv file (or the simulation store) to the
+        size of the checkpoint.
+
+        :param state: dict with the state of the sampling
+        :return: None
+        """
+        random.setstate(state["random"])
+        np.random.set_state(state["numpy_random"])
+        status = state["status"]
+        self.status.rep = status["rep"]
+        self.status.objectivefunction_max = status["objectivefunction_max"]
+        self.status.params_max = status["params_max"]
+        self.status.starttime -= status["duration"]
+        database = self.dbname + ".csv"
+        if state["database_size"] is None or not os.path.exists(database):
+            self.dbappend = False
+        else:
+            os.truncate(database, state["database_size"])
+            self.dbappend = True
+        if state["store_position"] is not None:
+            self.setup.store.resume(state["store_position"])
+        print("Resuming subset {} with {} of {} runs finished".format(
+            state["subset"] + 1, len(state["done"]), len(state["matrix"])))
@@ -2,66 +2,149 @@
 """
 Created on Aug 04 11:08 2017
 @author(s): Florian U. Jehn
+
+Saves the best 20 % (by like2) of the last 10 % of the runs of ROPE
+without the simulations. The files are streamed: the rows are counted by
+scanning the bytes for line ends, only the lines of the last 10 % are
+split into fields and the best runs are kept in a heap. Several files are
+handled in parallel (number of processes from the environment variable
+PROCESSES, see process_pool.py).
+
+Runs without like2 (nan) are ranked below all other runs, so they are only
+saved if there are not enough runs with a like2. The old version sorted
+them with sort_values, which puts nan last, so the tail picked them first
+as the "best" runs. Runs with the same like2 are ranked by their position,
+the later run is the better one.
 """
+import heapq
+import math
+import multiprocessing
 
-import pandas as pd
-import matplotlib.pyplot as plt
+from process_pool import processes_from_environ
+from result_reader import read_header, pruned_columns
 
 
-def read_data(filename):
+def line_ends(filename, block_size=1 << 24):
     """
-    Reads in the data from a csv file.
+    Counts the line ends of a file block by block.
 
-    :param filename:
-    :return: pd.dataframe
+    :param filename: file name
+    :param block_size: number of bytes read at once
+    :return: list with the cumulated number of line ends after every block,
+    True if the last line has no line end
+    """
+    counts = []
+    total = 0
+    last = b"\n"
+    with open(filename, "rb") as csv_file:
+        while True:
+            block = csv_file.read(block_size)
+            if not block:
+                break
+            total += block.count(b"\n")
+            counts.append(total)
+            last = block[-1:]
+    return counts, last != b"\n"
+
+
+def line_start(filename, line, counts, block_size=1 << 24):
+    """
+    :param filename: file name
+    :param line: number of the line (0 is the header)
+    :param counts: cumulated line ends of the blocks, see line_ends
+    :param block_size: block size of counts
+    :return: position of the first byte of the line
     """
-    results = pd.read_csv(filename, delimiter=",")
-    objective_functions = 0
-    params = 0
-    for col_name in results.columns.values.tolist():
-        if "sim" in col_name:
-            break
-        if "like" in col_name:
-            objective_functions += 1
-        if "par" in col_name:
-            params += 1
-    results_no_sims = results.ix[:, 0:objective_functions + params]
-    return results_no_sims
-
-
-def save_best_runs(results_no_sims, org_name):
+    if line == 0:
+        return 0
+    # Block with the line end before the line
+    block = next(index for index, count in enumerate(counts)
+                 if count >= line)
+    before = counts[block - 1] if block else 0
+    with open(filename, "rb") as csv_file:
+        csv_file.seek(block * block_size)
+        data = csv_file.read(block_size)
+    position = -1
+    for _ in range(line - before):
+        position = data.index(b"\n", position + 1)
+    return block * block_size + position + 1
+
+
+def save_best_runs(org_name, last=0.1, best=0.2, block_size=1 << 24):
     """
     Saves the best 20 % of the last 10 % of runs Rope has produced.
 
-    :param results_no_sims: results without the simulation data
     :param org_name: name of the original file
-    :return: None
+    :param last: fraction of the runs at the end of the file, which are
+    ranked
+    :param best: fraction of the ranked runs, which are saved
+    :param block_size: number of bytes read at once while counting
+    :return: number of saved runs, runs with a nan in like2 are the worst
+    ones (see the module docstring)
     """
-
-    repetitions = results_no_sims.shape[0]
+    header = read_header(org_name)
+    columns = pruned_columns(header)
+    if "like2" not in columns:
+        raise ValueError("{} has no column like2".format(org_name))
+    indices = [header.index(column) for column in columns]
+    rank_index = header.index("like2")
+    split = max(indices) + 1
+
+    counts, unfinished = line_ends(org_name, block_size)
+    repetitions = (counts[-1] if counts else 0) + unfinished - 1
     # Calculate how large the last 10 % of all runs are
-    last_ten_percent = int(repetitions * 0.1)
+    last_ten_percent = int(repetitions * last)
     # calculate how large the best 20 % of the last 10 % are.
-    best_20_percent = int(last_ten_percent * 0.2)
-
-    # Get the last 10 % of the dataframe
-    last_ten_percent_dataframe = results_no_sims.tail(last_ten_percent)
+    best_20_percent = int(last_ten_percent * best)
+
+    # Heap of (like2, number of the run, values), the worst of the kept runs
+    # is the first item
+    heap = []
+    if best_20_percent:
+        first = repetitions - last_ten_percent + 1
+        with open(org_name, "rb") as csv_file:
+            csv_file.seek(line_start(org_name, first, counts, block_size))
+            for run, line in enumerate(csv_file):
+                fields = line.rstrip(b"\r\n").split(b",", split)
+                like = float(fields[rank_index])
+                # Runs without an objective function are never the best
+                if math.isnan(like):
+                    like = -math.inf
+                item = (like, run, b",".join(fields[index]
+                                             for index in indices))
+                if len(heap) < best_20_percent:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+    # Sorted by like2 like before, the best run is the last one
+    with open(org_name[:-4] + "_best_runs.csv", "wb") as csv_out:
+        csv_out.write(",".join(columns).encode() + b"\n")
+        for item in sorted(heap):
+            csv_out.write(item[2] + b"\n")
+    return len(heap)
+
+
+def save_all_best_runs(names, processes=None):
+    """
+    Saves the best runs of several files, each in its own process.
 
-    # Get the best 20 % of the last 10 %
-    sorted_dataframe = last_ten_percent_dataframe.sort_values(by="like2")
-    best_runs = sorted_dataframe.tail(best_20_percent)
+    :param names: names of the original files
+    :param processes: number of processes, None takes it from PROCESSES
+    :return: list with the number of saved runs of every file
+    """
+    if processes is None:
+        processes = processes_from_environ()
+    processes = min(processes, len(names))
+    if processes <= 1:
+        return [save_best_runs(name) for name in names]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(save_best_runs, names)
 
-    best_runs.to_csv(org_name[:-4] + "_best_runs.csv", index=False)
 
 names = ["simple_lumped_2_subsets.csv", "simple_lumped_3_subsets.csv",
          "simple_lumped_4_subsets.csv", "simple_lumped.csv"]
 
 
 if __name__ == '__main__':
-    for name in names:
-
-        results_no_sims = read_data(name)
-        save_best_runs(results_no_sims, name)
-
-
-
+    save_all_best_runs(names)
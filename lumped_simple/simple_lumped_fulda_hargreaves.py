@@ -12,13 +12,27 @@ import datetime
 import sys
 import numpy as np
 from dateutil.relativedelta import relativedelta
+from evaluation_data import EvaluationData
+from forcing_cache import load_window
+from storage_state import StorageState
+from discharge_recorder import DischargeRecorder
+from solver_ladder import SolverLadder
+from parameter_bounds import BoundsEnforcer, ParameterOutOfBounds
+from spinup import Spinup
+from early_stop import EarlyStop
+from surrogate import Screen, ScreenedRepeat
+from process_pool import ProcessRepeat, processes_from_environ
+from simulation_store import SimulationStore, merge
+from vector_engine import create_engine, BatchRepeat
 
 
 class SimpleLumped(object):
     """
     Class which contains the complete model, readeable for Spotpy
     """
-    def __init__(self, begin, end):
+    def __init__(self, begin, end, persistent_connections=True,
+                 bounds="reject", spinup="year", warmup_days=90,
+                 early_stop=None, early_stop_margin=None, engine="cmf"):
         """Initializes the model and build the core setup"""
         # tr_soil_GW = Residence time of the water in the soil to the GW
         self.params = [param("tr_soil_out", 0., 200.),
@@ -43,10 +57,19 @@ class SimpleLumped(object):
         self.begin = begin
         self.end = end
 
+        # Create the connections only once and change their parameters
+        # for every run. False creates them again for every run.
+        self.persistent_connections = persistent_connections
+        self.connections = None
+
         # load the weather data and discharge data
         prec, temp, temp_min, temp_max, Q = self.loadPETQ()
         self.Q = Q
 
+        # Observed discharge and its statistics for the objective function
+        self.evaluation_data = EvaluationData(
+            self.Q[self.begin:self.end + datetime.timedelta(days=1)])
+
         # use only one core (faster when model is small
         cmf.set_parallel_threads(1)
 
@@ -77,6 +100,31 @@ class SimpleLumped(object):
         self.make_stations(prec, temp, temp_min, temp_max)
         self.project = p
 
+        # Initial volumes of all storages, every run starts from them
+        self.initial_state = StorageState(p)
+        # Solvers for all runs, the ladder tries them one after the other
+        # until one of them finishes a run
+        self.ladder = SolverLadder(self.project, self.create_solver)
+        # Repairs or rejects parameter values outside of their bounds
+        self.bounds = BoundsEnforcer(self.params, bounds)
+        # Initial state of every run, the mean observed runoff of the spin-up
+        # year is used for the steady state of the parameters
+        spinup_begin = p.meteo_stations[0].T.begin.AsPython()
+        self.spinup = Spinup(p, [self.outlet], spinup_begin, self.begin,
+                             self.Q[spinup_begin:self.begin].mean(), spinup,
+                             warmup_days)
+        # Stops runs, which can not reach the save threshold of the sampler
+        self.early_stop = EarlyStop(self.evaluation_data, early_stop,
+                                    early_stop_margin)
+        # Solves the runs with cmf or many parameter sets at once with NumPy
+        self.engine = create_engine(engine, p, self.begin, self.end,
+                                    self.spinup)
+        # Surrogate, which screens the candidates of ROPE (see surrogate.py)
+        self.screen = None
+        # Store for the results, if the sampler uses dbformat="custom"
+        # (see simulation_store.py)
+        self.store = None
+
 
     def set_parameters(self,
                        tr_soil_out,
@@ -92,26 +140,71 @@ class SimpleLumped(object):
                        snow_melt_temp,
                        ):
         """
-        Creates all connections with the parameter values produced by the
-        sampling algorithm.
+        Sets the parameter values produced by the sampling algorithm. The
+        connections are created on the first call, later calls only change
+        their parameters.
         """
         # Get all definition from the init method
-        p = self.project
-        c = p[0]
-        outlet = self.outlet
-        soil = c.layers[0]
+        c = self.project[0]
+        if self.connections is None or not self.persistent_connections:
+            self.connections = self.create_connections()
+        con = self.connections
 
-        # Adjustment of the ET
+        # Adjustment of the ET, cmf copies the stress into the cell, so it
+        # is handed over for every parameter set
         c.set_uptakestress(cmf.VolumeStress(ETV1, ETV1 * fETV0))
 
         # Flux from soil to outlet
-        cmf.kinematic_wave(soil, outlet, tr_soil_out/V0_soil,
-                           V0=V0_soil,
-                           exponent=beta_soil_out)
+        con["soil_out"].residencetime = tr_soil_out / V0_soil
+        con["soil_out"].V0 = V0_soil
+        con["soil_out"].exponent = beta_soil_out
 
-        # # Set parameters of the snow calculations
+        # Set parameters of the snow calculations
         cmf.Weather.set_snow_threshold(snow_melt_temp)
-        cmf.SimpleTindexSnowMelt(c.snow, soil, c, rate=meltrate)
+        con["snowmelt"].SnowMeltRate = meltrate
+
+    def engine_parameters(self, tr_soil_out,
+                          V0_soil,
+                          beta_soil_out,
+                          ETV1, fETV0,
+                          meltrate, snow_melt_temp):
+        """
+        Parameters of the connections for the NumPy engine, the same values
+        set_parameters gives the cmf connections. Every parameter can be a
+        np.array with one value per parameter set.
+
+        :return: dictionary for VectorEngine.run
+        """
+        return {
+            # Flux from soil to outlet
+            "soil_out_tr": tr_soil_out / V0_soil,
+            "soil_out_V0": V0_soil,
+            "soil_out_beta": beta_soil_out,
+            # Adjustment of the ET
+            "ET_V1": ETV1,
+            "ET_V0": ETV1 * fETV0,
+            # Snow
+            "meltrate": meltrate,
+            "snow_threshold": snow_melt_temp}
+
+    def create_connections(self):
+        """
+        Creates all connections of the model. Their parameter values are
+        set by set_parameters.
+
+        :return: dictionary with all connections that have parameters
+        """
+        c = self.project[0]
+        outlet = self.outlet
+        soil = c.layers[0]
+
+        # Flux from soil to outlet
+        soil_out = cmf.kinematic_wave(soil, outlet, 1.)
+
+        # Snow melt, the rate is set by set_parameters
+        snowmelt = cmf.SimpleTindexSnowMelt(c.snow, soil, c)
+
+        return {"soil_out": soil_out, "snowmelt": snowmelt}
 
     def loadPETQ(self):
         """
@@ -121,27 +214,26 @@ class SimpleLumped(object):
         # Fixed model starting point
         begin = self.begin - relativedelta(years=1)
         step = datetime.timedelta(days=1)
-        # empty time series
-        prec = cmf.timeseries(begin, step)
-        prec.extend(float(Pstr.strip("\n")) for Pstr in open(fnP))
 
-        discharge = cmf.timeseries(begin, step)
-        discharge.extend(float(Qstr.strip("\n")) for Qstr in open(fnQ))
+        def load(file_name, num_columns=1):
+            """
+            Loads only the simulated days of a file. The text files are
+            parsed once, later starts read the binary cache.
+            """
+            return load_window(file_name, begin, self.end, num_columns)
+
+        prec = cmf.timeseries.from_array(begin, step, load(fnP))
+        discharge = cmf.timeseries.from_array(begin, step, load(fnQ))
         # Convert m3/s to mm/day
         area_catchment = 562.41
         # 86400 = seconds per day
         discharge *= 86400 * 1e3 / (area_catchment * 1e6)
-        temp = cmf.timeseries(begin, step)
-        temp_min = cmf.timeseries(begin, step)
-        temp_max = cmf.timeseries(begin, step)
-
-        # Go through all lines in the file
-        for line in open(fnT):
-            columns = line.strip("\n").split('\t')
-            if len(columns) == 3:
-                temp_max.add(float(columns[0]))
-                temp_min.add(float(columns[1]))
-                temp.add(float(columns[2]))
+
+        # The columns of the temperature file are max, min and avg
+        temperature = load(fnT, num_columns=3)
+        temp_max = cmf.timeseries.from_array(begin, step, temperature[:, 0])
+        temp_min = cmf.timeseries.from_array(begin, step, temperature[:, 1])
+        temp = cmf.timeseries.from_array(begin, step, temperature[:, 2])
 
         return prec, temp, temp_min, temp_max, discharge
 
@@ -162,52 +254,105 @@ class SimpleLumped(object):
         self.project.use_nearest_meteo()
         return rainstation
 
-    def run_model(self):
+    def create_solver(self):
         """
-        Starts the model. Used by spotpy
-        """
-        try:
-            # Create a solver for differential equations
-            solver = cmf.CVodeIntegrator(self.project, 1e-8)
+        Creates the solver for differential equations. The model creates it
+        only once and uses it for all runs, it is the first rung of the
+        solver ladder.
 
-            # New time series for model results
-            resQ = cmf.timeseries(self.begin, cmf.day)
-            # starts the solver and calculates the daily time steps
-            end = self.end
-            for t in solver.run(self.project.meteo_stations[0].T.begin,
-                                end,
-                                cmf.day):
+        :return: cmf.CVodeIntegrator
+        """
+        return cmf.CVodeIntegrator(self.project, 1e-8)
 
-                # Fill the results (first year is included but not used to
-                # calculate the NS)
-                if t >= self.begin:
-                    resQ.add(self.outlet.waterbalance(t))
+    def run_model(self, parameters=None):
+        """
+        Starts the model. Used by spotpy
 
-            return resQ
+        :param parameters: dictionary with the parameters of the run, only
+        used for the records of failed attempts
+        """
 
-        # Return an nan - array when a runtime error occurs
+        # The solvers of the ladder are tried one after the other, until one
+        # of them finishes the run
+        try:
+            return self.ladder.run(self.run_solver, parameters)
+        # Return an nan - array when a runtime error occurs in all solvers
+        # (solver errors and runs stopped by the watchdogs)
         except RuntimeError:
-            return np.array(self.Q[
-                            self.begin:self.end + datetime.timedelta(
-                                days=1)]) * np.nan
+            return self.evaluation_data.nan_result()
+
+    def run_solver(self, solver, watchdog):
+        """
+        Runs the model once with one solver of the ladder.
+
+        :param solver: cmf integrator of the project
+        :param watchdog: Watchdog with the limits for the solver
+        :return: np.array with the discharge of every day
+        """
+        # Start every parameter set from the initial volumes or from the
+        # steady state of its parameters
+        self.spinup.restore(self.initial_state, solver)
+        self.early_stop.start()
+
+        # Buffer for the model results, allocated for all days at once
+        resQ = DischargeRecorder(self.begin, self.end)
+        # starts the solver and calculates the daily time steps
+        end = self.end
+        for t in watchdog.run(solver, end, cmf.day):
+
+            # Fill the results (first year is included but not used to
+            # calculate the NS)
+            if t >= self.begin:
+                q = self.outlet.waterbalance(t)
+                resQ.add(q)
+                # The rest of the run stays nan
+                if not self.early_stop.add(q):
+                    break
+
+        return resQ.values
 
     def simulation(self, vector):
         """
         SpotPy expects a method simulation. This methods calls set_parameters
         and run_models, so SpotPy is satisfied
         """
+        # The NumPy engine only pays off for many sets at once, single sets
+        # (e.g. from MPI) are run with cmf
+        if self.engine is not None and np.ndim(vector) == 2:
+            return self.simulation_numpy(vector)
+        # Repair or reject values outside of the bounds of the parameters
+        try:
+            vector = self.bounds.apply(vector)
+        except ParameterOutOfBounds:
+            return self.evaluation_data.nan_result()
         paramdict = dict((pp.name, v) for pp, v in zip(self.params, vector))
         self.set_parameters(**paramdict)
-        resQ = self.run_model()
+        return self.run_model(paramdict)
+
+    def simulation_numpy(self, vector):
+        """
+        Runs one parameter set or a matrix with one parameter set per row
+        with the NumPy engine.
 
-        return np.array(resQ)
+        :param vector: parameter values or np.array with one set per row
+        :return: np.array with the discharge of every day, for a matrix one
+        row per parameter set
+        """
+        # Sets outside of the bounds are repaired or stay nan
+        matrix, valid = self.bounds.apply_batch(vector)
+        result = np.full((len(matrix), len(self.evaluation_data.observed)),
+                         np.nan)
+        if valid.any():
+            columns = dict((pp.name, matrix[valid, i])
+                           for i, pp in enumerate(self.params))
+            result[valid] = self.engine.run(self.engine_parameters(**columns))
+        return result if np.ndim(vector) == 2 else result[0]
 
     def evaluation(self):
         """
         For Spotpy
         """
-        return np.array(
-            self.Q[self.begin:self.end + datetime.timedelta(days=1)])
+        return self.evaluation_data.observed
 
     def parameters(self):
         """
@@ -215,25 +360,81 @@ class SimpleLumped(object):
         """
         return spotpy.parameter.generate(self.params)
 
-    def objectivefunction(self, simulation, evaluation):
+    def objectivefunction(self, simulation, evaluation, params=None):
         """
         For Spotpy
         """
-        # Slice the arrays to only use the days of the calibration period
-        # for objective function
-        # 1827 = 2 * 366 + 3 * 365
-        evaluation_calibration = evaluation[:1827]
-        evaluation_validation = evaluation[1827:]
-        simulation_calibration = simulation[:1827]
-        simulation_validation = simulation[1827:]
-        ns_calibration = spotpy.objectivefunctions.kge(
-                                                        evaluation_calibration,
-                                                        simulation_calibration,
-        )
-        ns_validation = spotpy.objectivefunctions.kge(
-                                                        evaluation_validation,
-                                                        simulation_validation,)
-        return [ns_calibration, ns_validation]
+        # Candidates rejected by the surrogate were not run, they are ranked
+        # below all runs
+        if self.screen is not None and params is not None:
+            score = self.screen.score(params[0])
+            if score is not None:
+                return score
+        # Runs stopped early are ranked below all finished runs
+        if self.early_stop.stopped_early(simulation):
+            like = self.early_stop.score(simulation)
+        else:
+            # Calibration and validation period, the statistics of the
+            # observed discharge are calculated once in __init__
+            like = self.evaluation_data.for_evaluation(evaluation).kge(
+                simulation)
+        # The surrogate learns the objective function of every run
+        if self.screen is not None and params is not None:
+            self.screen.learn(params[0], like)
+        return like
+
+    def simulation_batch(self, matrix):
+        """
+        Runs many parameter sets, one per row of matrix. The bounds of all
+        sets are checked at once, the NumPy engine runs them together if
+        there are enough of them (see VectorEngine.min_batch).
+
+        :param matrix: np.array with one parameter set per row
+        :return: np.array with the discharge of every day, one row per
+        parameter set
+        """
+        if self.engine is not None and len(matrix) >= self.engine.min_batch:
+            return self.simulation_numpy(matrix)
+        matrix, valid = self.bounds.apply_batch(matrix)
+        result = np.full((len(matrix), len(self.evaluation_data.observed)),
+                         np.nan)
+        for index in np.flatnonzero(valid):
+            paramdict = dict((pp.name, v)
+                             for pp, v in zip(self.params, matrix[index]))
+            self.set_parameters(**paramdict)
+            result[index] = self.run_model(paramdict)
+        return result
+
+    def objectivefunction_batch(self, simulations, evaluation):
+        """
+        Objective function of many runs at once, the periods of all runs
+        are scored together.
+
+        :param simulations: np.array with one simulation per row
+        :param evaluation: observed discharge
+        :return: np.array with one row per run and one column per period
+        """
+        simulations = np.array(simulations, dtype=np.float64, ndmin=2)
+        result = self.evaluation_data.for_evaluation(
+            evaluation).score_batch(simulations, "kge")
+        # Runs stopped early are ranked below all finished runs
+        for index, simulation in enumerate(simulations):
+            if self.early_stop.stopped_early(simulation):
+                result[index] = self.early_stop.score(simulation)
+        return result
+
+    def save(self, objectivefunctions, parameter, simulations, chains=1):
+        """
+        Called by spotpy for the runs above the save threshold, if the
+        sampler uses dbformat="custom".
+
+        :param objectivefunctions: objective functions of the run
+        :param parameter: parameter values of the run
+        :param simulations: simulated discharge of the run
+        :param chains: chain of the sampler
+        :return: None
+        """
+        self.store.save(objectivefunctions, parameter, simulations, chains)
 
 
 if __name__ == '__main__':
@@ -257,15 +458,26 @@ if __name__ == '__main__':
     fnP = "P_Krigavg_kammerzell_1979_1999.txt"
 
     # import algorithm
-    from spotpy.algorithms import rope as Sampler
+    from resumable_rope import ResumableRope as Sampler
 
     # Find out if the model should run parallel (for supercomputer)
     parallel = 'mpi' if 'OMPI_COMM_WORLD_SIZE' in os.environ else 'seq'
 
+    # Runs below the threshold in one of the periods are not saved. With
+    # EARLY_STOP=<threshold> the model stops runs as soon as they can not
+    # reach it anymore (see early_stop.py)
+    save_threshold = [0.0, 0.0]
+
     # Create the model
     model = SimpleLumped(datetime.datetime(begin, 1, 1), datetime.datetime(
         end, 12, 31))
 
+    # Continue an interrupted sampling from its csv file and checkpoint
+    # (see resumable_rope.py)
+    resume = "--resume" in sys.argv
+    if resume:
+        sys.argv.remove("--resume")
+
     # If there is an command line argument, take its value for the amount of
     #  runs
     if len(sys.argv) > 1:
@@ -273,10 +485,43 @@ if __name__ == '__main__':
 
     # run the model
     if runs:
-        sampler = Sampler(model, parallel=parallel,
-                          dbname="simple_lumped_hargreaves",
-                          dbformat="csv", save_sim=True,save_threshold=[0.0,
-                                                                        0.0])
-        sampler.sample(runs, subsets=30)
+        # Spotpy writes the runs to a csv file. With RESULTS=store the
+        # parameters and objective functions are saved in a table and the
+        # simulations in binary blocks instead (see simulation_store.py)
+        dbname = "simple_lumped_hargreaves"
+        results = os.environ.get("RESULTS", "csv")
+        sampler = Sampler(model, parallel=parallel, dbname=dbname,
+                          dbformat="custom" if results == "store" else "csv",
+                          save_sim=True, save_threshold=save_threshold)
+        # KEEP_SIMULATIONS=<K> keeps only the simulations of the K best
+        # runs above the save threshold. The table then holds all runs,
+        # also those below it
+        keep = int(os.environ.get("KEEP_SIMULATIONS", 0)) or None
+        if results == "store":
+            model.store = SimulationStore(
+                dbname, sampler.parnames, keep=keep, threshold=save_threshold)
+        # Without MPI the runs can be spread over a pool of local processes
+        # (environment variable PROCESSES), each with its own model
+        processes = processes_from_environ()
+        if parallel == 'seq' and processes > 1:
+            sampler.repeat = ProcessRepeat(
+                SimpleLumped, (model.begin, model.end),
+                processes=processes)
+        # The NumPy engine gets the parameter sets of ROPE in batches
+        elif model.engine is not None and parallel == 'seq':
+            sampler.repeat = BatchRepeat(model)
+        # Optional surrogate, which rejects candidates predicted to stay below
+        # the threshold (environment variable SURROGATE)
+        model.screen = Screen.from_environ(model, save_threshold)
+        if model.screen is not None:
+            sampler.repeat = ScreenedRepeat(sampler.repeat, model.screen)
+        sampler.sample(runs, subsets=30, resume=resume)
+        if model.store is not None:
+            # Only a finished sampling is merged, a stopped one is resumed
+            model.store.close()
+            if sampler.finished:
+                merge(dbname, keep=keep)
+        if model.screen is not None:
+            print(model.screen.summary())
 
 
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Screens the candidates of ROPE with a surrogate of the model before they
+are run. Spotpy only saves runs, whose objective function is above the
+threshold in every period, but ROPE runs every candidate, although most of
+them end up far below it.
+
+The surrogate is a nearest neighbour regression in the parameter space
+scaled to the bounds of the parameters. It predicts like1, like2, ... of a
+candidate from the k nearest runs (weighted by their inverse distance) and
+their spread. It is trained on the results of earlier samplings (spotpy
+csv files with like and par columns) and learns every finished run during
+the sampling from the objective function of the model (Screen.learn is
+called by objectivefunction, so every run is scored once).
+
+A candidate is rejected, if the prediction plus its spread plus a margin
+is below the threshold in one of the periods. Rejected candidates are not
+run. Their objective function is -inf in every period, so they are never
+saved and ROPE ranks them below all runs (ResumableRope ranks by the
+objective function only, so the tied -inf are fine). The predictions of the
+surrogate are never mixed with the objective functions of the model.
+Screening starts only when the surrogate knows enough runs.
+
+Switch it on for a whole job with the environment variable SURROGATE,
+either "online" or the csv file of an earlier sampling of the same model
+and objective function.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def read_results(file_name, names):
+    """
+    Reads the parameters and objective functions of a spotpy csv file,
+    without the simulations.
+
+    :param file_name: spotpy csv file
+    :param names: names of the parameters of the model
+    :return: np.array with one parameter set per row, np.array with the
+    objective functions (like1, like2, ...) of every run
+    """
+    columns = pd.read_csv(file_name, nrows=0).columns
+    likes = [column for column in columns if column.startswith("like")]
+    missing = [name for name in names if "par" + name not in columns]
+    if missing:
+        raise ValueError("{} has no values for the parameters {}".format(
+            file_name, ", ".join(missing)))
+    pars = ["par" + name for name in names]
+    data = pd.read_csv(file_name, usecols=likes + pars)
+    return data[pars].to_numpy(dtype=float), data[likes].to_numpy(
+        dtype=float)
+
+
+class Surrogate:
+    """
+    Nearest neighbour regression of the objective functions.
+    """
+    def __init__(self, lower, upper, neighbours=8, floor=-np.inf):
+        """
+        :param lower: np.array with the lower bounds of the parameters
+        :param upper: np.array with the upper bounds of the parameters
+        :param neighbours: number of runs a prediction is based on
+        :param floor: objective functions below (and nan) are set to it,
+        so a few very bad runs do not dominate the mean
+        """
+        self.lower = np.asarray(lower, dtype=float)
+        self.width = np.asarray(upper, dtype=float) - self.lower
+        self.width[self.width <= 0] = 1.
+        self.neighbours = neighbours
+        self.floor = floor
+        # The runs are stored in buffers, which grow when they are full
+        self.size = 0
+        self.points = np.empty((1024, len(self.lower)))
+        self.likes = None
+
+    def __len__(self):
+        return self.size
+
+    def scale(self, params):
+        """
+        :param params: np.array with one parameter set per row
+        :return: parameters scaled to 0 - 1 by their bounds
+        """
+        return (np.array(params, dtype=float, ndmin=2) - self.lower) / \
+            self.width
+
+    def add(self, params, likes):
+        """
+        Adds finished runs to the surrogate.
+
+        :param params: np.array with one parameter set per row
+        :param likes: np.array with the objective functions of every run
+        :return: None
+        """
+        points = self.scale(params)
+        likes = np.array(likes, dtype=float, ndmin=2)
+        likes = np.where(np.isnan(likes), self.floor,
+                         np.maximum(likes, self.floor))
+        if self.likes is None:
+            self.likes = np.empty((len(self.points), likes.shape[1]))
+        end = self.size + len(points)
+        if end > len(self.points):
+            capacity = max(2 * len(self.points), end)
+            self.points = np.resize(self.points, (capacity,
+                                                  self.points.shape[1]))
+            self.likes = np.resize(self.likes, (capacity,
+                                                self.likes.shape[1]))
+        self.points[self.size:end] = points
+        self.likes[self.size:end] = likes
+        self.size = end
+
+    def predict(self, params, chunk_size=4000000):
+        """
+        Predicts the objective functions of parameter sets.
+
+        :param params: np.array with one parameter set per row
+        :param chunk_size: maximal number of distances in memory
+        :return: np.array with the prediction, np.array with the weighted
+        standard deviation of the neighbours, both with one row per set
+        """
+        points = self.scale(params)
+        known = self.points[:self.size]
+        known_likes = self.likes[:self.size]
+        known_squares = np.einsum("ij,ij->i", known, known)
+        k = min(self.neighbours, self.size)
+        mean = np.empty((len(points), known_likes.shape[1]))
+        spread = np.empty_like(mean)
+        step = max(chunk_size // self.size, 1)
+        for start in range(0, len(points), step):
+            part = points[start:start + step]
+            # Squared distances |a - b|² = |a|² + |b|² - 2ab
+            distance = np.einsum("ij,ij->i", part, part)[:, np.newaxis] + \
+                known_squares - 2 * np.dot(part, known.T)
+            nearest = np.argpartition(distance, k - 1, axis=1)[:, :k]
+            distance = np.sqrt(np.maximum(
+                np.take_along_axis(distance, nearest, axis=1), 0.))
+            weights = 1 / np.maximum(distance, 1e-9)
+            weights /= weights.sum(axis=1, keepdims=True)
+            likes = known_likes[nearest]
+            part_mean = np.einsum("ij,ijk->ik", weights, likes)
+            variance = np.einsum("ij,ijk->ik", weights,
+                                 (likes - part_mean[:, np.newaxis]) ** 2)
+            mean[start:start + step] = part_mean
+            spread[start:start + step] = np.sqrt(variance)
+        return mean, spread
+
+
+class Screen:
+    """
+    Decides which candidates of ROPE are run and remembers the rejected
+    ones for the objective function.
+    """
+    def __init__(self, model, threshold, results=None, margin=0.1,
+                 min_runs=200, neighbours=8):
+        """
+        :param model: model with params, bounds and objectivefunction
+        :param threshold: save threshold of the sampler, one value for all
+        periods or a list with one value per period
+        :param results: spotpy csv file of an earlier sampling of the same
+        model and objective function, None starts without any runs
+        :param margin: candidates whose prediction plus spread plus margin
+        is below the threshold are rejected
+        :param min_runs: runs the surrogate needs before it rejects
+        candidates
+        :param neighbours: number of runs a prediction is based on
+        """
+        self.model = model
+        self.threshold = np.atleast_1d(np.asarray(threshold, dtype=float))
+        self.margin = margin
+        self.min_runs = min_runs
+        self.names = [param.name for param in model.params]
+        self.surrogate = Surrogate(model.bounds.lower, model.bounds.upper,
+                                   neighbours, self.threshold.min() - 1)
+        if results is not None:
+            self.surrogate.add(*read_results(results, self.names))
+        # Rejected candidates, removed when they are handed to the objective
+        # function, and the number of periods of the objective function
+        self.skipped = set()
+        self.periods = len(self.threshold)
+        # Number of run and rejected candidates
+        self.run = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_environ(cls, model, threshold, **kwargs):
+        """
+        Creates a screen, if the environment variable SURROGATE is set.
+
+        :param model: see __init__
+        :param threshold: see __init__
+        :return: Screen or None
+        """
+        value = os.environ.get("SURROGATE", "none")
+        if value.lower() in ("", "none"):
+            return None
+        results = None if value.lower() == "online" else value
+        return cls(model, threshold, results, **kwargs)
+
+    @staticmethod
+    def key(params):
+        return np.asarray(params, dtype=float).tobytes()
+
+    def rejects(self, params):
+        """
+        :param params: np.array with one parameter set per row
+        :return: boolean np.array, True for the rejected sets
+        """
+        params = np.array(params, dtype=float, ndmin=2)
+        if len(self.surrogate) < self.min_runs:
+            return np.zeros(len(params), dtype=bool)
+        mean, spread = self.surrogate.predict(params)
+        periods = min(mean.shape[1], len(self.threshold))
+        threshold = np.broadcast_to(self.threshold, (periods,))
+        optimistic = mean[:, :periods] + spread[:, :periods] + self.margin
+        rejected = (optimistic < threshold).any(axis=1)
+        self.periods = mean.shape[1]
+        for row in params[rejected]:
+            self.skipped.add(self.key(row))
+        return rejected
+
+    def score(self, params):
+        """
+        Returns the objective function of a rejected candidate.
+
+        :param params: parameter values handed to the objective function
+        :return: list with -inf for every period or None, if the candidate
+        was run
+        """
+        key = self.key(params)
+        if key not in self.skipped:
+            return None
+        self.skipped.remove(key)
+        return [-np.inf] * self.periods
+
+    def learn(self, params, like):
+        """
+        Adds a finished run to the surrogate, called by the objective
+        function of the model.
+
+        :param params: parameter values of the run
+        :param like: objective function of the run
+        :return: None
+        """
+        self.surrogate.add(params, np.atleast_1d(like))
+
+    def summary(self):
+        """
+        :return: str with the numbers of run and rejected candidates
+        """
+        return "{} candidates run, {} rejected by the surrogate".format(
+            self.run, self.rejected)
+
+
+class ScreenedRepeat:
+    """
+    Replaces the repeat of a spotpy sampler. Every batch of candidates is
+    screened, the rejected ones are not handed to the original repeat. The
+    results are yielded in the order of the jobs.
+    """
+    def __init__(self, repeat, screen, batch_size=1000):
+        """
+        :param repeat: repeat of the sampler (spotpy.parallel or
+        BatchRepeat)
+        :param screen: Screen of the model
+        :param batch_size: maximal number of candidates screened at once
+        """
+        self.repeat = repeat
+        self.screen = screen
+        self.batch_size = batch_size
+
+    def is_idle(self):
+        return self.repeat.is_idle()
+
+    def terminate(self):
+        self.repeat.terminate()
+
+    def setphase(self, phasename):
+        self.repeat.setphase(phasename)
+
+    def start(self):
+        self.repeat.start()
+
+    def __call__(self, jobs):
+        """
+        :param jobs: iterable of (run id, parameter set)
+        :return: generator of (run id, parameter set, simulation)
+        """
+        jobs = iter(jobs)
+        nan_result = self.screen.model.evaluation_data.nan_result
+        while True:
+            batch = [job for _, job in zip(range(self.batch_size), jobs)]
+            if not batch:
+                return
+            rejected = self.screen.rejects([params for _, params in batch])
+            self.screen.rejected += int(rejected.sum())
+            accepted = [job for job, reject in zip(batch, rejected)
+                        if not reject]
+            # Finished runs by their position in the batch, the rejected
+            # candidates are finished right away
+            position = {run_id: index
+                        for index, (run_id, _) in enumerate(batch)}
+            finished = {index: (run_id, params, nan_result())
+                        for index, ((run_id, params), reject)
+                        in enumerate(zip(batch, rejected)) if reject}
+            index = 0
+            for run_id, params, simulation in self.repeat(accepted):
+                self.screen.run += 1
+                finished[position[run_id]] = run_id, params, simulation
+                while index in finished:
+                    yield finished.pop(index)
+                    index += 1
+            while index in finished:
+                yield finished.pop(index)
+                index += 1
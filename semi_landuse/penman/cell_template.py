@@ -18,6 +18,8 @@ class CellTemplate:
         self.project = project
         self.outlet = outlet
         self.cell = self.project.NewCell(0, 0, self.height, self.size * 1e6)
+        # Connections with parameters, created by the first set_parameters
+        self.connections = None
         self.basic_set_up()
         self.make_meteo_stations()
 
@@ -44,47 +46,78 @@ class CellTemplate:
         # Install a connection for the ET
         cmf.PenmanMonteithET(self.cell.layers[0], self.cell.transpiration)
 
-    def set_parameters(self, params):
+    def set_parameters(self, params, rebuild=False):
         """
-        Sets the parameters for the current cell.
+        Sets the parameters for the current cell. The connections are created
+        on the first call, later calls only change their parameters.
 
         :param: params: dictionary of parameters.
+        :param: rebuild: create the connections again
         :return:
         """
         # Get all definition from the init method
         cell = self.cell
-        outlet = self.outlet
-        soil = cell.layers[0]
-        gw = cell.layers[1]
-        
+        if self.connections is None or rebuild:
+            self.connections = self.create_connections()
+        con = self.connections
+
         # EVT1 must be adjusted to cell size
         ETV1 = params["ETV1"]
         ETV1 = (ETV1 / 1000) * cell.area
-        
+
         # V0 must be adjusted to cell size as well
         V0_soil = params["V0_soil"]
         V0_soil = (V0_soil / 1000) * cell.area
-        
-        # Adjustment of the ET
+
+        # Adjustment of the ET, cmf copies the stress into the cell, so it
+        # is handed over for every parameter set
         cell.set_uptakestress(cmf.VolumeStress(
                                 ETV1,
                                 ETV1 * params["fETV0"]))
 
         # Flux from soil to outlet
-        cmf.kinematic_wave(soil,
-                           outlet,
-                           params["tr_soil_out"] / V0_soil,
-                           V0=V0_soil,
-                           exponent=params["beta_soil_out"])
+        con["soil_out"].residencetime = params["tr_soil_out"] / V0_soil
+        con["soil_out"].V0 = V0_soil
+        con["soil_out"].exponent = params["beta_soil_out"]
+
+        # Flux from soil to groundwater
+        con["soil_gw"].residencetime = params["tr_soil_gw"] / V0_soil
+        con["soil_gw"].V0 = V0_soil
+        con["soil_gw"].exponent = params["beta_soil_gw"]
+
+        # Flux from the  groundwater to the outlet (baseflow)
+        con["gw_out"].residencetime = params["tr_gw_out"]
+
+        # Sets the paramaters for interception
+        cell.vegetation.LAI = params["LAI"]
+
+        # Defines how much throughfall there is (in %)
+        cell.vegetation.CanopyClosure = params["CanopyClosure"]
+
+        # # Set parameters of the snow calculations
+        cmf.Weather.set_snow_threshold(params["snow_melt_temp"])
+        con["snowmelt"].SnowMeltRate = params["meltrate"]
+
+    def create_connections(self):
+        """
+        Creates all connections of the cell. Their parameter values are set
+        by set_parameters.
+
+        :return: dictionary with all connections that have parameters
+        """
+        cell = self.cell
+        outlet = self.outlet
+        soil = cell.layers[0]
+        gw = cell.layers[1]
+
+        # Flux from soil to outlet
+        soil_out = cmf.kinematic_wave(soil, outlet, 1.)
 
         # Flux from soil to groundwater
-        cmf.kinematic_wave(soil, gw,
-                           params["tr_soil_gw"] / V0_soil,
-                           V0=V0_soil,
-                           exponent=params["beta_soil_gw"])
+        soil_gw = cmf.kinematic_wave(soil, gw, 1.)
 
         # Flux from the  groundwater to the outlet (baseflow)
-        cmf.kinematic_wave(gw, outlet, params["tr_gw_out"])
+        gw_out = cmf.kinematic_wave(gw, outlet, 1.)
 
         # Split the rainfall in interception and throughfall
         cmf.Rainfall(cell.canopy, cell, False, True)
@@ -96,16 +129,11 @@ class CellTemplate:
         # Transpiration from the plants is added
         cmf.CanopyStorageEvaporation(cell.canopy, cell.evaporation, cell)
 
-        # Sets the paramaters for interception
-        cell.vegetation.LAI = params["LAI"]
+        # Snow melt, the rate is set by set_parameters
+        snowmelt = cmf.SimpleTindexSnowMelt(cell.snow, soil, cell)
 
-        # Defines how much throughfall there is (in %)
-        cell.vegetation.CanopyClosure = params["CanopyClosure"]
-
-        # # Set parameters of the snow calculations
-        cmf.Weather.set_snow_threshold(params["snow_melt_temp"])
-        cmf.SimpleTindexSnowMelt(cell.snow, soil, cell,
-                                 rate=params["meltrate"])
+        return {"soil_out": soil_out, "soil_gw": soil_gw,
+                "gw_out": gw_out, "snowmelt": snowmelt}
 
     def make_meteo_stations(self):
         """
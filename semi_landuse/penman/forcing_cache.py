@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Binary cache for the plain text forcing files. Every file is parsed only
+once into a .npy file in the folder __forcing_cache__ next to it. Later
+starts memory map the .npy file instead of parsing the text again.
+
+When the model runs with mpirun, only the first rank on every node loads a
+file. The array is put into a MPI shared memory window and all other ranks
+of the node use this window without copying the data. Set the environment
+variable SHARE_FORCING=0 to let every rank load the files on its own.
+
+The models only keep the days they simulate (load_window), all forcing
+files hold daily values starting on FORCING_BEGIN.
+"""
+import datetime
+import functools
+import itertools
+import os
+import socket
+
+import numpy as np
+
+
+CACHE_DIR = "__forcing_cache__"
+
+# First day of all forcing files
+FORCING_BEGIN = datetime.datetime(1979, 1, 1)
+
+# Shared memory windows have to live as long as the arrays using them
+_windows = []
+_node_comm = None
+
+
+def cache_key(file_name):
+    """
+    Creates a key from the size and the modification time of a file, so
+    the cache is renewed as soon as the file changes. The content is not
+    read, that is what the cache is for.
+
+    :param file_name: path of the text file
+    :return: hex string
+    """
+    stat = os.stat(file_name)
+    return "{:x}-{:x}".format(stat.st_size, stat.st_mtime_ns)
+
+
+def temp_name(path):
+    """
+    Returns a temporary name for writing path, which is unique for the
+    process on a shared file system (host name and process id).
+
+    :param path: path of the file
+    :return: path of the temporary file
+    """
+    return "{}.{}.{}.tmp".format(path, socket.gethostname(), os.getpid())
+
+
+def cache_name(file_name):
+    """
+    Returns the name of the cache file for a text file.
+
+    :param file_name: path of the text file
+    :return: path of the .npy file
+    """
+    folder, name = os.path.split(os.path.abspath(file_name))
+    return os.path.join(folder, CACHE_DIR,
+                        name + "." + cache_key(file_name) + ".npy")
+
+
+def parse_text(file_name, num_columns=1, stop=None):
+    """
+    Parses a text file with one value per line or with tab separated
+    columns. Lines of multi column files with another number of columns are
+    skipped, like the old loadPETQ did.
+
+    :param file_name: path of the text file
+    :param num_columns: number of columns in the file
+    :param stop: stop reading after this many lines, None reads all
+    :return: np.array with shape (lines,) or (lines, num_columns)
+    """
+    lines = itertools.islice(open(file_name), stop)
+    if num_columns == 1:
+        return np.array([float(line.strip("\n")) for line in lines])
+    rows = []
+    for line in lines:
+        columns = line.strip("\n").split("\t")
+        if len(columns) == num_columns:
+            rows.append([float(value) for value in columns])
+    return np.array(rows).reshape(-1, num_columns)
+
+
+def write_cache(array, path):
+    """
+    Writes the array to path. The file is written under a temporary name
+    first, so other processes never see a half written cache.
+
+    :param array: np.array
+    :param path: path of the .npy file
+    :return: None
+    """
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    # Remove caches of older versions of the same file
+    name = os.path.basename(path)
+    prefix = name.rsplit(".", 2)[0] + "."
+    for old in os.listdir(folder):
+        if old.startswith(prefix) and old.endswith(".npy") and old != name:
+            try:
+                os.remove(os.path.join(folder, old))
+            except OSError:
+                pass
+    temp_path = temp_name(path)
+    with open(temp_path, "wb") as temp_file:
+        np.save(temp_file, array)
+    os.replace(temp_path, path)
+
+
+def cached(file_name, parse, fallback=None):
+    """
+    Returns the array parse(file_name) from the cache. The file is only
+    parsed when there is no valid cache for it.
+
+    :param file_name: path of the file
+    :param parse: function creating a float64 array from the file
+    :param fallback: function used instead of parse, if the cache can not
+    be written, default is parse
+    :return: read only np.array
+    """
+    path = cache_name(file_name)
+    if not os.path.exists(path):
+        try:
+            write_cache(parse(file_name), path)
+        except OSError:
+            # Read only file system, just use the parsed values
+            return (fallback or parse)(file_name)
+    return np.load(path, mmap_mode="r")
+
+
+def load_cached(file_name, num_columns=1, stop=None):
+    """
+    Loads a forcing file as a read only float64 array. The text is only
+    parsed when there is no valid cache for the file.
+
+    :param file_name: path of the text file
+    :param num_columns: number of columns in the file
+    :param stop: only the first stop lines are needed, None loads all
+    :return: np.array with shape (lines,) or (lines, num_columns)
+    """
+    values = cached(file_name,
+                    functools.partial(parse_text, num_columns=num_columns),
+                    functools.partial(parse_text, num_columns=num_columns,
+                                      stop=stop))
+    return values[:stop]
+
+
+def node_comm():
+    """
+    Returns a MPI communicator with all ranks on the current node or None, if
+    the model does not run with mpirun or sharing is switched off.
+
+    :return: mpi4py.MPI.Comm or None
+    """
+    global _node_comm
+    if "OMPI_COMM_WORLD_SIZE" not in os.environ:
+        return None
+    if os.environ.get("SHARE_FORCING", "1") == "0":
+        return None
+    if _node_comm is None:
+        from mpi4py import MPI
+        _node_comm = MPI.COMM_WORLD.Split_type(MPI.COMM_TYPE_SHARED)
+    return _node_comm
+
+
+def share_on_node(load, *args):
+    """
+    Calls load(*args) only on the first rank of the node and hands the
+    resulting array to all ranks of the node through a shared memory window.
+    All ranks of a node have to call this function in the same order.
+
+    :param load: function returning a np.array
+    :param args: arguments for load
+    :return: read only np.array in shared memory
+    """
+    comm = node_comm()
+    if comm is None:
+        return load(*args)
+    from mpi4py import MPI
+
+    array = None
+    layout = None
+    if comm.rank == 0:
+        try:
+            array = np.ascontiguousarray(load(*args), dtype=np.float64)
+            layout = array.shape
+        except Exception as error:
+            # Hand the error to the other ranks, so they do not wait forever
+            layout = error
+    shape = comm.bcast(layout, root=0)
+    if isinstance(shape, Exception):
+        raise shape
+    item_size = np.dtype(np.float64).itemsize
+    size = int(np.prod(shape)) * item_size if comm.rank == 0 else 0
+    window = MPI.Win.Allocate_shared(size, item_size, comm=comm)
+    buffer, _ = window.Shared_query(0)
+    shared = np.ndarray(buffer=buffer, dtype=np.float64, shape=shape)
+    if comm.rank == 0:
+        shared[...] = array
+    comm.Barrier()
+    shared.flags.writeable = False
+    _windows.append(window)
+    return shared
+
+
+def window_rows(begin, end, file_begin=FORCING_BEGIN):
+    """
+    Returns the rows of a daily forcing file between begin and end.
+
+    :param begin: first day needed
+    :param end: last day needed (included)
+    :param file_begin: first day of the file
+    :return: first, stop (stop is not included)
+    """
+    first = (begin - file_begin).days
+    stop = (end - file_begin).days + 1
+    if first < 0:
+        raise ValueError("The forcing starts on {:%d.%m.%Y}, but the model "
+                         "starts on {:%d.%m.%Y}".format(file_begin, begin))
+    return first, stop
+
+
+def check_window(name, length, begin, end, file_begin=FORCING_BEGIN,
+                 missing_days=0):
+    """
+    Raises a ValueError if a series with length values does not reach end.
+
+    :param name: name of the series for the error message
+    :param length: number of days in the series
+    :param missing_days: number of days the series may end before end
+    :return: None
+    """
+    first, stop = window_rows(begin, end, file_begin)
+    if length < stop - missing_days:
+        last = file_begin + datetime.timedelta(days=length - 1)
+        raise ValueError("{} ends on {:%d.%m.%Y}, but the model runs until "
+                         "{:%d.%m.%Y}".format(name, last, end))
+
+
+def read_window(file_name, begin, end, num_columns=1):
+    """
+    Reads only the rows of a forcing file between begin and end.
+
+    :return: np.array with shape (days,) or (days, num_columns)
+    """
+    first, stop = window_rows(begin, end)
+    values = load_cached(file_name, num_columns, stop)
+    check_window(file_name, len(values), begin, end)
+    return np.array(values[first:stop])
+
+
+def load_window(file_name, begin, end, num_columns=1):
+    """
+    Loads the days between begin and end (included) from a forcing file as
+    a read only float64 array. Everything outside the window is dropped and
+    a ValueError is raised if the file does not cover the window. With
+    mpirun the window is loaded once per node and shared between the ranks.
+
+    :param file_name: path of the text file
+    :param begin: first day needed
+    :param end: last day needed
+    :param num_columns: number of columns in the file
+    :return: np.array with shape (days,) or (days, num_columns)
+    """
+    return share_on_node(read_window, file_name, begin, end, num_columns)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Column store for the forcing of a semi distributed layout. All text files
+of the layout (one per subcatchment and data type plus the discharge) are
+converted into a single file. The file starts with a json header holding
+the column names, the valid length of every column, the first day, the
+sizes and heights of the subcatchments and the size and mtime of the source
+files. The header is followed by a float64 matrix with one contiguous row
+per (subcatchment, data type) column, which is memory mapped when the store
+is read. Reading a window of a column only touches the pages of this window.
+"""
+import datetime
+import json
+import os
+
+import numpy as np
+
+from forcing_cache import FORCING_BEGIN, check_window, node_comm, \
+    parse_text, temp_name, window_rows
+
+
+STORE_NAME = "forcing_store.dat"
+MAGIC = b"FORCINGSTORE2\n"
+DISCHARGE = "dis_eval"
+
+
+def text_name(subcatchment, data_type):
+    """
+    Returns the name of the text file for a subcatchment and data type.
+
+    :param subcatchment: name of the subcatchment or None for the discharge
+    :param data_type: e.g. "T_avg" or "prec"
+    :return: file name
+    """
+    if subcatchment is None:
+        return data_type + "_kaemmerzell_79_89.txt"
+    return data_type + "_kaemmerzell_" + subcatchment + "_79_89.txt"
+
+
+def column_name(subcatchment, data_type):
+    """
+    Returns the name of a column in the store.
+
+    :param subcatchment: name of the subcatchment or None for the discharge
+    :param data_type: e.g. "T_avg" or "prec"
+    :return: column name
+    """
+    if subcatchment is None:
+        return data_type
+    return subcatchment + "/" + data_type
+
+
+def layout_columns(subcatchment_names, input_data):
+    """
+    Lists all (subcatchment, data type) pairs of a layout, the discharge
+    comes last.
+
+    :param subcatchment_names: list of subcatchment names
+    :param input_data: list of data types
+    :return: list of tuples
+    """
+    columns = [(sub, data_type) for sub in subcatchment_names
+               for data_type in input_data]
+    columns.append((None, DISCHARGE))
+    return columns
+
+
+def source_stamp(file_name):
+    """
+    Size and modification time of a source file.
+
+    :param file_name: path of the text file
+    :return: [size, mtime_ns]
+    """
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def convert(store_name, subcatchment_names, input_data, sizes, heights):
+    """
+    Reads all text files of a layout and writes them into one store file.
+    Columns shorter than the longest one are padded with nan.
+
+    :param store_name: path of the store
+    :param subcatchment_names: list of subcatchment names
+    :param input_data: list of data types
+    :param sizes: dictionary with the subcatchment sizes in km²
+    :param heights: dictionary with the average subcatchment heights in m
+    :return: None
+    """
+    columns = layout_columns(subcatchment_names, input_data)
+    values = [parse_text(text_name(sub, data_type))
+              for sub, data_type in columns]
+    lengths = [len(column) for column in values]
+    matrix = np.full((len(columns), max(lengths)), np.nan)
+    for i, column in enumerate(values):
+        matrix[i, :len(column)] = column
+
+    header = {"columns": [column_name(sub, data_type)
+                          for sub, data_type in columns],
+              "lengths": lengths,
+              "days": matrix.shape[1],
+              "begin": FORCING_BEGIN.strftime("%Y-%m-%d"),
+              "sizes": {sub: sizes[sub] for sub in subcatchment_names},
+              "heights": {sub: heights[sub] for sub in subcatchment_names},
+              "sources": {text_name(sub, data_type):
+                          source_stamp(text_name(sub, data_type))
+                          for sub, data_type in columns}}
+    header = json.dumps(header).encode()
+    # Pad the header, so the matrix starts aligned
+    padding = -(len(MAGIC) + len(header) + 1) % 64
+    header += b" " * padding + b"\n"
+
+    temp_path = temp_name(store_name)
+    with open(temp_path, "wb") as store:
+        store.write(MAGIC)
+        store.write(header)
+        store.write(matrix.astype("<f8").tobytes())
+    os.replace(temp_path, store_name)
+
+
+class ForcingStore:
+    """
+    Read only view on a store file written by convert.
+    """
+    def __init__(self, store_name):
+        with open(store_name, "rb") as store:
+            if store.readline() != MAGIC:
+                raise ValueError(store_name + " is no forcing store")
+            header = store.readline()
+            offset = store.tell()
+        header = json.loads(header.decode())
+        self.columns = {name: i for i, name in enumerate(header["columns"])}
+        self.lengths = header["lengths"]
+        self.begin = datetime.datetime.strptime(header["begin"], "%Y-%m-%d")
+        self.sizes = header["sizes"]
+        self.heights = header["heights"]
+        self.sources = header["sources"]
+        self.matrix = np.memmap(store_name, dtype="<f8", mode="r",
+                                offset=offset,
+                                shape=(len(self.columns), header["days"]))
+
+    def column(self, subcatchment, data_type):
+        """
+        Returns the values of one column without the nan padding.
+
+        :param subcatchment: name of the subcatchment or None for discharge
+        :param data_type: e.g. "T_avg" or "prec"
+        :return: read only np.array
+        """
+        i = self.columns[column_name(subcatchment, data_type)]
+        return self.matrix[i, :self.lengths[i]]
+
+    def window(self, subcatchment, data_type, begin, end, missing_days=0):
+        """
+        Returns a copy of the days between begin and end (included) of one
+        column. Raises a ValueError if the column does not cover them.
+
+        :param subcatchment: name of the subcatchment or None for discharge
+        :param data_type: e.g. "T_avg" or "prec"
+        :param begin: first day needed
+        :param end: last day needed
+        :param missing_days: number of days the column may end before end,
+        these days get the last value of the column
+        :return: np.array
+        """
+        name = column_name(subcatchment, data_type)
+        i = self.columns[name]
+        check_window(name, self.lengths[i], begin, end, self.begin,
+                     missing_days)
+        first, stop = window_rows(begin, end, self.begin)
+        values = self.matrix[i, first:min(stop, self.lengths[i])]
+        return np.pad(values, (0, stop - first - len(values)), mode="edge")
+
+    def is_current(self, subcatchment_names, input_data, sizes, heights):
+        """
+        Checks if the store holds all columns of a layout and if none of
+        the text files has changed since the conversion.
+
+        :return: bool
+        """
+        for sub, data_type in layout_columns(subcatchment_names, input_data):
+            if column_name(sub, data_type) not in self.columns:
+                return False
+            name = text_name(sub, data_type)
+            if os.path.exists(name) and \
+                    source_stamp(name) != self.sources.get(name):
+                return False
+        return all(self.sizes.get(sub) == sizes[sub] and
+                   self.heights.get(sub) == heights[sub]
+                   for sub in subcatchment_names)
+
+
+def open_store(store_name, subcatchment_names, input_data, sizes, heights):
+    """
+    Opens the store of a layout and converts the text files first, if the
+    store is missing or outdated. With mpirun only the first rank of a node
+    converts, the other ranks wait for it.
+
+    :return: ForcingStore
+    """
+    def current():
+        try:
+            return ForcingStore(store_name).is_current(
+                subcatchment_names, input_data, sizes, heights)
+        except (OSError, ValueError):
+            return False
+
+    comm = node_comm()
+    if comm is None or comm.rank == 0:
+        if not current():
+            convert(store_name, subcatchment_names, input_data, sizes,
+                    heights)
+    if comm is not None:
+        comm.Barrier()
+    return ForcingStore(store_name)
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+"""
+Result format for samplings with many saved simulations. The spotpy csv
+files hold every simulated day as text (simulation_0, simulation_1, ...),
+so 100000 runs give gigabytes, which take ages to write and to parse.
+
+The store splits the results in two parts:
+
+- dbname_rank<r>.csv: a small table like the spotpy csv file, but without
+  the simulation columns (like1, like2, ..., par..., chain)
+- dbname_rank<r>/block_00000.npy, ...: the simulations as float32 blocks
+  of block_size rows, in the order of the table, which are only appended
+
+merge combines the parts of all ranks into dbname.csv and dbname.npy, load
+returns the table and the simulations (memory mapped). Row i of the
+simulations belongs to row i of the table.
+
+For the uncertainty bands only the simulations of the best runs are
+needed. With keep=K, the store writes the table for all runs, but keeps
+only the simulations of the K best runs of a rank in a heap. Only runs
+above the threshold of the store (the save threshold of the sampler) get
+into the heap. They are written to dbname_rank<r>_best.csv and .npy (table
+rows and simulations of the kept runs, best first) and merged to
+dbname_best.csv and .npy, which load("dbname_best") reads.
+
+The model hands the runs to the store in its save method, which spotpy
+calls if the sampler uses dbformat="custom". Spotpy only does this for the
+runs above the save threshold, so without keep the table holds only those.
+With keep, ResumableRope hands every run to the store (see
+ResumableRope.save), so the table holds all runs.
+
+The model scripts only use the store with the environment variable
+RESULTS=store. By default they write the csv file of spotpy, which the
+scripts for the analysis (stat_and_hist.py, spotpy_csv_shrinker.py, ...)
+read.
+"""
+import glob
+import heapq
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+
+def part_name(dbname, rank):
+    """
+    :return: name of the part of a rank (without extension)
+    """
+    return "{}_rank{}".format(dbname, rank)
+
+
+def block_name(part, block):
+    """
+    :return: file name of a block of simulations
+    """
+    return os.path.join(part, "block_{:05d}.npy".format(block))
+
+
+def save_atomic(file_name, array):
+    """
+    Saves an array, so a kill while writing does not leave a broken file.
+    """
+    with open(file_name + ".tmp", "wb") as npy_file:
+        np.save(npy_file, array)
+    os.replace(file_name + ".tmp", file_name)
+
+
+class Reservoir:
+    """
+    Keeps the simulations of the best runs in a heap of bounded size.
+    """
+    def __init__(self, size, rank_by=None):
+        """
+        :param size: number of simulations kept
+        :param rank_by: index of the objective function the runs are ranked
+        by, None ranks them by their worst objective function
+        """
+        self.size = size
+        self.rank_by = rank_by
+        # Heap of (rank, number of the run, line of the table, simulation),
+        # the worst of the kept runs is the first item
+        self.heap = []
+        self.pushed = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def rank(self, like):
+        """
+        :param like: objective functions of a run
+        :return: float, higher is better
+        """
+        like = np.atleast_1d(np.asarray(like, dtype=float))
+        value = like.min() if self.rank_by is None else like[self.rank_by]
+        return -np.inf if np.isnan(value) else float(value)
+
+    def push(self, like, line, simulation):
+        """
+        Keeps a run, if it is better than the worst one kept.
+
+        :param like: objective functions of the run
+        :param line: line of the run in the table
+        :param simulation: simulated series of the run
+        :return: None
+        """
+        rank = self.rank(like)
+        self.pushed += 1
+        if len(self.heap) == self.size and rank <= self.heap[0][0]:
+            return
+        item = (rank, self.pushed, line,
+                np.array(simulation, dtype=np.float32))
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, item)
+        else:
+            heapq.heapreplace(self.heap, item)
+
+    def save(self, name, header):
+        """
+        Writes the kept runs, best first, to name.csv and name.npy.
+
+        :param name: file name without extension
+        :param header: header line of the table
+        :return: None
+        """
+        items = sorted(self.heap, reverse=True)
+        if not items:
+            return
+        save_atomic(name + ".npy", np.array([item[3] for item in items]))
+        with open(name + ".csv.tmp", "w") as table:
+            table.write(header)
+            table.writelines(item[2] for item in items)
+        os.replace(name + ".csv.tmp", name + ".csv")
+
+    def load(self, name):
+        """
+        Adds the runs of name.csv and name.npy written by save.
+
+        :param name: file name without extension
+        :return: None
+        """
+        simulations = np.load(name + ".npy")
+        with open(name + ".csv") as table:
+            likes = sum(column.startswith("like")
+                        for column in table.readline().split(","))
+            for line, simulation in zip(table, simulations):
+                like = [float(value) for value in line.split(",")[:likes]]
+                self.push(like, line, simulation)
+
+
+class SimulationStore:
+    """
+    Writes the results of one rank, see the module docstring.
+    """
+    def __init__(self, dbname, parnames, rank=None, block_size=1000,
+                 save_sim=True, keep=None, rank_by=None, threshold=None):
+        """
+        :param dbname: name of the results without extension
+        :param parnames: names of the parameters
+        :param rank: rank of the process, None takes it from MPI
+        :param block_size: number of simulations per block file
+        :param save_sim: False writes only the table
+        :param keep: number of best runs whose simulations are kept, None
+        keeps the simulations of all runs
+        :param rank_by: see Reservoir
+        :param threshold: save threshold of the sampler (one value or one
+        per objective function), only runs above it get into the reservoir
+        """
+        if rank is None:
+            rank = int(os.environ.get("OMPI_COMM_WORLD_RANK", 0))
+        self.part = part_name(dbname, rank)
+        self.parnames = list(parnames)
+        self.block_size = block_size
+        self.save_sim = save_sim
+        # Number of saved runs, index of the block in the buffer and its
+        # number of runs
+        self.rows = 0
+        self.block = 0
+        self.buffer = None
+        self.count = 0
+        self.table = None
+        self.header = None
+        self.append = False
+        self.reservoir = None if keep is None else Reservoir(keep, rank_by)
+        self.threshold = threshold
+
+    @property
+    def all_runs(self):
+        """
+        :return: True if the store wants every run, not only the runs above
+        the save threshold
+        """
+        return self.reservoir is not None
+
+    def above_threshold(self, like):
+        """
+        Compares the objective functions of a run with the threshold like
+        spotpy does.
+
+        :param like: np.array with the objective functions
+        :return: True if the run is above the threshold
+        """
+        if self.threshold is None:
+            return True
+        threshold = np.atleast_1d(np.asarray(self.threshold, dtype=float))
+        if len(threshold) == 1:
+            return bool(like[0] > threshold[0])
+        return all(value > limit for value, limit in zip(like, threshold))
+
+    def open_table(self, likes):
+        """
+        Opens the table and writes its header, if it is new.
+
+        :param likes: number of objective functions
+        :return: None
+        """
+        header = ["like{}".format(i + 1) for i in range(likes)]
+        header += ["par" + name for name in self.parnames] + ["chain"]
+        self.header = ",".join(header) + "\n"
+        if self.append:
+            self.table = open(self.part + ".csv", "a")
+        else:
+            self.table = open(self.part + ".csv", "w")
+            self.table.write(self.header)
+
+    def save(self, like, params, simulation, chains=1):
+        """
+        Saves a run.
+
+        :param like: objective function (one value or list)
+        :param params: parameter values of the run
+        :param simulation: simulated series of the run
+        :param chains: chain of the sampler
+        :return: None
+        """
+        like = np.atleast_1d(np.asarray(like, dtype=float))
+        if self.table is None:
+            self.open_table(len(like))
+        values = list(like) + [float(value) for value in params] + [chains]
+        line = ",".join(map(repr, values)) + "\n"
+        self.table.write(line)
+        self.rows += 1
+        if not self.save_sim:
+            return
+        if self.reservoir is not None:
+            if self.above_threshold(like):
+                self.reservoir.push(like, line, simulation)
+            return
+        simulation = np.asarray(simulation, dtype=np.float32)
+        if self.buffer is None:
+            os.makedirs(self.part, exist_ok=True)
+            self.buffer = np.empty((self.block_size, len(simulation)),
+                                   dtype=np.float32)
+        self.buffer[self.count] = simulation
+        self.count += 1
+        if self.count == self.block_size:
+            save_atomic(block_name(self.part, self.block), self.buffer)
+            self.block += 1
+            self.count = 0
+
+    def flush(self):
+        """
+        Writes everything saved so far to the disk. The block, which is not
+        full yet, is written as a shorter block and overwritten later. The
+        reservoir is written completely.
+
+        :return: dict with the position, which resume can return to
+        """
+        table_size = None
+        if self.table is not None:
+            self.table.flush()
+            os.fsync(self.table.fileno())
+            table_size = self.table.tell()
+        if self.count:
+            save_atomic(block_name(self.part, self.block),
+                        self.buffer[:self.count])
+        if self.reservoir is not None and self.header is not None:
+            self.reservoir.save(self.part + "_best", self.header)
+        return dict(rows=self.rows, table_size=table_size)
+
+    def resume(self, position):
+        """
+        Returns to a position of flush. Runs saved after it are removed.
+
+        :param position: dict returned by flush
+        :return: None
+        """
+        if position["table_size"] is None:
+            return
+        os.truncate(self.part + ".csv", position["table_size"])
+        self.append = True
+        self.rows = position["rows"]
+        if not self.save_sim:
+            return
+        if self.reservoir is not None:
+            if os.path.exists(self.part + "_best.csv"):
+                self.reservoir.load(self.part + "_best")
+            return
+        self.block, self.count = divmod(self.rows, self.block_size)
+        for file_name in glob.glob(os.path.join(self.part, "block_*.npy")):
+            block = int(os.path.basename(file_name)[len("block_"):-4])
+            if block > self.block or (block == self.block and
+                                      not self.count):
+                os.remove(file_name)
+        if self.count:
+            last = np.load(block_name(self.part, self.block))
+            self.buffer = np.empty((self.block_size, last.shape[1]),
+                                   dtype=np.float32)
+            self.buffer[:self.count] = last[:self.count]
+
+    def close(self):
+        """
+        Writes the rest of the runs and closes the table.
+
+        :return: None
+        """
+        self.flush()
+        if self.table is not None:
+            self.table.close()
+            self.table = None
+            self.append = True
+
+
+def merge(dbname, remove_parts=True, keep=None, rank_by=None):
+    """
+    Combines the parts of all ranks into dbname.csv and dbname.npy (and
+    the reservoirs into dbname_best.csv and dbname_best.npy).
+
+    :param dbname: name of the results without extension
+    :param remove_parts: True deletes the parts after merging
+    :param keep: number of best runs kept of the reservoirs of all ranks,
+    None keeps all of them
+    :param rank_by: see Reservoir
+    :return: number of runs
+    """
+    pattern = re.compile(re.escape(dbname) + r"_rank\d+\.csv")
+    parts = sorted(name[:-4] for name in glob.glob(dbname + "_rank*.csv")
+                   if pattern.fullmatch(name))
+    if not parts:
+        raise FileNotFoundError("No parts of {} to merge".format(dbname))
+    # The tables are copied as text, so the values are not rounded
+    rows = []
+    with open(dbname + ".csv", "w") as table:
+        for part in parts:
+            with open(part + ".csv") as part_table:
+                header = part_table.readline()
+                if not rows:
+                    first_header = header
+                    table.write(header)
+                elif header != first_header:
+                    raise ValueError("{} has other columns than {}".format(
+                        part, parts[0]))
+                rows.append(0)
+                for line in part_table:
+                    table.write(line)
+                    rows[-1] += 1
+    blocks = [sorted(glob.glob(os.path.join(part, "block_*.npy")))
+              for part in parts]
+    if any(blocks):
+        first = next(part_blocks[0] for part_blocks in blocks if part_blocks)
+        days = np.load(first, mmap_mode="r").shape[1]
+        simulations = np.lib.format.open_memmap(
+            dbname + ".npy", mode="w+", dtype=np.float32,
+            shape=(sum(rows), days))
+        row = 0
+        for part, part_rows, part_blocks in zip(parts, rows, blocks):
+            start = row
+            for file_name in part_blocks:
+                block = np.load(file_name, mmap_mode="r")
+                simulations[row:row + len(block)] = block
+                row += len(block)
+            if row - start != part_rows:
+                raise ValueError("{} has {} runs, but {} simulations".format(
+                    part, part_rows, row - start))
+        simulations.flush()
+        del simulations
+    best = [part + "_best" for part in parts
+            if os.path.exists(part + "_best.csv")]
+    if best:
+        reservoir = Reservoir(keep or float("inf"), rank_by)
+        for name in best:
+            reservoir.load(name)
+        reservoir.save(dbname + "_best", first_header)
+    if remove_parts:
+        for part, part_blocks in zip(parts, blocks):
+            for file_name in part_blocks:
+                os.remove(file_name)
+            if os.path.isdir(part):
+                os.rmdir(part)
+            os.remove(part + ".csv")
+        for name in best:
+            os.remove(name + ".csv")
+            os.remove(name + ".npy")
+    return sum(rows)
+
+
+def load(dbname, mmap=True):
+    """
+    Loads merged results.
+
+    :param dbname: name of the results without extension
+    :param mmap: True maps the simulations instead of reading them
+    :return: pd.DataFrame with the table, np.array with one simulation per
+    row of the table (None if the simulations were not saved)
+    """
+    table = pd.read_csv(dbname + ".csv")
+    simulations = None
+    if os.path.exists(dbname + ".npy"):
+        simulations = np.load(dbname + ".npy",
+                              mmap_mode="r" if mmap else None)
+    return table, simulations
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Pool of local processes as a backend for the samplers of spotpy, for
+computers without MPI. Every worker builds its own model once, when the
+pool starts, and keeps it for all of its runs. The parameter sets are sent
+in chunks, which the workers run with simulation_batch, and the results
+come back in the order of the parameter sets.
+
+The pool uses the fork start method, so the workers know the model class
+and the globals of the model script (e.g. the file names of the forcing
+data in __main__). It is therefore not available on Windows.
+
+The number of processes is set for a whole job with the environment
+variable PROCESSES, "auto" uses every core.
+"""
+import multiprocessing
+import os
+
+import numpy as np
+
+
+# Model of a worker process, built by init_worker
+worker_model = None
+
+
+def processes_from_environ(default=1):
+    """
+    :param default: number of processes, if PROCESSES is not set
+    :return: number of processes given by the environment variable PROCESSES
+    """
+    value = os.environ.get("PROCESSES", str(default))
+    if value.lower() == "auto":
+        return os.cpu_count() or 1
+    return max(int(value), 1)
+
+
+def init_worker(factory, args, kwargs):
+    """
+    Builds the model of a worker process.
+
+    :param factory: model class (or function returning a model)
+    :param args: positional arguments of factory
+    :param kwargs: keyword arguments of factory
+    :return: None
+    """
+    global worker_model
+    worker_model = factory(*args, **kwargs)
+
+
+def run_chunk(matrix):
+    """
+    Runs a chunk of parameter sets with the model of the worker process.
+
+    :param matrix: np.array with one parameter set per row
+    :return: np.array with one simulation per row
+    """
+    return worker_model.simulation_batch(matrix)
+
+
+class ProcessRepeat:
+    """
+    Replaces the repeat of a spotpy sampler (spotpy.parallel.sequential),
+    so the runs are spread over a pool of local processes.
+    """
+    def __init__(self, factory, args=(), kwargs=None, processes=None,
+                 chunk_size=None):
+        """
+        :param factory: model class (or function returning a model), called
+        once in every worker process
+        :param args: positional arguments of factory
+        :param kwargs: keyword arguments of factory
+        :param processes: number of worker processes, None uses every core
+        :param chunk_size: number of parameter sets sent to a worker at
+        once, None gives every worker about four chunks of each call
+        """
+        self.factory = factory
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.phase = None
+        self.pool = None
+
+    def is_idle(self):
+        return True
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def setphase(self, phasename):
+        self.phase = phasename
+
+    def start(self):
+        # The pool is started with the first call, so the repeat can replace
+        # the one of a sampler after it was started
+        pass
+
+    def start_pool(self):
+        """
+        Starts the worker processes, which build their models.
+
+        :return: None
+        """
+        context = multiprocessing.get_context("fork")
+        self.pool = context.Pool(self.processes, initializer=init_worker,
+                                 initargs=(self.factory, self.args,
+                                           self.kwargs))
+
+    def chunks(self, jobs):
+        """
+        :param jobs: list of (run id, parameter set)
+        :return: list of lists of jobs
+        """
+        size = self.chunk_size or max(
+            min(len(jobs) // (4 * self.processes), 1000), 1)
+        return [jobs[start:start + size]
+                for start in range(0, len(jobs), size)]
+
+    def __call__(self, jobs):
+        """
+        :param jobs: iterable of (run id, parameter set)
+        :return: generator of (run id, parameter set, simulation)
+        """
+        chunks = self.chunks(list(jobs))
+        if not chunks:
+            return
+        if self.pool is None:
+            self.start_pool()
+        matrices = [np.array([params for _, params in chunk], dtype=float)
+                    for chunk in chunks]
+        for chunk, simulations in zip(chunks,
+                                      self.pool.imap(run_chunk, matrices)):
+            for (run_id, params), simulation in zip(chunk, simulations):
+                yield run_id, params, simulation
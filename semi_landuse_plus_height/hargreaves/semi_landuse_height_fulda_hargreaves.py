@@ -4,9 +4,21 @@ Created on Nov 29 13:46 2017
 @author(s): Florian U. Jehn
 """
 from cell_template import CellTemplate
+from evaluation_data import EvaluationData
+from forcing_store import DISCHARGE, STORE_NAME, open_store
+from storage_state import StorageState
+from discharge_recorder import DischargeRecorder
+from solver_ladder import SolverLadder
+from parameter_bounds import BoundsEnforcer, ParameterOutOfBounds
+from spinup import Spinup
+from early_stop import EarlyStop
+from surrogate import Screen, ScreenedRepeat
+from process_pool import ProcessRepeat, processes_from_environ
+from simulation_store import SimulationStore, merge
 import cmf
 import datetime
 import os
+import sys
 import numpy as np
 import spotpy
 from dateutil.relativedelta import relativedelta
@@ -14,12 +26,29 @@ from dateutil.relativedelta import relativedelta
 
 class SemiDisLanduse:
     def __init__(self, begin: datetime.datetime, end: datetime.datetime,
-                 subcatchment_names):
+                 subcatchment_names, persistent_connections=True,
+                 bounds="reject", spinup="year", warmup_days=90,
+                 early_stop=None, early_stop_margin=None):
         """
 
         :param begin:
         :param end:
+        :param persistent_connections: Create the connections only once and
+        change their parameters for every run. False creates them again for
+        every run.
+        :param bounds: "reject", "clip" or "reflect" parameter values outside
+        of their bounds
+        :param spinup: "year" starts every run with the fixed initial volumes
+        a year before begin, "equilibrium" with the steady state of the
+        parameters warmup_days before begin
+        :param warmup_days: length of the warm up in mode equilibrium
+        :param early_stop: save threshold of the sampler, runs which can not
+        reach it are stopped early. None simulates all runs completely
+        :param early_stop_margin: margin for stopping runs, which are very
+        unlikely to reach the threshold, None stops only runs which can not
+        reach it
         """
+        self.persistent_connections = persistent_connections
         project = cmf.project()
         # Add outlet
         self.outlet = project.NewOutlet("Outlet", 50, 0, 0)
@@ -28,8 +57,36 @@ class SemiDisLanduse:
         self.end = end
         self.subcatchment_names = subcatchment_names
         self.dis_eval, self.subcatchments = self.load_data()
+        # Observed discharge and its statistics for the objective function,
+        # plus one day because as in lists the last entry is not included in
+        # datetime objects
+        self.evaluation_data = EvaluationData(self.dis_eval[
+            self.begin:self.end + datetime.timedelta(days=1)])
         self.params = self.create_params()
         self.cell_list = self.create_cells()
+        # Initial volumes of all storages, every run starts from them
+        self.initial_state = StorageState(project)
+        # Solvers for all runs, the ladder tries them one after the other
+        # until one of them finishes a run
+        self.ladder = SolverLadder(self.project, self.create_solver)
+        # Repairs or rejects parameter values outside of their bounds
+        self.bounds = BoundsEnforcer(self.params, bounds)
+        # Initial state of every run, the mean observed runoff of the spin-up
+        # year is used for the steady state of the parameters
+        spinup_begin = project.meteo_stations[0].T.begin.AsPython()
+        self.spinup = Spinup(project, [self.outlet], spinup_begin, self.begin,
+                             self.dis_eval[spinup_begin:self.begin].mean(), spinup,
+                             warmup_days)
+        # Stops runs, which can not reach the save threshold of the sampler.
+        # CMF outputs m³/day, the observed discharge is in mm/day
+        self.early_stop = EarlyStop(self.evaluation_data, early_stop,
+                                    early_stop_margin,
+                                    scale=1000 / (562.41 * 1e6))
+        # Surrogate, which screens the candidates of ROPE (see surrogate.py)
+        self.screen = None
+        # Store for the results, if the sampler uses dbformat="custom"
+        # (see simulation_store.py)
+        self.store = None
         cmf.set_parallel_threads(1)
 
     def create_cells(self):
@@ -53,7 +110,8 @@ class SemiDisLanduse:
         :return: None
         """
         for cell in self.cell_list:
-            cell.set_parameters(params)
+            cell.set_parameters(
+                params, rebuild=not self.persistent_connections)
 
     def load_data(self):
         """
@@ -75,29 +133,36 @@ class SemiDisLanduse:
         # Different input data types (except discharge)
         input_data = ["T_avg", "T_min", "T_max", "prec"]
 
-        # Read in the data for all subcatchments separately
+        # All text files of the layout are converted once into a single
+        # column store, which is then read for all cells in one go
+        store = open_store(STORE_NAME, self.subcatchment_names, input_data,
+                           sizes, heights)
+
         subcatchments = {}
         for sub in self.subcatchment_names:
-            subcatchments[sub] = {"size": sizes[sub]}
-            subcatchments[sub]["height"] = heights[sub]
+            subcatchments[sub] = {"size": store.sizes[sub]}
+            subcatchments[sub]["height"] = store.heights[sub]
             subcatchments[sub]["data"] = {}
 
             for data_type in input_data:
-                name = data_type + "_kaemmerzell_" + sub + "_79_89.txt"
-                timeseries = self.read_timeseries(name)
+                timeseries = self.make_timeseries(store, sub, data_type)
                 subcatchments[sub]["data"][data_type] = timeseries
 
-        dis_eval = self.read_timeseries("dis_eval_kaemmerzell_79_89.txt",
+        dis_eval = self.make_timeseries(store, None, DISCHARGE,
                                         convert=True)
 
         return dis_eval, subcatchments
 
-    def read_timeseries(self, timeseries_name, convert=False):
+    def make_timeseries(self, store, subcatchment, data_type,
+                        convert=False, missing_days=0):
         """
-        Loads in a timeseries and returns it
+        Creates a timeseries from the simulated days of a store column
 
-        :param timeseries_name:
+        :param store: ForcingStore
+        :param subcatchment: name of the subcatchment (None for discharge)
+        :param data_type: name of the data type
         :param convert: Discharge needs to be converted.
+        :param missing_days: Days the data may end before self.end
 
         :return: timeseries
         """
@@ -106,9 +171,10 @@ class SemiDisLanduse:
         begin = self.begin - relativedelta(years=1)
         step = datetime.timedelta(days=1)
 
-        timeseries = cmf.timeseries(begin, step)
-        timeseries.extend(float(value.strip("\n")) for value in open(
-            timeseries_name))
+        # Only the simulated days are kept
+        values = store.window(subcatchment, data_type, begin, self.end,
+                              missing_days)
+        timeseries = cmf.timeseries.from_array(begin, step, values)
 
         if convert:
             area_catchment = 562.41
@@ -157,60 +223,89 @@ class SemiDisLanduse:
                   ]
         return params
 
-    def run_model(self):
+    def create_solver(self):
+        """
+        Creates the solver for differential equations. The model creates it
+        only once and uses it for all runs, it is the first rung of the
+        solver ladder.
+
+        :return: cmf.CVodeIntegrator
+        """
+        return cmf.CVodeIntegrator(self.project, 1e-8)
+
+    def run_model(self, parameters=None):
         """
         Starts the model. Used by spotpy
+
+        :param parameters: dictionary with the parameters of the run, only
+        used for the records of failed attempts
         """
+        # The solvers of the ladder are tried one after the other, until one
+        # of them finishes the run
         try:
-            # Create a solver for differential equations
-            solver = cmf.CVodeIntegrator(self.project, 1e-8)
+            return self.ladder.run(self.run_solver, parameters)
+        # Return an nan - array when a runtime error occurs in all solvers
+        # (solver errors and runs stopped by the watchdogs)
+        except RuntimeError:
+            return self.evaluation_data.nan_result()
 
-            # New time series for model results
-            dis_sim = cmf.timeseries(self.begin, cmf.day)
-            # starts the solver and calculates the daily time steps
-            end = self.end
+    def run_solver(self, solver, watchdog):
+        """
+        Runs the model once with one solver of the ladder.
 
-            for t in solver.run(self.project.meteo_stations[0].T.begin,
-                                end, cmf.day):
+        :param solver: cmf integrator of the project
+        :param watchdog: Watchdog with the limits for the solver
+        :return: np.array with the discharge of every day
+        """
+        # Start every parameter set from the initial volumes or from the
+        # steady state of its parameters
+        self.spinup.restore(self.initial_state, solver)
+        self.early_stop.start()
 
-                # Fill the results (first year is included but not used to
-                # calculate the NS)
-                if t >= self.begin:
-                    dis_sim.add(self.outlet.waterbalance(t))
+        # Buffer for the model results, allocated for all days at once
+        dis_sim = DischargeRecorder(self.begin, self.end)
+        # starts the solver and calculates the daily time steps
+        end = self.end
 
-            return dis_sim
-        # Return an nan - array when a runtime error occurs
-        except RuntimeError:
-            dis_sim = np.array(self.dis_eval[
-                            self.begin:self.end + datetime.timedelta(days=1)])\
-                      * np.nan
-            return dis_sim
+        for t in watchdog.run(solver, end, cmf.day):
+
+            # Fill the results (first year is included but not used to
+            # calculate the NS)
+            if t >= self.begin:
+                q = self.outlet.waterbalance(t)
+                dis_sim.add(q)
+                # The rest of the run stays nan
+                if not self.early_stop.add(q):
+                    break
+
+        return dis_sim.values
 
     def simulation(self, vector):
         """
         SpotPy expects a method simulation. This methods calls set_parameters
         and run_models, so SpotPy is satisfied
         """
+        # Repair or reject values outside of the bounds of the parameters
+        try:
+            vector = self.bounds.apply(vector)
+        except ParameterOutOfBounds:
+            return self.evaluation_data.nan_result()
         paramdict = dict((pp.name, v) for pp, v in zip(self.params, vector))
         self.set_parameters(paramdict)
-        discharge = self.run_model()
-        discharge = np.array(discharge)
+        discharge = self.run_model(paramdict)
         # CMF outputs discharge in m³/day
         # Measured discharge is in m³/s but is internally converted to mm
-        # Convert CMF output to mm as well
+        # Convert CMF output to mm as well (in place)
         area_catchment = 562.41
-        discharge = (discharge * 1000) / (area_catchment * 1e6)
+        discharge *= 1000
+        discharge /= area_catchment * 1e6
         return discharge
 
     def evaluation(self):
         """
         For Spotpy
         """
-        # plus one day because as in lists the last entry is not included in
-        # datetime objects
-        dis_eval = self.dis_eval[self.begin:self.end +
-                                 datetime.timedelta(days=1)]
-        return np.array(dis_eval)
+        return self.evaluation_data.observed
 
     def parameters(self):
         """
@@ -218,37 +313,81 @@ class SemiDisLanduse:
         """
         return spotpy.parameter.generate(self.params)
 
-    @staticmethod
-    def objectivefunction(simulation, evaluation):
+    def objectivefunction(self, simulation, evaluation, params=None):
         """
         For Spotpy
         """
-        # Slice the arrays to only use the days of the calibration period
-        # for objective function
-        evaluation_calibration = evaluation[:1827]
-        evaluation_validation = evaluation[1827:]
-        simulation_calibration = simulation[:1827]
-        simulation_validation = simulation[1827:]
-
-        ns_calibration = spotpy.objectivefunctions.kge(
-                                                        evaluation_calibration,
-                                                        simulation_calibration)
-        ns_validation = spotpy.objectivefunctions.kge(
-                                                        evaluation_validation,
-                                                        simulation_validation)
-        # if ns_calibration > 0:
-        #     plt.plot(simulation * 86400, label="simulation_"+str(
-        #         ns_calibration),
-        #              alpha=0.7)
-        #     plt.plot(evaluation * 86400, label="evaluation", alpha=0.7)
-        #     plt.plot(model.ET, label="ET", alpha=0.7)
-        #     plt.legend()
-        #     name = "test_" + str(datetime.datetime.timestamp(
-        #         datetime.datetime.now()))+".jpg"
-        #     plt.savefig(name, dpi=300)
-        #     plt.close()
-
-        return [ns_calibration, ns_validation]
+        # Candidates rejected by the surrogate were not run, they are ranked
+        # below all runs
+        if self.screen is not None and params is not None:
+            score = self.screen.score(params[0])
+            if score is not None:
+                return score
+        # Runs stopped early are ranked below all finished runs
+        if self.early_stop.stopped_early(simulation):
+            like = self.early_stop.score(simulation)
+        else:
+            # Calibration and validation period, the statistics of the
+            # observed discharge are calculated once in __init__
+            like = self.evaluation_data.for_evaluation(evaluation).kge(
+                simulation)
+        # The surrogate learns the objective function of every run
+        if self.screen is not None and params is not None:
+            self.screen.learn(params[0], like)
+        return like
+
+    def simulation_batch(self, matrix):
+        """
+        Runs many parameter sets, one per row of matrix. The bounds of all
+        sets are checked at once.
+
+        :param matrix: np.array with one parameter set per row
+        :return: np.array with the discharge of every day, one row per
+        parameter set
+        """
+        matrix, valid = self.bounds.apply_batch(matrix)
+        result = np.full((len(matrix), len(self.evaluation_data.observed)),
+                         np.nan)
+        for index in np.flatnonzero(valid):
+            paramdict = dict((pp.name, v)
+                             for pp, v in zip(self.params, matrix[index]))
+            self.set_parameters(paramdict)
+            result[index] = self.run_model(paramdict)
+        # Convert the CMF output from m³/day to mm/day like simulation
+        area_catchment = 562.41
+        result *= 1000 / (area_catchment * 1e6)
+        return result
+
+    def objectivefunction_batch(self, simulations, evaluation):
+        """
+        Objective function of many runs at once, the periods of all runs
+        are scored together.
+
+        :param simulations: np.array with one simulation per row
+        :param evaluation: observed discharge
+        :return: np.array with one row per run and one column per period
+        """
+        simulations = np.array(simulations, dtype=np.float64, ndmin=2)
+        result = self.evaluation_data.for_evaluation(
+            evaluation).score_batch(simulations, "kge")
+        # Runs stopped early are ranked below all finished runs
+        for index, simulation in enumerate(simulations):
+            if self.early_stop.stopped_early(simulation):
+                result[index] = self.early_stop.score(simulation)
+        return result
+
+    def save(self, objectivefunctions, parameter, simulations, chains=1):
+        """
+        Called by spotpy for the runs above the save threshold, if the
+        sampler uses dbformat="custom".
+
+        :param objectivefunctions: objective functions of the run
+        :param parameter: parameter values of the run
+        :param simulations: simulated discharge of the run
+        :param chains: chain of the sampler
+        :return: None
+        """
+        self.store.save(objectivefunctions, parameter, simulations, chains)
 
 
 if __name__ == '__main__':
@@ -262,23 +401,65 @@ if __name__ == '__main__':
 
     runs = 100000
 
+    # Continue an interrupted sampling from its csv file and checkpoint
+    # (see resumable_rope.py)
+    resume = "--resume" in sys.argv
+    if resume:
+        sys.argv.remove("--resume")
+
     # File names of the forcing data
     subcatchment_names = ["grass_high", "wood_high", "rest_high",
                           "crops_high", "grass_low",
                           "wood_low", "rest_low", "crops_low"]
 
     # import algorithm
-    from spotpy.algorithms import rope as sampler
+    from resumable_rope import ResumableRope as sampler
 
     # Find out if the model should run parallel (for supercomputer)
     parallel = 'mpi' if 'OMPI_COMM_WORLD_SIZE' in os.environ else 'seq'
 
+    # Runs below the threshold in one of the periods are not saved. With
+    # EARLY_STOP=<threshold> the model stops runs as soon as they can not
+    # reach it anymore (see early_stop.py)
+    save_threshold = [0.0, 0.0]
+
     # Create the model
     model = SemiDisLanduse(datetime.datetime(begin, 1, 1),
                            datetime.datetime(end, 12, 31),
                            subcatchment_names)
-    sampler = sampler(model, parallel=parallel,
-                      dbname="semi_dis_landuse_height_hargreaves",
-                      dbformat="csv", save_sim=True, save_threshold=[0, 0])
-    sampler.sample(runs, subsets=30)
+    # Spotpy writes the runs to a csv file. With RESULTS=store the
+    # parameters and objective functions are saved in a table and the
+    # simulations in binary blocks instead (see simulation_store.py)
+    dbname = "semi_dis_landuse_height_hargreaves"
+    results = os.environ.get("RESULTS", "csv")
+    sampler = sampler(model, parallel=parallel, dbname=dbname,
+                      dbformat="custom" if results == "store" else "csv",
+                      save_sim=True, save_threshold=save_threshold)
+    # KEEP_SIMULATIONS=<K> keeps only the simulations of the K best
+    # runs above the save threshold. The table then holds all runs,
+    # also those below it
+    keep = int(os.environ.get("KEEP_SIMULATIONS", 0)) or None
+    if results == "store":
+        model.store = SimulationStore(
+            dbname, sampler.parnames, keep=keep, threshold=save_threshold)
+    # Without MPI the runs can be spread over a pool of local processes
+    # (environment variable PROCESSES), each with its own model
+    processes = processes_from_environ()
+    if parallel == 'seq' and processes > 1:
+        sampler.repeat = ProcessRepeat(
+            SemiDisLanduse, (model.begin, model.end, subcatchment_names),
+            processes=processes)
+    # Optional surrogate, which rejects candidates predicted to stay below
+    # the threshold (environment variable SURROGATE)
+    model.screen = Screen.from_environ(model, save_threshold)
+    if model.screen is not None:
+        sampler.repeat = ScreenedRepeat(sampler.repeat, model.screen)
+    sampler.sample(runs, subsets=30, resume=resume)
+    if model.store is not None:
+        # Only a finished sampling is merged, a stopped one is resumed
+        model.store.close()
+        if sampler.finished:
+            merge(dbname, keep=keep)
+    if model.screen is not None:
+        print(model.screen.summary())
     #print(cmf.describe(model.project))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Fallback ladder for parameter sets the default solver can not handle. A run
+is tried with one integrator after the other, until one of them finishes it:
+
+1. the solver of the model (CVODE with its default linear solver)
+2. CVODE with the dense linear solver and a tolerance of 1e-9, like the
+   params_list variant used before
+3. Heun's method with a fixed time step of 15 minutes, which can not get
+   stuck in tiny time steps, but is less accurate
+
+Every rung has its own Watchdog, so a rung that can not handle the
+parameter set fails fast and leaves time for the next one. All solvers are
+created once and used for all runs of the model.
+
+The ladder counts which rung finished the runs. Every failed attempt of a
+run is written as one json line to the log file of run_watchdog, together
+with the rung that finished the run in the end (null if none did).
+"""
+import functools
+import json
+
+import cmf
+
+from run_watchdog import Watchdog, LOG_FILE
+
+
+class SolverRung:
+    """
+    One integrator of the ladder with its own limits.
+    """
+    def __init__(self, name, create, watchdog):
+        """
+        :param name: name of the rung in the counts and records
+        :param create: function without arguments creating the integrator
+        :param watchdog: Watchdog with the limits for the integrator
+        """
+        self.name = name
+        self.create = create
+        self.watchdog = watchdog
+
+
+def dense_cvode(project, tolerance=1e-9):
+    """
+    Creates a CVODE integrator with the dense linear solver.
+
+    :param project: cmf project
+    :param tolerance: tolerance of the integrator
+    :return: cmf.CVodeIntegrator
+    """
+    solver = cmf.CVodeIntegrator(project, tolerance)
+    solver.LinearSolver = 0
+    return solver
+
+
+def default_rungs(project, create_solver):
+    """
+    Returns the rungs used by the models.
+
+    :param project: cmf project
+    :param create_solver: function creating the default solver of the model
+    :return: list of SolverRung
+    """
+    return [SolverRung("cvode", create_solver, Watchdog(log_file=None)),
+            # Checked every hour, so a stuck run is stopped early
+            SolverRung("cvode_dense",
+                       functools.partial(dense_cvode, project),
+                       Watchdog(max_seconds=120., check_interval=cmf.h,
+                                log_file=None)),
+            # Explicit steps never shrink, only the wall clock is limited
+            SolverRung("heun",
+                       functools.partial(cmf.HeunIntegrator, project),
+                       Watchdog(max_seconds=600., max_rhs_evals=None,
+                                min_step=None, fixed_step=15 * cmf.min,
+                                log_file=None))]
+
+
+class SolverLadder:
+    """
+    Tries the rungs one after the other, until one of them finishes a run.
+    """
+    def __init__(self, project, create_solver, rungs=None,
+                 log_file=LOG_FILE):
+        """
+        :param project: cmf project of the model
+        :param create_solver: function creating the default solver of the
+        model
+        :param rungs: list of SolverRung, None uses default_rungs
+        :param log_file: file for the records of failed attempts, None keeps
+        them only in self.records
+        """
+        self.rungs = rungs or default_rungs(project, create_solver)
+        self.solvers = [None] * len(self.rungs)
+        self.log_file = log_file
+        self.records = []
+        # Number of runs finished by every rung and of runs no rung finished
+        self.counts = dict.fromkeys([rung.name for rung in self.rungs], 0)
+        self.counts["failed"] = 0
+        self.last_rung = None
+
+    def solver(self, index):
+        """
+        Returns the integrator of a rung, it is created with the first run
+        that needs it.
+
+        :param index: index of the rung
+        :return: cmf integrator
+        """
+        if self.solvers[index] is None:
+            self.solvers[index] = self.rungs[index].create()
+        return self.solvers[index]
+
+    def clear(self):
+        """
+        Drops all integrators, the next runs create new ones.
+
+        :return: None
+        """
+        self.solvers = [None] * len(self.rungs)
+
+    def run(self, run_solver, parameters=None):
+        """
+        Runs the model with the rungs of the ladder, until one of them
+        finishes the run. The last error is raised if no rung finishes it.
+
+        :param run_solver: function (solver, watchdog) of the model, which
+        runs the model once and raises a RuntimeError if the run fails
+        :param parameters: dictionary with the parameters of the run, only
+        used for the records of failed attempts
+        :return: return value of run_solver
+        """
+        attempts = []
+        failure = None
+        self.last_rung = None
+        try:
+            for index, rung in enumerate(self.rungs):
+                solver = self.solver(index)
+                try:
+                    result = run_solver(solver, rung.watchdog)
+                except RuntimeError as error:
+                    record = rung.watchdog.record(error, parameters, solver)
+                    record["rung"] = rung.name
+                    attempts.append(record)
+                    failure = error
+                    continue
+                self.last_rung = rung.name
+                self.counts[rung.name] += 1
+                return result
+            self.counts["failed"] += 1
+            raise failure
+        finally:
+            self.write(attempts)
+
+    def write(self, attempts):
+        """
+        Keeps the records of the failed attempts of a run and appends them
+        to the log file.
+
+        :param attempts: list of records from Watchdog.record
+        :return: None
+        """
+        for record in attempts:
+            record["finished_by"] = self.last_rung
+        self.records.extend(attempts)
+        if self.log_file and attempts:
+            with open(self.log_file, "a") as log:
+                for record in attempts:
+                    log.write(json.dumps(record) + "\n")
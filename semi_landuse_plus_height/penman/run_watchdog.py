@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Watchdog for single model runs. Some parameter sets make CVODE shrink its
+time step to a few milliseconds, a run with such a set does not finish for
+hours (see "hängen geblieben Läufe.txt"). The watchdog integrates a run in
+chunks and aborts it as soon as it exceeds one of its limits:
+
+- wall clock time of the run in seconds
+- number of evaluations of the right hand side (cmf does not report the
+  number of internal CVODE steps, the evaluations grow with them)
+- size of the last internal time step in seconds (off by default: stiff
+  runs, which still finish, have short steps too)
+
+Aborted runs and runs stopped by a solver error are written as one json
+line each to a log file, together with their parameters and the reason.
+
+The limits can be set for a whole job with the environment variables
+WATCHDOG_SECONDS, WATCHDOG_RHS_EVALS and WATCHDOG_MIN_STEP, 0 switches a
+limit off.
+"""
+import datetime
+import json
+import os
+import time
+
+import cmf
+
+
+LOG_FILE = "aborted_runs.jsonl"
+
+
+class RunAborted(RuntimeError):
+    """
+    Raised when a run exceeds a limit of the watchdog.
+    """
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def limit_from_environ(name, default):
+    """
+    Returns the limit set in the environment variable name or default.
+
+    :param name: name of the environment variable
+    :param default: value if the variable is not set
+    :return: float or None, if the limit is switched off
+    """
+    value = float(os.environ.get(name, default or 0))
+    return value or None
+
+
+def rhs_evals(solver):
+    """
+    Returns the right hand side evaluations of the solver since its last
+    reset.
+
+    :param solver: cmf integrator
+    :return: int, always 0 for integrators other than CVODE
+    """
+    try:
+        return solver.get_rhsevals()
+    # A new CVODE solver is only initialized by its first step, the other
+    # integrators do not count the evaluations
+    except (RuntimeError, AttributeError):
+        return 0
+
+
+class Watchdog:
+    """
+    Runs a solver and checks the limits between the chunks of a run.
+    """
+    def __init__(self, max_seconds=600., max_rhs_evals=2e7, min_step=None,
+                 check_interval=None, fixed_step=None, log_file=LOG_FILE):
+        """
+        :param max_seconds: wall clock time allowed for one run
+        :param max_rhs_evals: right hand side evaluations allowed for one run
+        :param min_step: smallest internal time step in seconds, which is
+        allowed at the end of a chunk, None does not check the step
+        :param check_interval: cmf.Time between two checks, None checks once
+        per output step. Shorter intervals abort faster, but cost time and
+        change the results slightly, because CVODE has to stop more often.
+        :param fixed_step: cmf.Time of the steps of integrators with a fixed
+        time step, None lets the integrator choose
+        :param log_file: file for the records of stopped runs, None keeps
+        them only in self.records
+        """
+        self.max_seconds = limit_from_environ("WATCHDOG_SECONDS", max_seconds)
+        self.max_rhs_evals = limit_from_environ("WATCHDOG_RHS_EVALS",
+                                                max_rhs_evals)
+        self.min_step = limit_from_environ("WATCHDOG_MIN_STEP", min_step)
+        self.check_interval = check_interval
+        self.fixed_step = fixed_step
+        self.log_file = log_file
+        self.records = []
+        self.started = None
+        self.rhs_evals = 0
+
+    def run(self, solver, end, step):
+        """
+        Integrates from the current time of the solver until end. Like
+        solver.run, but a solver error is raised instead of retrying the
+        same step forever.
+
+        :param solver: cmf integrator, already set to the start time
+        :param end: end of the run
+        :param step: output time step
+        :return: generator of the times after every step
+        """
+        self.started = time.perf_counter()
+        self.rhs_evals = rhs_evals(solver)
+        interval = self.check_interval or step
+        while solver.t < end:
+            target = solver.t + step
+            while solver.t < target:
+                solver.integrate_until(min(solver.t + interval, target),
+                                       self.fixed_step or cmf.Time())
+                self.check(solver)
+            yield solver.t
+
+    def check(self, solver):
+        """
+        Raises RunAborted if the current run exceeds a limit.
+
+        :param solver: cmf integrator of the run
+        :return: None
+        """
+        seconds = time.perf_counter() - self.started
+        if self.max_seconds and seconds > self.max_seconds:
+            raise RunAborted("wall_clock", "Took more than {:0.1f} s to run"
+                             .format(self.max_seconds))
+        evals = rhs_evals(solver) - self.rhs_evals
+        if self.max_rhs_evals and evals > self.max_rhs_evals:
+            raise RunAborted("rhs_evals", "Needed more than {:0.0f} right "
+                             "hand side evaluations".format(
+                                 self.max_rhs_evals))
+        if self.min_step and solver.get_dt() < self.min_step * cmf.sec:
+            raise RunAborted("min_step", "Time step of {} is smaller than "
+                             "{:g} s".format(solver.get_dt(), self.min_step))
+
+    def record(self, error, parameters=None, solver=None):
+        """
+        Keeps a record of a stopped run and appends it to the log file.
+
+        :param error: RunAborted or the error of the solver
+        :param parameters: dictionary with the parameters of the run
+        :param solver: cmf integrator of the run
+        :return: dictionary with the record
+        """
+        record = {"date": datetime.datetime.now().isoformat(),
+                  "rank": os.environ.get("OMPI_COMM_WORLD_RANK"),
+                  "reason": getattr(error, "reason", "solver_error"),
+                  "message": str(error),
+                  "parameters": {name: float(value) for name, value in
+                                 (parameters or {}).items()}}
+        if self.started is not None:
+            record["seconds"] = time.perf_counter() - self.started
+        if solver is not None:
+            record["model_time"] = str(solver.t)
+            record["rhs_evals"] = rhs_evals(solver) - self.rhs_evals
+        self.records.append(record)
+        if self.log_file:
+            with open(self.log_file, "a") as log:
+                log.write(json.dumps(record) + "\n")
+        return record
@@ -11,6 +11,14 @@ from spotpy.parameter import Uniform
 import os
 import numpy as np
 import pandas as pd
+from evaluation_data import EvaluationData
+from forcing_cache import cached, load_cached
+from storage_state import StorageState
+from discharge_recorder import DischargeRecorder
+from solver_ladder import SolverLadder
+from parameter_bounds import BoundsEnforcer, ParameterOutOfBounds
+from spinup import Spinup
+from early_stop import EarlyStop
 
 
 class ScalingTester:
@@ -53,19 +61,38 @@ class ScalingTester:
     LAI = Uniform(1, 12, doc="Leaf Area Index")
     CanopyClosure = Uniform(0.1, 0.9, doc="Closure of the Canopy [%]")
 
-    def __init__(self, begin=None, end=None, num_cells=None):
+    def __init__(self, begin=None, end=None, num_cells=None, penman=False,
+                 persistent_connections=True, bounds="reject", spinup="year",
+                 early_stop=None, early_stop_margin=None):
         """
         Initializes the model.
 
         :param begin: Start year for the calibration
         :param end: Stop year
         :param num_cells: Number of cells used for this layout
+        :param penman: Use Penman-Monteith instead of Hargreaves for the ET
+        :param persistent_connections: Create the connections only once and
+        change their parameters for every run. False creates them again for
+        every run.
+        :param bounds: "reject", "clip" or "reflect" parameter values outside
+        of their bounds
+        :param spinup: "year" starts every run with empty layers,
+        "equilibrium" with the steady state of the parameters
+        :param early_stop: NSE threshold, runs which can not reach it are
+        stopped early. None simulates all runs completely
+        :param early_stop_margin: margin for stopping runs, which are very
+        unlikely to reach the threshold, None stops only runs which can not
+        reach it
         :return: None
         """
         self.dbname = "scaling_tester_num_cells_" + str(num_cells)
+        if penman:
+            self.dbname += "_penman"
+        self.penman = penman
+        self.persistent_connections = persistent_connections
 
-        # load driver data
-        self.data = DataProvider("fulda_kaemmerzell_climate_79_89.csv")
+        # load driver data, all models of this process share the provider
+        self.data = DataProvider.shared("fulda_kaemmerzell_climate_79_89.csv")
         # Create cells and project
         self.project, self.outlet = self.create_project()
         self.num_cells = num_cells
@@ -73,10 +100,34 @@ class ScalingTester:
 
         # Add the data and set the parameters with random value, so the
         # complete structure can be described.
-        self.data.add_stations(self.project)
+        self.data.add_stations(self.project, penman)
         self.begin = begin or self.data.begin
         self.end = end or self.data.end
+        # Observed discharge and its statistics for the objective function
+        self.evaluation_data = EvaluationData(
+            self.data.Q[self.begin:self.end], calibration_days=None)
         self.setparameters()
+        # Initial volumes of all storages, every run starts from them
+        self.initial_state = StorageState(self.project)
+        # Solvers for all runs, the ladder tries them one after the other
+        # until one of them finishes a run
+        self.ladder = SolverLadder(self.project, self.create_solver)
+        # Repairs or rejects parameter values outside of their bounds
+        self.bounds = BoundsEnforcer(
+            spotpy.parameter.get_parameters_from_setup(self), bounds)
+        # Initial state of every run. The model has no spin-up, so the
+        # steady state uses the mean observed runoff (m³/s in mm/day) of the
+        # first year and the runs start on the first day in both modes.
+        first_year = self.data.Q[self.data.begin:self.data.begin +
+                                 datetime.timedelta(days=365)]
+        runoff = first_year.mean() * 86400 * 1e3 / (self.area * 1e6)
+        self.spinup = Spinup(self.project, [self.outlet], self.data.begin,
+                             self.data.begin, runoff, spinup)
+        # Stops runs, which can not reach the threshold. CMF outputs
+        # m³/day, the observed discharge is in m³/s
+        self.early_stop = EarlyStop(self.evaluation_data, early_stop,
+                                    early_stop_margin, objective="nse",
+                                    scale=1 / 86400)
 
     def create_project(self):
         """
@@ -106,70 +157,153 @@ class ScalingTester:
         cells = []
         for num in range(self.num_cells):
             cells.append(CellTemplate(self.project, self.outlet, area,
-                                      num))
+                                      num, self.penman))
         return cells
 
     def setparameters(self, par=None):
         """
         Sets the parameters for all cells seperately
-        :return:
+        :return: the parameter set
         """
         # Create tje parameters
         par = par or spotpy.parameter.create_set(self)
         # Call all cells
         for cell in self.cells:
-            cell.set_parameters(par)
+            cell.set_parameters(par,
+                                rebuild=not self.persistent_connections)
+        return par
 
-    def runmodel(self):
+    def create_solver(self):
         """
-        Runs the models and saves the results.
+        Creates the solver for the model, it is created only once and used
+        for all runs as the first rung of the solver ladder.
 
-        :return: Simulated discharge
+        :return: cmf.CVodeIntegrator
         """
-        solver = cmf.CVodeIntegrator(self.project, 1e-9)
+        return cmf.CVodeIntegrator(self.project, 1e-9)
 
-        # Result timeseries
-        res_q = cmf.timeseries(self.begin, cmf.day)
+    def runmodel(self, parameters=None):
+        """
+        Runs the models and saves the results.
 
+        :param parameters: dictionary with the parameters of the run, only
+        used for the records of failed attempts
+        :return: Simulated discharge
+        """
+        # Try the solvers of the ladder until one finishes the run
         try:
-            # Start solver and calculate in daily steps
-            for t in solver.run(self.data.begin, self.end, cmf.day):
-                res_q.add(self.outlet.waterbalance(t))
+            return self.ladder.run(self.run_solver, parameters)
+        # Solver errors and runs stopped by the watchdogs in all solvers
         except RuntimeError:
-            return np.array(self.data.Q[
-                            self.data.begin:self.data.end + datetime.timedelta(
-                                days=1)])*np.nan
+            return self.evaluation_data.nan_result()
 
-        return res_q
+    def run_solver(self, solver, watchdog):
+        """
+        Runs the model once with one solver of the ladder.
+
+        :param solver: cmf integrator of the project
+        :param watchdog: Watchdog with the limits for the solver
+        :return: Simulated discharge
+        """
+        # Start every parameter set from the initial volumes or from the
+        # steady state of its parameters
+        self.spinup.restore(self.initial_state, solver)
+        self.early_stop.start()
+
+        # Buffer for the results, allocated for all days at once
+        res_q = DischargeRecorder(self.data.begin + self.data.step, self.end)
+
+        # Start solver and calculate in daily steps
+        for t in watchdog.run(solver, self.end, cmf.day):
+            q = self.outlet.waterbalance(t)
+            res_q.add(q)
+            # The rest of the run stays nan
+            if not self.early_stop.add(q):
+                break
+        return res_q.values
 
     def simulation(self, vector=None):
         """
         Sets the parameters of the model and starts a run
         :return: np.array with runoff in mm/day
         """
-        self.setparameters(vector)
-        result_q = self.runmodel()
+        if vector is not None:
+            # Repair or reject values outside of the bounds of the parameters
+            try:
+                vector = spotpy.parameter.create_set(self)(
+                    *self.bounds.apply(vector))
+            except ParameterOutOfBounds:
+                return self.evaluation_data.nan_result()
+        par = self.setparameters(vector)
+        result_q = self.runmodel(dict(zip(par.name, par)))
         result_q /= 86400
-        return np.array(result_q[self.begin:self.end])
+        # The results start on self.begin, so they only have to be cut to
+        # the length of the evaluation data
+        return result_q[:len(self.evaluation_data.observed)]
 
     def evaluation(self):
         """Returns the evaluation data"""
-        return np.array(self.data.Q[self.begin:self.end])
+        return self.evaluation_data.observed
 
     def objectivefunction(self, simulation, evaluation):
         """Calculates the objective function"""
-        return spotpy.objectivefunctions.nashsutcliffe(evaluation, simulation)
+        # Runs stopped early are ranked below all finished runs
+        if self.early_stop.stopped_early(simulation):
+            return self.early_stop.score(simulation)[0]
+        # Whole period, the statistics of the observed discharge are
+        # calculated once in __init__
+        return self.evaluation_data.for_evaluation(evaluation).nse(
+            simulation)[0]
+
+    def simulation_batch(self, matrix):
+        """
+        Runs many parameter sets, one per row of matrix. The bounds of all
+        sets are checked at once and one parameter set object is used for
+        all runs.
+
+        :param matrix: np.array with one parameter set per row
+        :return: np.array with runoff in mm/day, one row per parameter set
+        """
+        matrix, valid = self.bounds.apply_batch(matrix)
+        result = np.full((len(matrix), len(self.evaluation_data.observed)),
+                         np.nan)
+        par = spotpy.parameter.create_set(self)
+        for index in np.flatnonzero(valid):
+            par = self.setparameters(par(*matrix[index]))
+            result_q = self.runmodel(dict(zip(par.name, par)))
+            result[index] = result_q[:len(self.evaluation_data.observed)]
+        result /= 86400
+        return result
+
+    def objectivefunction_batch(self, simulations, evaluation):
+        """
+        Calculates the objective function of many runs at once
+
+        :param simulations: np.array with one simulation per row
+        :param evaluation: observed discharge
+        :return: np.array with the NSE of every run
+        """
+        result = self.evaluation_data.for_evaluation(evaluation).score_batch(
+            simulations, "nse")[:, 0]
+        # Runs stopped early are ranked below all finished runs
+        for index, simulation in enumerate(simulations):
+            if self.early_stop.stopped_early(simulation):
+                result[index] = self.early_stop.score(simulation)[0]
+        return result
 
 
 class CellTemplate:
     """
     Template, which provides
     """
-    def __init__(self, project, outlet, area, cell_num):
+    def __init__(self, project, outlet, area, cell_num, penman=False):
         self.project = project
         self.outlet = outlet
         self.area = area
+        self.penman = penman
         self.cell = self.project.NewCell(cell_num, 0, 0, area * 1e6)
+        # Connections with parameters, created by the first set_parameters
+        self.connections = None
         self.basic_set_up()
 
     def basic_set_up(self):
@@ -181,48 +315,80 @@ class CellTemplate:
         self.cell.add_layer(2.0)
         self.cell.add_layer(4.0)
         # Install a connection for the ET
-        cmf.HargreaveET(self.cell.layers[0], self.cell.transpiration)
+        if self.penman:
+            cmf.PenmanMonteithET(self.cell.layers[0], self.cell.transpiration)
+        else:
+            cmf.HargreaveET(self.cell.layers[0], self.cell.transpiration)
         # Add Snow
         self.cell.add_storage("Snow", "S")
         cmf.Snowfall(self.cell.snow, self.cell)
         # Create a storage for Interception
         self.cell.add_storage("Canopy", "C")
 
-    def set_parameters(self, par):
+    def set_parameters(self, par, rebuild=False):
         """
-        Sets the parameters for a cell instance
+        Sets the parameters for a cell instance. The connections are created
+        on the first call, later calls only change their parameters.
         :param par: Object with all parameters
+        :param rebuild: Create the connections again
         :return: None
         """
         c = self.cell
-        out = self.outlet
+        if self.connections is None or rebuild:
+            self.connections = self.create_connections()
+        con = self.connections
 
         # Scale to the cellsize
         V0_L1 = (par.V0_L1 / 1000) * self.area * 1e6
         V0_L2 = (par.V0_L2 / 1000) * self.area * 1e6
 
-        # Set uptake stress
+        # Set uptake stress, cmf copies the stress into the cell, so it is
+        # handed over for every parameter set
         ETV1 = par.fETV1 * V0_L1
         ETV0 = par.fETV0 * ETV1
         c.set_uptakestress(cmf.VolumeStress(ETV1, ETV0))
 
         # Connect layer and outlet
-        cmf.PowerLawConnection(c.layers[0], out, Q0=V0_L1 / par.tr_L1_out,
-                               V0=V0_L1,
-                               beta=par.beta_L1_out)
+        con["L1_out"].Q0 = V0_L1 / par.tr_L1_out
+        con["L1_out"].V0 = V0_L1
+        con["L1_out"].beta = par.beta_L1_out
+
+        con["L1_L2"].Q0 = V0_L1 / par.tr_L1_L2
+        con["L1_L2"].V0 = V0_L1
+        con["L1_L2"].beta = par.beta_L1_L2
 
-        cmf.PowerLawConnection(c.layers[0], c.layers[1], Q0=(V0_L1 /
-                                                            par.tr_L1_L2),
-                               V0=V0_L1, beta=par.beta_L1_L2)
-        cmf.PowerLawConnection(c.layers[1], out, Q0=V0_L2 / par.tr_L2_out,
-                               V0=V0_L2,
-                               beta=par.beta_L2_out)
+        con["L2_out"].Q0 = V0_L2 / par.tr_L2_out
+        con["L2_out"].V0 = V0_L2
+        con["L2_out"].beta = par.beta_L2_out
 
         # Snow
-        cmf.SimpleTindexSnowMelt(c.snow, c.layers[0], c,
-                                 rate=par.snow_meltrate)
+        con["snowmelt"].SnowMeltRate = par.snow_meltrate
         cmf.Weather.set_snow_threshold(par.snow_melt_temp)
 
+        # Sets the paramaters for interception
+        c.vegetation.LAI = par.LAI
+
+        # Defines how much throughfall there is (in %)
+        c.vegetation.CanopyClosure = par.CanopyClosure
+
+    def create_connections(self):
+        """
+        Creates all connections of the cell, their parameter values are set
+        by set_parameters.
+        :return: Dictionary with all connections that have parameters
+        """
+        c = self.cell
+        out = self.outlet
+
+        # Connect layer and outlet
+        L1_out = cmf.PowerLawConnection(c.layers[0], out, Q0=1., V0=1.)
+        L1_L2 = cmf.PowerLawConnection(c.layers[0], c.layers[1], Q0=1.,
+                                       V0=1.)
+        L2_out = cmf.PowerLawConnection(c.layers[1], out, Q0=1., V0=1.)
+
+        # Snow
+        snowmelt = cmf.SimpleTindexSnowMelt(c.snow, c.layers[0], c)
+
         # Split the rainfall in interception and throughfall
         cmf.Rainfall(c.canopy, c, False, True)
         cmf.Rainfall(c.surfacewater, c, True, False)
@@ -233,51 +399,138 @@ class CellTemplate:
         # Transpiration from the plants is added
         cmf.CanopyStorageEvaporation(c.canopy, c.evaporation, c)
 
-        # Sets the paramaters for interception
-        c.vegetation.LAI = par.LAI
-
-        # Defines how much throughfall there is (in %)
-        c.vegetation.CanopyClosure = par.CanopyClosure
+        return {"L1_out": L1_out, "L1_L2": L1_L2, "L2_out": L2_out,
+                "snowmelt": snowmelt}
 
 
 class DataProvider:
     """
-    Holds the forcing and calibration data
+    Holds the forcing and calibration data. The climate csv is parsed once
+    into a binary cache (see forcing_cache), later starts only memory map
+    the cached columns. Use DataProvider.shared to let several models of a
+    process use the same provider instead of loading the files again.
     """
-    def __init__(self, file_name):
-        # Load data from file using numpy magic
-        data = pd.read_csv(file_name, encoding="ISO-8859-1", sep=";")
-        # Delete first row, as it only contains the units
-        data = data.iloc[1:]
-        data = data.dropna(axis=0)
+    # Name of the csv column for every variable
+    csv_columns = {"Tmax": "tmax", "Tmin": "tmin", "T": "tmean",
+                   "P": "Prec", "Q": "Q"}
+
+    # Variables only needed for Penman-Monteith, which are not in the csv.
+    # They start on the same day as the csv.
+    penman_files = {
+        "wind": "windspeed_m_s_mw_fulda_wasserkuppe_1979_1989.txt",
+        "sunshine": "sunshine_hours_mw_fulda_wasserkuppe_1979_1989.txt",
+        "rel_hum": "rel_hum_percent_mw_fulda_wasserkuppe_1979_1989.txt"}
 
-        def bstr2date(bs):
-            """
-            Helper function to convert date byte string to datetime object
-            """
-            return datetime.datetime.strptime(bs, '%d.%m.%Y')
+    # Coordinates of the catchment for the sun calculation
+    latitude = 50.555809
+    longitude = 9.680845
+
+    # Providers already loaded in this process
+    _shared = {}
+
+    def __init__(self, file_name):
+        # The first row of the cache holds the dates as days since 1970,
+        # every following row one column of the csv
+        with open(file_name, encoding="ISO-8859-1") as csv_file:
+            names = csv_file.readline().strip().split(";")[1:]
+        values = cached(file_name, self.parse_csv)
+        days = values[0]
 
         # Get begin, step and end from the date column
-        self.begin = bstr2date(data["date"].iloc[0])
-        self.step = bstr2date(data["date"].iloc[1]) - self.begin
-        self.end = bstr2date(data["date"].iloc[-1])
+        self.begin = self.day2date(days[0])
+        self.step = self.day2date(days[1]) - self.begin
+        self.end = self.day2date(days[-1])
+
+        # Read only views on the cache, one contiguous array per variable
+        self.arrays = {}
+        for variable, column in self.csv_columns.items():
+            self.arrays[variable] = values[names.index(column) + 1]
+        for variable, penman_file in self.penman_files.items():
+            if os.path.exists(penman_file):
+                self.arrays[variable] = load_cached(penman_file)[:len(days)]
 
         # Read in the data
-        self.P = cmf.timeseries.from_sequence(self.begin, self.step,
-                                              data["Prec"])
-        self.T = cmf.timeseries.from_sequence(self.begin, self.step,
-                                              data["tmean"])
-        self.Tmin = cmf.timeseries.from_sequence(self.begin, self.step,
-                                                 data["tmin"])
-        self.Tmax = cmf.timeseries.from_sequence(self.begin, self.step,
-                                                 data["tmax"])
-        self.Q = cmf.timeseries.from_sequence(self.begin, self.step,
-                                              data["Q"])
-
-    def add_stations(self, project):
+        self.P = self.timeseries("P")
+        self.T = self.timeseries("T")
+        self.Tmin = self.timeseries("Tmin")
+        self.Tmax = self.timeseries("Tmax")
+        self.Q = self.timeseries("Q")
+        self.wind = self.timeseries("wind")
+        self.sunshine = self.timeseries("sunshine")
+        self.rel_hum = self.timeseries("rel_hum")
+
+    @classmethod
+    def shared(cls, file_name):
+        """
+        Returns the provider for file_name and loads it only the first time.
+
+        :param file_name: name of the climate csv
+        :return: DataProvider
+        """
+        if file_name not in cls._shared:
+            cls._shared[file_name] = cls(file_name)
+        return cls._shared[file_name]
+
+    @staticmethod
+    def parse_csv(file_name):
+        """
+        Reads the climate csv, converts the dates in one go and returns all
+        columns as rows of one float64 array.
+
+        :param file_name: name of the climate csv
+        :return: np.array, first row are the days since 1970
+        """
+        # Skip the second row, as it only contains the units
+        data = pd.read_csv(file_name, encoding="ISO-8859-1", sep=";",
+                           skiprows=[1])
+        data = data.dropna(axis=0)
+        dates = pd.to_datetime(data["date"], format="%d.%m.%Y")
+        days = (dates - pd.Timestamp(1970, 1, 1)).dt.days
+        columns = [days.to_numpy(dtype=np.float64)]
+        for name in data.columns[1:]:
+            columns.append(data[name].to_numpy(dtype=np.float64))
+        return np.vstack(columns)
+
+    @staticmethod
+    def day2date(day):
+        """
+        Helper function to convert the days since 1970 to a datetime object
+        """
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(
+            days=int(day))
+
+    @property
+    def has_penman(self):
+        """True if wind, sunshine and humidity are available"""
+        return all(variable in self.arrays for variable in self.penman_files)
+
+    def array(self, variable):
+        """
+        Returns the values of a variable without copying them, e.g. for
+        cmf.timeseries.from_sequence or from_array.
+
+        :param variable: key of csv_columns or penman_files
+        :return: read only np.array
+        """
+        return self.arrays[variable]
+
+    def timeseries(self, variable):
+        """
+        Creates a cmf.timeseries for a variable
+
+        :param variable: key of csv_columns or penman_files
+        :return: cmf.timeseries or None, if the variable is not available
+        """
+        if variable not in self.arrays:
+            return None
+        return cmf.timeseries.from_array(self.begin, self.step,
+                                         self.arrays[variable])
+
+    def add_stations(self, project, penman=False):
         """
         Creates a rainstation and a meteo station for the cmf project
         :param project: A cmf.project
+        :param penman: Add the data needed for Penman-Monteith
         :return: rainstation, meteo
         """
         rainstation = project.rainfall_stations.add('Kaemmerzell avg', self.P,
@@ -292,6 +545,17 @@ class DataProvider:
         meteo.Tmin = self.Tmin
         meteo.Tmax = self.Tmax
 
+        if penman:
+            if not self.has_penman:
+                raise ValueError("Penman-Monteith needs the files " +
+                                 ", ".join(self.penman_files.values()))
+            # Give coordinates for sun calculation
+            meteo.Latitude = self.latitude
+            meteo.Longitude = self.longitude
+            meteo.Windspeed = self.wind
+            meteo.SetSunshineFraction(self.sunshine)
+            meteo.rHmean = self.rel_hum
+
         project.use_nearest_meteo()
         return rainstation, meteo
 
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshot of the water volumes of all storages of a cmf project. The models
+take a snapshot after setting the initial volumes and restore it before
+every run, so all parameter sets start from the same state without
+rebuilding the project.
+"""
+import numpy as np
+
+
+class StorageState:
+    """
+    Volumes of all storages of a project at one point in time.
+    """
+    def __init__(self, project):
+        """
+        Takes the snapshot.
+
+        :param project: cmf project
+        """
+        # Keep the storage objects, so the restore does not have to search
+        # the project again
+        self.storages = list(project.get_storages())
+        self.volumes = np.array([storage.volume
+                                 for storage in self.storages])
+
+    def restore(self, solver=None, t=None):
+        """
+        Sets all storages back to the volumes of the snapshot. A solver that
+        is used for several runs is set back to t and forgets its history,
+        so it starts again from the restored volumes.
+
+        :param solver: cmf integrator of the project or None
+        :param t: start time of the next run
+        :return: None
+        """
+        for storage, volume in zip(self.storages, self.volumes):
+            storage.volume = volume
+        if solver is not None:
+            if t is not None:
+                solver.set_t(t)
+            solver.reset()
+